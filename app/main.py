@@ -1,20 +1,21 @@
+import argparse
+import asyncio
 import logging
+import os
+import sys
+from functools import partial
 
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    ConversationHandler,
-)
-
-from tictactoe.constants import TOKEN, SELECT_MODE, CONTINUE_GAME, FINISH_GAME
-from tictactoe.handlers import (
-    start,
-    mode_selection,
-    join,
-    game,
-    end,
-    help_command
+from tictactoe.constants import (
+    BOT_MODE,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    CONCURRENT_UPDATES,
+    SUPERVISOR_WORKERS,
+    WORKER_STOP_TIMEOUT,
+    SHUTDOWN_TIMEOUT
 )
 
 logging.basicConfig(
@@ -25,35 +26,84 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def main() -> None:
-    application = Application.builder().token(TOKEN).build()
-
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            SELECT_MODE: [
-                CallbackQueryHandler(mode_selection, pattern="^mode_.*$")
-            ],
-            CONTINUE_GAME: [
-                CallbackQueryHandler(game, pattern="^(stop_game|[0-2][0-2])$"),
-                CommandHandler("join", join),
-            ],
-            FINISH_GAME: [
-                CallbackQueryHandler(game, pattern="^(stop_game|[0-2][0-2])$")
-            ],
-        },
-        fallbacks=[CommandHandler("end", end)],
-
-        per_chat=True,
-        per_user=False
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tic-tac-toe Telegram bot")
+    parser.add_argument("--mode",
+                        choices=("polling", "webhook", "supervisor",
+                                 "worker"),
+                        default=BOT_MODE,
+                        help="supervisor: a webhook routing updates to "
+                             "--workers bot processes by chat")
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--url-path", default=WEBHOOK_PATH)
+    parser.add_argument("--webhook-url", default=WEBHOOK_URL,
+                        help="public URL registered with setWebhook")
+    parser.add_argument("--concurrency", type=int,
+                        default=CONCURRENT_UPDATES,
+                        help="number of updates processed concurrently")
+    parser.add_argument("--workers", type=int, default=SUPERVISOR_WORKERS,
+                        help="bot processes in supervisor mode")
+    return parser.parse_args()
+
+
+def run_supervisor(args: argparse.Namespace) -> None:
+    # The supervisor only routes updates and never loads the bot itself.
+    from tictactoe.supervisor import Supervisor
+
+    command = [sys.executable, os.path.abspath(__file__), "--mode", "worker",
+               "--listen", "127.0.0.1", "--url-path", args.url_path,
+               "--concurrency", str(args.concurrency)]
+    webhook_url = (args.webhook_url
+                   or f"http://{args.listen}:{args.port}/{args.url_path}")
+    supervisor = Supervisor(
+        command, args.workers, args.listen, args.port, args.url_path,
+        webhook_url=webhook_url, secret_token=WEBHOOK_SECRET,
+        stop_timeout=WORKER_STOP_TIMEOUT,
     )
+    asyncio.run(supervisor.serve())
+
+
+def main() -> None:
+    args = parse_args()
+    if args.mode == "supervisor":
+        run_supervisor(args)
+        return
+
+    # Imported here, not at the top: the AI pool spawns its processes by
+    # importing this module again, and they need none of the bot.
+    from tictactoe.bot import build_application, serve_application
+
+    application = build_application(args.concurrency)
+    if args.mode == "worker":
+        from tictactoe.supervisor import serve_worker
+
+        asyncio.run(serve_worker(application, args.listen, args.port,
+                                 args.url_path, WEBHOOK_SECRET,
+                                 SHUTDOWN_TIMEOUT))
+        return
 
-    application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("end", end))
+    updater = application.updater
+    if args.mode == "webhook":
+        webhook_url = (args.webhook_url
+                       or f"http://{args.listen}:{args.port}/{args.url_path}")
+        logger.info("Bot is running! Webhook on %s:%d/%s",
+                    args.listen, args.port, args.url_path)
+        start_updates = partial(
+            updater.start_webhook,
+            listen=args.listen,
+            port=args.port,
+            url_path=args.url_path,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=max(40, args.concurrency),
+        )
+    else:
+        logger.info("Bot is running!")
+        start_updates = updater.start_polling
 
-    logger.info("Bot is running!")
-    application.run_polling()
+    asyncio.run(serve_application(application, start_updates, updater.stop,
+                                  SHUTDOWN_TIMEOUT))
 
 
 if __name__ == "__main__":
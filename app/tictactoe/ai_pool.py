@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from concurrent.futures import BrokenExecutor, Executor
+from typing import Any
+
+from tictactoe.board import Board, GridBoard
+from tictactoe.book import book_move
+from tictactoe.constants import AI_ENGINE, BOARD_VARIANTS
+from tictactoe.game_logic import find_best_move, search_move
+from tictactoe.position_cache import canonical, get_position_cache
+from tictactoe.search import Geometry, Zobrist, get_engine, heuristic_move
+
+logger = logging.getLogger(__name__)
+
+AI_POOL_KEY = "ai_pool"
+
+
+def pack_board(size: int, k: int, x: int, o: int) -> bytes:
+    """
+    Packs a position into bytes: size, k and the two masks, each
+    ceil(size * size / 8) bytes long (60 bytes for 15x15).
+
+    Parameters
+    ----------
+    size, k : int
+        Board variant.
+    x, o : int
+        Masks of CROSS and ZERO.
+
+    Returns
+    -------
+    bytes
+        Packed position.
+    """
+    width = (size * size + 7) // 8
+    return bytes((size, k)) + x.to_bytes(width, "little") \
+        + o.to_bytes(width, "little")
+
+
+def unpack_board(data: bytes) -> tuple[int, int, int, int]:
+    """
+    Restores a position packed with pack_board().
+
+    Parameters
+    ----------
+    data : bytes
+        Packed position.
+
+    Returns
+    -------
+    tuple[int, int, int, int]
+        (size, k, x, o).
+    """
+    size, k = data[0], data[1]
+    width = (size * size + 7) // 8
+    x = int.from_bytes(data[2:2 + width], "little")
+    o = int.from_bytes(data[2 + width:2 + 2 * width], "little")
+    return size, k, x, o
+
+
+def _warm_up() -> None:
+    # Runs once in every worker: the engine and its transposition table
+    # then live for the whole life of the process.
+    if AI_ENGINE != "heuristic":
+        get_engine(AI_ENGINE)
+    for size, k in BOARD_VARIANTS.values():
+        if size != 3:
+            Geometry.get(size, k)
+            Zobrist.get(size * size)
+
+
+def _worker_move(data: bytes) -> int | None:
+    # The bot process checks its position cache before sending a search.
+    return search_move(*unpack_board(data), cached=False)
+
+
+class AIPool:
+    """
+    Computes AI moves for large boards in worker processes.
+
+    3x3 moves are a table lookup and are answered in place. Other boards
+    are looked up in the opening book and the position cache of the bot
+    process and, on a miss, sent to a ProcessPoolExecutor as packed
+    bytes. Every worker keeps its search engine, so the transposition
+    table stays warm between moves. When `max_pending` searches are
+    already in flight, a new move is answered at once by the one-ply
+    heuristic instead of waiting.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes; 0 runs searches in a thread of the
+        bot process.
+    max_pending : int
+        Maximum number of searches in flight.
+    """
+
+    def __init__(self, workers: int = 0, max_pending: int = 32) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: Executor | None = None
+        self.metrics = {"searched": 0, "fallback": 0, "failed": 0}
+
+    def start(self) -> None:
+        """
+        Starts the worker processes. Without it searches run in threads.
+        """
+        if self.workers and self._executor is None:
+            # multiprocessing is only loaded when worker processes are
+            # used.
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Workers are spawned rather than forked: the bot process
+            # already runs threads (e.g. the store flush).
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+            )
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes, cancelling the queued searches.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def best_move(
+        self, board: Board | GridBoard
+    ) -> tuple[int, int] | None:
+        """
+        Finds the AI move without blocking the event loop.
+
+        Parameters
+        ----------
+        board : Board or GridBoard
+            Current board.
+
+        Returns
+        -------
+        tuple[int, int] or None
+            (row, col) of the chosen cell or None if no free cells.
+        """
+        if (board.size, board.k) == (3, 3):
+            return find_best_move(board)
+
+        index = book_move(board.size, board.k, board.x, board.o)
+        if index is not None:
+            return divmod(index, board.size)
+        cache = get_position_cache()
+        key, transform = canonical(board.size, board.k, board.x, board.o)
+        index = cache.get(key, transform)
+        if index is not None:
+            return divmod(index, board.size)
+
+        if self.pending >= self.max_pending:
+            self.metrics["fallback"] += 1
+            index = heuristic_move(board.size, board.k, board.x, board.o)
+            return None if index is None else divmod(index, board.size)
+
+        self.pending += 1
+        try:
+            index = await self._search(board.size, board.k, board.x,
+                                       board.o)
+        finally:
+            self.pending -= 1
+        return None if index is None else divmod(index, board.size)
+
+    async def _search(self, size: int, k: int, x: int,
+                      o: int) -> int | None:
+        if self._executor is None:
+            index = await asyncio.to_thread(search_move, size, k, x, o,
+                                            cached=False)
+            self._searched(size, k, x, o, index)
+            return index
+
+        loop = asyncio.get_running_loop()
+        try:
+            index = await loop.run_in_executor(
+                self._executor, _worker_move, pack_board(size, k, x, o)
+            )
+        except BrokenExecutor as exc:
+            logger.warning("AI worker pool is broken, restarting: %s", exc)
+            self.metrics["failed"] += 1
+            self.shutdown()
+            self.start()
+            return heuristic_move(size, k, x, o)
+        self._searched(size, k, x, o, index)
+        return index
+
+    def _searched(self, size: int, k: int, x: int, o: int,
+                  index: int | None) -> None:
+        # Only searched moves are cached, never the heuristic fallbacks.
+        self.metrics["searched"] += 1
+        get_position_cache().put(*canonical(size, k, x, o), index)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns move counters and the number of searches in flight.
+
+        Returns
+        -------
+        dict[str, int]
+            searched, fallback, failed and pending.
+        """
+        return dict(self.metrics, pending=self.pending)
+
+
+def get_ai_pool(context: Any) -> AIPool:
+    """
+    Returns the AI pool of the application, creating one that searches in
+    threads if none was configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+
+    Returns
+    -------
+    AIPool
+        The AI pool.
+    """
+    pool = context.bot_data.get(AI_POOL_KEY)
+    if pool is None:
+        pool = context.bot_data[AI_POOL_KEY] = AIPool()
+    return pool
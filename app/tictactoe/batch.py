@@ -0,0 +1,169 @@
+"""
+Vectorized evaluation of many 3x3 boards at once.
+
+Boards come in one of two layouts:
+
+- (N, 9) int8 arrays of cells, 0 - free, 1 - CROSS, 2 - ZERO, in the
+  row * 3 + col order used everywhere else;
+- (N, 2) uint16 arrays of (x, o) masks, the representation of Board and
+  of the game store, viewed without copying by masks_view().
+"""
+from array import array
+from typing import Iterable, NamedTuple
+
+import numpy as np
+
+from tictactoe.board import FULL_MASK, WIN_LINES, Board
+
+# (8, 3) cell indices of the winning lines.
+LINE_INDICES = np.array(
+    [[i for i in range(9) if line >> i & 1] for line in WIN_LINES],
+    dtype=np.intp
+)
+LINE_MASKS = np.array(WIN_LINES, dtype=np.uint16)
+_CELL_BITS = np.arange(9, dtype=np.uint16)
+_CELL_WEIGHTS = (1 << _CELL_BITS).astype(np.uint16)
+
+FREE, X, O = 0, 1, 2
+
+
+class BatchResult(NamedTuple):
+    """
+    Evaluation of N boards.
+
+    Attributes
+    ----------
+    winners : np.ndarray
+        (N,) int8: X, O or FREE if nobody has a line.
+    draws : np.ndarray
+        (N,) bool: the board is full and nobody has a line.
+    legal : np.ndarray
+        (N,) uint16 masks of free cells, empty once the game is over.
+    """
+    winners: np.ndarray
+    draws: np.ndarray
+    legal: np.ndarray
+
+
+def winners(boards: np.ndarray) -> np.ndarray:
+    """
+    Winners of (N, 9) int8 boards.
+
+    Returns
+    -------
+    np.ndarray
+        (N,) int8: X, O or FREE.
+    """
+    lines = boards[:, LINE_INDICES]
+    result = np.zeros(len(boards), dtype=np.int8)
+    for player in (X, O):
+        result[(lines == player).all(axis=2).any(axis=1)] = player
+    return result
+
+
+def evaluate(boards: np.ndarray) -> BatchResult:
+    """
+    Winners, draws and legal moves of (N, 9) int8 boards.
+
+    Parameters
+    ----------
+    boards : np.ndarray
+        (N, 9) int8 boards.
+
+    Returns
+    -------
+    BatchResult
+        Evaluation of every board.
+    """
+    won = winners(boards)
+    free = boards == FREE
+    legal = (free.astype(np.uint16) << _CELL_BITS).sum(axis=1,
+                                                        dtype=np.uint16)
+    legal[won != FREE] = 0
+    draws = (won == FREE) & ~free.any(axis=1)
+    return BatchResult(won, draws, legal)
+
+
+def evaluate_masks(masks: np.ndarray) -> BatchResult:
+    """
+    Winners, draws and legal moves of (N, 2) uint16 (x, o) masks, computed
+    with bit operations and no conversion to cells.
+
+    Parameters
+    ----------
+    masks : np.ndarray
+        (N, 2) uint16 masks, e.g. from masks_view().
+
+    Returns
+    -------
+    BatchResult
+        Evaluation of every board.
+    """
+    x = masks[:, 0]
+    o = masks[:, 1]
+    won = np.zeros(len(masks), dtype=np.int8)
+    for player, mask in ((X, x), (O, o)):
+        has_line = ((mask[:, None] & LINE_MASKS) == LINE_MASKS).any(axis=1)
+        won[has_line] = player
+    legal = ~(x | o) & np.uint16(FULL_MASK)
+    draws = (won == FREE) & (legal == 0)
+    legal[won != FREE] = 0
+    return BatchResult(won, draws, legal)
+
+
+def pack_masks(boards: Iterable[Board]) -> array:
+    """
+    Packs boards into a flat buffer of (x, o) uint16 pairs.
+
+    Parameters
+    ----------
+    boards : Iterable[Board]
+        Boards, e.g. of the games in a store.
+
+    Returns
+    -------
+    array
+        array("H") of 2 * N values, ready for masks_view().
+    """
+    buffer = array("H")
+    for board in boards:
+        buffer.append(board.x)
+        buffer.append(board.o)
+    return buffer
+
+
+def masks_view(buffer) -> np.ndarray:
+    """
+    Views a buffer of (x, o) uint16 pairs as an (N, 2) array without
+    copying it.
+
+    Parameters
+    ----------
+    buffer : bytes-like
+        array("H"), bytes, mmap or any object exporting the buffer
+        protocol, native byte order.
+
+    Returns
+    -------
+    np.ndarray
+        (N, 2) uint16 array sharing memory with the buffer.
+    """
+    return np.frombuffer(buffer, dtype=np.uint16).reshape(-1, 2)
+
+
+def masks_to_cells(masks: np.ndarray) -> np.ndarray:
+    """
+    Converts (N, 2) uint16 masks to (N, 9) int8 boards.
+    """
+    x = (masks[:, :1] >> _CELL_BITS) & 1
+    o = (masks[:, 1:] >> _CELL_BITS) & 1
+    return (x + 2 * o).astype(np.int8)
+
+
+def cells_to_masks(boards: np.ndarray) -> np.ndarray:
+    """
+    Converts (N, 9) int8 boards to (N, 2) uint16 masks.
+    """
+    x = ((boards == X) * _CELL_WEIGHTS).sum(axis=1, dtype=np.uint16)
+    o = ((boards == O) * _CELL_WEIGHTS).sum(axis=1, dtype=np.uint16)
+    return np.stack((x, o), axis=1)
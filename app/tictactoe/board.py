@@ -0,0 +1,264 @@
+from tictactoe.constants import FREE_SPACE, CROSS, ZERO
+
+# Cells are numbered 0..8 row by row: index = row * 3 + col.
+WIN_LINES = (
+    0b000000111, 0b000111000, 0b111000000,
+    0b001001001, 0b010010010, 0b100100100,
+    0b100010001, 0b001010100,
+)
+FULL_MASK = 0b111111111
+
+
+def has_line(mask: int) -> bool:
+    """
+    Checks if a 9-bit mask contains a complete row, column or diagonal.
+
+    Parameters
+    ----------
+    mask : int
+        9-bit mask of one player's cells.
+
+    Returns
+    -------
+    bool
+        True if the mask covers one of WIN_LINES.
+    """
+    for line in WIN_LINES:
+        if mask & line == line:
+            return True
+    return False
+
+
+class Board:
+    """
+    Compact 3x3 board: two 9-bit masks of cells taken by CROSS and ZERO.
+
+    For compatibility with code written against the list-of-lists board,
+    `len(board)` is 3 and `board[row]` is a read-only tuple of emoji.
+    """
+
+    __slots__ = ("x", "o")
+
+    size = 3
+    k = 3
+
+    def __init__(self, x: int = 0, o: int = 0) -> None:
+        self.x = x
+        self.o = o
+
+    @classmethod
+    def from_rows(cls, rows: list[list[str]]) -> "Board":
+        """
+        Builds a board from a 3x3 matrix with CROSS / ZERO / FREE_SPACE.
+
+        Parameters
+        ----------
+        rows : list[list[str]]
+            A 3x3 matrix.
+
+        Returns
+        -------
+        Board
+            The same position as masks.
+        """
+        x = o = 0
+        for r in range(3):
+            for c in range(3):
+                if rows[r][c] == CROSS:
+                    x |= 1 << (r * 3 + c)
+                elif rows[r][c] == ZERO:
+                    o |= 1 << (r * 3 + c)
+        return cls(x, o)
+
+    def cell(self, index: int) -> str:
+        """
+        Returns the symbol in a cell.
+
+        Parameters
+        ----------
+        index : int
+            Cell index, row * 3 + col.
+
+        Returns
+        -------
+        str
+            CROSS, ZERO or FREE_SPACE.
+        """
+        bit = 1 << index
+        if self.x & bit:
+            return CROSS
+        if self.o & bit:
+            return ZERO
+        return FREE_SPACE
+
+    def is_free(self, index: int) -> bool:
+        return not (self.x | self.o) >> index & 1
+
+    @property
+    def free_mask(self) -> int:
+        return FULL_MASK & ~(self.x | self.o)
+
+    def place(self, index: int, symbol: str) -> None:
+        """
+        Puts a symbol into a cell.
+
+        Parameters
+        ----------
+        index : int
+            Cell index, row * 3 + col.
+        symbol : str
+            CROSS or ZERO.
+        """
+        if symbol == CROSS:
+            self.x |= 1 << index
+        else:
+            self.o |= 1 << index
+
+    def winner(self) -> str | None:
+        """
+        Returns CROSS or ZERO if one of them has a line, otherwise None.
+        """
+        if has_line(self.x):
+            return CROSS
+        if has_line(self.o):
+            return ZERO
+        return None
+
+    def is_full(self) -> bool:
+        return (self.x | self.o).bit_count() == 9
+
+    def to_rows(self) -> list[list[str]]:
+        return [list(self[r]) for r in range(3)]
+
+    def __len__(self) -> int:
+        return 3
+
+    def __getitem__(self, row: int) -> tuple[str, str, str]:
+        if not 0 <= row < 3:
+            raise IndexError("board row out of range")
+        return tuple(self.cell(row * 3 + col) for col in range(3))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Board):
+            return NotImplemented
+        return self.x == other.x and self.o == other.o
+
+    def __repr__(self) -> str:
+        return f"Board(x={self.x:#011b}, o={self.o:#011b})"
+
+
+# (row step, col step) of the four line directions.
+_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+class GridBoard:
+    """
+    N x N board where K in a row wins, e.g. 7x7 with 4 or 15x15 gomoku.
+
+    Cells are numbered row by row (index = row * size + col) and stored as
+    two size*size-bit masks. The winner is found incrementally: place()
+    only walks the four lines through the new stone, so a move costs
+    O(K) instead of a scan of the whole board.
+    """
+
+    __slots__ = ("size", "k", "x", "o", "won")
+
+    def __init__(self, size: int, k: int, x: int = 0, o: int = 0) -> None:
+        self.size = size
+        self.k = k
+        self.x = x
+        self.o = o
+        self.won: str | None = None
+        if x | o:
+            self.won = self._scan_winner()
+
+    def cell(self, index: int) -> str:
+        bit = 1 << index
+        if self.x & bit:
+            return CROSS
+        if self.o & bit:
+            return ZERO
+        return FREE_SPACE
+
+    def is_free(self, index: int) -> bool:
+        return not (self.x | self.o) >> index & 1
+
+    @property
+    def free_mask(self) -> int:
+        return ((1 << self.size * self.size) - 1) & ~(self.x | self.o)
+
+    def line_length(self, index: int, mask: int, dr: int, dc: int) -> int:
+        """
+        Counts the stones of `mask` in one line through a cell.
+
+        Parameters
+        ----------
+        index : int
+            Cell index, counted as taken.
+        mask : int
+            Mask of one player's cells.
+        dr, dc : int
+            Line direction.
+
+        Returns
+        -------
+        int
+            Length of the unbroken line through the cell, at most 2K - 1.
+        """
+        size = self.size
+        row, col = divmod(index, size)
+        length = 1
+        for sign in (1, -1):
+            r, c = row + sign * dr, col + sign * dc
+            for _ in range(self.k - 1):
+                if not (0 <= r < size and 0 <= c < size):
+                    break
+                if not mask >> (r * size + c) & 1:
+                    break
+                length += 1
+                r += sign * dr
+                c += sign * dc
+        return length
+
+    def place(self, index: int, symbol: str) -> None:
+        """
+        Puts a symbol into a cell and updates the winner.
+
+        Parameters
+        ----------
+        index : int
+            Cell index, row * size + col.
+        symbol : str
+            CROSS or ZERO.
+        """
+        if symbol == CROSS:
+            self.x |= 1 << index
+            mask = self.x
+        else:
+            self.o |= 1 << index
+            mask = self.o
+        if self.won is None:
+            for dr, dc in _DIRECTIONS:
+                if self.line_length(index, mask, dr, dc) >= self.k:
+                    self.won = symbol
+                    break
+
+    def _scan_winner(self) -> str | None:
+        for symbol, mask in ((CROSS, self.x), (ZERO, self.o)):
+            index = 0
+            while mask >> index:
+                if mask >> index & 1:
+                    for dr, dc in _DIRECTIONS:
+                        if self.line_length(index, mask, dr, dc) >= self.k:
+                            return symbol
+                index += 1
+        return None
+
+    def winner(self) -> str | None:
+        return self.won
+
+    def is_full(self) -> bool:
+        return (self.x | self.o).bit_count() == self.size * self.size
+
+    def __repr__(self) -> str:
+        return f"GridBoard(size={self.size}, k={self.k})"
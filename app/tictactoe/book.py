@@ -0,0 +1,426 @@
+"""
+Opening book and endgame tables of large-board positions, precomputed
+offline and memory-mapped at runtime.
+
+File layout: a fixed 16-byte header (see HEADER), then the 64-bit hashes
+of all positions sorted ascending, then one 4-byte entry per hash in the
+same order (see ENTRY). Positions are stored in their canonical
+orientation (see position_cache.canonical()), so one entry serves all 8
+rotations and reflections; a hash covers the board variant too, so one
+file may hold several variants. All numbers are little-endian.
+
+The loader maps the file read-only: every process of the bot shares the
+same page cache pages, and a lookup is a binary search over the hash
+column read in place, without copying or parsing the file.
+
+Build a book from the command line:
+
+    PYTHONPATH=app python -m tictactoe.book book.bin --variant 7 \\
+        --plies 3 --replay games.log
+"""
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, NamedTuple
+
+from tictactoe.constants import AI_BOOK, BOARD_VARIANTS
+from tictactoe.position_cache import Key, canonical, symmetries
+from tictactoe.replay import read_records
+from tictactoe.search import (
+    WIN_SCORE,
+    AlphaBetaEngine,
+    Geometry,
+    side_to_move
+)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"TTTB"
+VERSION = 1
+# magic, version, reserved, number of positions.
+HEADER = struct.Struct("<4sHHQ")
+# Canonical move (NO_MOVE: none), value for the side to move (1 win,
+# 0 draw or unknown, -1 loss), kind.
+ENTRY = struct.Struct("<HbB")
+NO_MOVE = 0xFFFF
+BOOK, ENDGAME = range(2)
+
+
+class BookEntry(NamedTuple):
+    """
+    A position found in the book.
+
+    Attributes
+    ----------
+    move : int or None
+        Cell index in the orientation of the probed position.
+    value : int
+        1 if the side to move wins, -1 if it loses, 0 otherwise.
+    kind : int
+        BOOK for opening positions, ENDGAME for solved ones.
+    """
+    move: int | None
+    value: int
+    kind: int
+
+
+def position_hash(key: Key) -> int:
+    """
+    Returns the 64-bit hash of a canonical position.
+
+    Parameters
+    ----------
+    key : Key
+        (size, k, x, o) as returned by canonical().
+
+    Returns
+    -------
+    int
+        The hash the book is sorted by.
+    """
+    size, k, x, o = key
+    width = (size * size + 7) // 8
+    data = bytes((size, k)) + x.to_bytes(width, "little") \
+        + o.to_bytes(width, "little")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          "little")
+
+
+def pack_book(entries: dict[int, tuple[int, int, int]]) -> bytes:
+    """
+    Packs book entries in the file format.
+
+    Parameters
+    ----------
+    entries : dict[int, tuple[int, int, int]]
+        position_hash() -> (canonical move or NO_MOVE, value, kind).
+
+    Returns
+    -------
+    bytes
+        The book file contents.
+    """
+    hashes = sorted(entries)
+    column = array("Q", hashes)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, 0, len(hashes)),
+        column.tobytes(),
+        b"".join(ENTRY.pack(*entries[value]) for value in hashes),
+    ])
+
+
+def write_book(path: str, entries: dict[int, tuple[int, int, int]]) -> None:
+    """
+    Writes a book file atomically. Processes that still map the old file
+    keep reading it until they reopen the book.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(pack_book(entries))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class OpeningBook:
+    """
+    Read-only view of a book file.
+
+    Parameters
+    ----------
+    path : str
+        Book file written by write_book().
+
+    Raises
+    ------
+    ValueError
+        If the file is not a book of this version or is truncated.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as file:
+            # The mapping stays valid after the file is closed.
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, count = HEADER.unpack_from(self._map)
+            if (magic, version) != (MAGIC, VERSION):
+                raise ValueError(f"Not a book of version {VERSION}: {path}")
+            self._entries = HEADER.size + count * 8
+            if len(self._map) != self._entries + count * ENTRY.size:
+                raise ValueError(f"Truncated book: {path}")
+        except (ValueError, struct.error):
+            self._map.close()
+            raise
+        self._view = memoryview(self._map)
+        column = self._view[HEADER.size:self._entries]
+        if sys.byteorder == "little":
+            self._hashes = column.cast("Q")
+        else:
+            # Big-endian hosts read a swapped copy of the hash column.
+            self._hashes = array("Q", column)
+            self._hashes.byteswap()
+            column.release()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def probe(self, size: int, k: int, x: int, o: int) -> BookEntry | None:
+        """
+        Looks up a position in any orientation.
+
+        Parameters
+        ----------
+        size, k : int
+            Board variant.
+        x, o : int
+            Masks of CROSS and ZERO.
+
+        Returns
+        -------
+        BookEntry or None
+            The entry, or None if the position is not in the book.
+        """
+        key, transform = canonical(size, k, x, o)
+        value = position_hash(key)
+        index = bisect_left(self._hashes, value)
+        if index == len(self._hashes) or self._hashes[index] != value:
+            self.misses += 1
+            return None
+        move, score, kind = ENTRY.unpack_from(
+            self._map, self._entries + index * ENTRY.size
+        )
+        if move == NO_MOVE:
+            move = None
+        else:
+            move = symmetries(size)[1][transform][move]
+            # A hash collision with another position.
+            if (x | o) >> move & 1:
+                self.misses += 1
+                return None
+        self.hits += 1
+        return BookEntry(move, score, kind)
+
+    def close(self) -> None:
+        if isinstance(self._hashes, memoryview):
+            self._hashes.release()
+        self._view.release()
+        self._map.close()
+
+
+_book: OpeningBook | None = None
+_book_loaded = False
+_book_lock = threading.Lock()
+
+
+def get_book() -> OpeningBook | None:
+    """
+    Returns the book of the process, opened from AI_BOOK on first use;
+    None if AI_BOOK is empty or the file cannot be read.
+    """
+    global _book, _book_loaded
+    if _book_loaded:
+        return _book
+    with _book_lock:
+        if not _book_loaded:
+            if AI_BOOK:
+                try:
+                    _book = OpeningBook(AI_BOOK)
+                except (OSError, ValueError) as exc:
+                    logger.warning("AI book %s not loaded: %s", AI_BOOK, exc)
+            _book_loaded = True
+    return _book
+
+
+def book_move(size: int, k: int, x: int, o: int) -> int | None:
+    """
+    Returns the move the book gives for a position, or None if there is
+    no book or the position is not in it.
+    """
+    book = get_book()
+    if book is None:
+        return None
+    entry = book.probe(size, k, x, o)
+    return None if entry is None else entry.move
+
+
+def _solved(geometry: Geometry, score: int) -> int:
+    # Value of a search score: a win or loss the search ran into, or 0.
+    if abs(score) < WIN_SCORE - geometry.cells:
+        return 0
+    return 1 if score > 0 else -1
+
+
+def opening_positions(size: int, k: int,
+                      plies: int) -> Iterator[tuple[int, int]]:
+    """
+    Positions reachable from the empty board in at most `plies` moves,
+    playing only next to existing stones (as the engines do), one per
+    symmetry class. Finished games are left out.
+
+    Yields
+    ------
+    tuple[int, int]
+        (x, o) of each position.
+    """
+    geometry = Geometry.get(size, k)
+    level = {canonical(size, k, 0, 0)[0]: (0, 0)}
+    for ply in range(plies + 1):
+        following = {}
+        for x, o in level.values():
+            yield x, o
+            if ply == plies:
+                continue
+            me, other = side_to_move(x, o)
+            candidates = geometry.candidates(me, other)
+            while candidates:
+                bit = candidates & -candidates
+                candidates ^= bit
+                if geometry.wins(bit.bit_length() - 1, me | bit):
+                    continue
+                child = (x | bit, o) if me is x else (x, o | bit)
+                key = canonical(size, k, *child)[0]
+                following.setdefault(key, child)
+        level = following
+
+
+def endgame_positions(size: int, k: int, paths: Iterable[str],
+                      tail: int) -> Iterator[tuple[int, int]]:
+    """
+    Positions of the last `tail` moves before the end of logged games.
+
+    Yields
+    ------
+    tuple[int, int]
+        (x, o) of each position; repeated ones are yielded again.
+    """
+    for path in paths:
+        for record in read_records(path):
+            if (record.size, record.k) != (size, k):
+                continue
+            x = o = 0
+            start = max(len(record.moves) - tail, 0)
+            for ply, cell in enumerate(record.moves):
+                if ply >= start:
+                    yield x, o
+                if ply % 2:
+                    o |= 1 << cell
+                else:
+                    x |= 1 << cell
+
+
+def build_entries(size: int, k: int, plies: int,
+                  replays: Iterable[str] = (), tail: int = 6,
+                  time_limit: float = 1.0, node_limit: int = 0,
+                  engine: AlphaBetaEngine | None = None
+                  ) -> dict[int, tuple[int, int, int]]:
+    """
+    Searches the opening positions of a variant and the endings of
+    logged games.
+
+    Every opening position gets the engine's move. Of the endings, only
+    positions the search finds won or lost are kept. The engine prunes
+    the moves it looks at, so values are as good as its search, not a
+    proof.
+
+    Parameters
+    ----------
+    size, k : int
+        Board variant.
+    plies : int
+        Depth of the opening book.
+    replays : Iterable[str]
+        Replay logs to take endings from.
+    tail : int
+        Number of final positions of each logged game to solve.
+    time_limit, node_limit : float, int
+        Budget of one search, as for AlphaBetaEngine.search().
+    engine : AlphaBetaEngine or None
+        Engine to search with; a new one by default.
+
+    Returns
+    -------
+    dict[int, tuple[int, int, int]]
+        Entries for pack_book().
+    """
+    engine = AlphaBetaEngine() if engine is None else engine
+    geometry = Geometry.get(size, k)
+    forward = symmetries(size)[0]
+    entries: dict[int, tuple[int, int, int]] = {}
+
+    def add(x: int, o: int, kind: int) -> None:
+        key, transform = canonical(size, k, x, o)
+        position = position_hash(key)
+        if position in entries:
+            return
+        result = engine.search(size, k, x, o, time_limit, node_limit)
+        if result.move is None:
+            return
+        # The engine plays a winning move without scoring it.
+        me = side_to_move(x, o)[0]
+        if geometry.wins(result.move, me | 1 << result.move):
+            value = 1
+        else:
+            value = _solved(geometry, result.score)
+        if kind == ENDGAME and not value:
+            return
+        entries[position] = (forward[transform][result.move], value, kind)
+
+    for x, o in opening_positions(size, k, plies):
+        add(x, o, BOOK)
+    for x, o in endgame_positions(size, k, replays, tail):
+        add(x, o, ENDGAME)
+    return entries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build an opening book and endgame tables of large "
+                    "boards"
+    )
+    parser.add_argument("path", help="book file to write")
+    parser.add_argument("--variant", action="append",
+                        choices=[name for name, (size, _) in
+                                 BOARD_VARIANTS.items() if size != 3],
+                        help="board variant (repeatable, default: all)")
+    parser.add_argument("--plies", type=int, default=2,
+                        help="depth of the opening book")
+    parser.add_argument("--replay", nargs="*", default=[],
+                        help="replay logs to take endings from")
+    parser.add_argument("--tail", type=int, default=6,
+                        help="final positions of each game to solve")
+    parser.add_argument("--time-limit", type=float, default=2.0,
+                        help="seconds per position")
+    parser.add_argument("--node-limit", type=int, default=0,
+                        help="nodes per position (0: no limit)")
+    args = parser.parse_args()
+
+    variants = args.variant or [name for name, (size, _) in
+                                BOARD_VARIANTS.items() if size != 3]
+    entries: dict[int, tuple[int, int, int]] = {}
+    for name in variants:
+        size, k = BOARD_VARIANTS[name]
+        started = time.perf_counter()
+        found = build_entries(size, k, args.plies, args.replay, args.tail,
+                              args.time_limit, args.node_limit)
+        entries.update(found)
+        print(f"{size}x{size}: {len(found)} positions in "
+              f"{time.perf_counter() - started:.1f} s")
+    write_book(args.path, entries)
+    print(f"{len(entries)} positions written to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Assembly of the bot Application: handlers, game store, outgoing queue, AI
+pool and the optional metrics server, replay log, game snapshot and
+idle-game reaper; and the serving loop with a graceful shutdown.
+"""
+import asyncio
+import logging
+import signal
+from typing import Awaitable, Callable
+
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    CallbackQueryHandler,
+    InlineQueryHandler,
+)
+
+from tictactoe.constants import (
+    TOKEN,
+    GAME_CALLBACK_PATTERN,
+    INLINE_CALLBACK_PATTERN,
+    TELEGRAM_API_URL,
+    GAME_STORE,
+    GAME_STORE_SHARDS,
+    GAME_STORE_FLUSH_INTERVAL,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_CHAT_BURST,
+    AI_WORKERS,
+    AI_MAX_PENDING,
+    METRICS_LISTEN,
+    METRICS_PORT,
+    GAME_TTL,
+    MAX_GAMES,
+    GAME_REAP_INTERVAL,
+    GAME_EXPIRED_NOTICE,
+    REPLAY_LOG,
+    REPLAY_FSYNC_INTERVAL,
+    GAME_SNAPSHOT,
+    RATING_STORE
+)
+from tictactoe.handlers import (
+    start,
+    mode_selection,
+    join,
+    game,
+    end,
+    help_command
+)
+from tictactoe.inline import inline_game, inline_query
+from tictactoe.lobby import (
+    queue,
+    leave,
+    tournament,
+    enter,
+    begin,
+    top,
+    rank
+)
+from tictactoe.ai_pool import AI_POOL_KEY, AIPool
+from tictactoe.book import get_book
+from tictactoe.concurrency import ChatSerialUpdateProcessor
+from tictactoe.metrics import (
+    ACTIVE_GAMES,
+    BOOK_LOOKUPS,
+    MATCH_QUEUE,
+    METRICS_SERVER_KEY,
+    POSITION_CACHE_LOOKUPS,
+    POSITION_CACHE_SIZE,
+    InstrumentedRequest,
+    MetricsServer
+)
+from tictactoe.matchmaking import MATCHMAKER_KEY, Matchmaker
+from tictactoe.outbound import OUTBOUND_KEY, OutboundQueue
+from tictactoe.position_cache import get_position_cache
+from tictactoe.ratings import RATINGS_KEY, create_rating_table
+from tictactoe.reaper import GameReaper
+from tictactoe.replay import REPLAY_KEY, ReplayLog
+from tictactoe.snapshot import SNAPSHOT_KEY, GameSnapshot
+from tictactoe.storage import STORE_KEY, create_store
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for unfinished updates while draining.
+DRAIN_POLL_INTERVAL = 0.01
+# Seconds the outgoing queue gets at shutdown to send what is left.
+OUTBOUND_FLUSH_TIMEOUT = 5.0
+
+
+async def post_init(application: Application) -> None:
+    if SNAPSHOT_KEY in application.bot_data:
+        application.bot_data[SNAPSHOT_KEY].restore(
+            application.bot_data[STORE_KEY]
+        )
+    await application.bot_data[STORE_KEY].start()
+    await application.bot_data[RATINGS_KEY].start()
+    application.bot_data[AI_POOL_KEY].start()
+    if REPLAY_KEY in application.bot_data:
+        await application.bot_data[REPLAY_KEY].start()
+    if METRICS_SERVER_KEY in application.bot_data:
+        await application.bot_data[METRICS_SERVER_KEY].start()
+
+
+async def post_shutdown(application: Application) -> None:
+    if SNAPSHOT_KEY in application.bot_data:
+        application.bot_data[SNAPSHOT_KEY].save(
+            application.bot_data[STORE_KEY]
+        )
+    await application.bot_data[STORE_KEY].stop()
+    await application.bot_data[RATINGS_KEY].stop()
+    application.bot_data[AI_POOL_KEY].shutdown()
+    if REPLAY_KEY in application.bot_data:
+        await application.bot_data[REPLAY_KEY].stop()
+    if METRICS_SERVER_KEY in application.bot_data:
+        await application.bot_data[METRICS_SERVER_KEY].stop()
+
+
+def build_application(concurrency: int = 1) -> Application:
+    builder = Application.builder().token(TOKEN)
+    builder.concurrent_updates(ChatSerialUpdateProcessor(concurrency))
+    builder.post_init(post_init)
+    builder.post_shutdown(post_shutdown)
+    builder.request(InstrumentedRequest(connection_pool_size=256))
+    if TELEGRAM_API_URL:
+        builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+    application.bot_data[STORE_KEY] = create_store(
+        GAME_STORE, GAME_STORE_SHARDS, GAME_STORE_FLUSH_INTERVAL
+    )
+    application.bot_data[OUTBOUND_KEY] = OutboundQueue(
+        OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST
+    )
+    application.bot_data[AI_POOL_KEY] = AIPool(AI_WORKERS, AI_MAX_PENDING)
+    ratings = application.bot_data[RATINGS_KEY] = create_rating_table(
+        RATING_STORE, GAME_STORE_FLUSH_INTERVAL
+    )
+    matchmaker = application.bot_data[MATCHMAKER_KEY] = Matchmaker(
+        rating_of=ratings.rating_of
+    )
+    store = application.bot_data[STORE_KEY]
+    ACTIVE_GAMES.set_function(lambda: len(store))
+    MATCH_QUEUE.set_function(matchmaker.waiting)
+    cache = get_position_cache()
+    POSITION_CACHE_LOOKUPS.labels("hit").set_function(lambda: cache.hits)
+    POSITION_CACHE_LOOKUPS.labels("miss").set_function(lambda: cache.misses)
+    POSITION_CACHE_SIZE.set_function(lambda: len(cache))
+    book = get_book()
+    if book is not None:
+        BOOK_LOOKUPS.labels("hit").set_function(lambda: book.hits)
+        BOOK_LOOKUPS.labels("miss").set_function(lambda: book.misses)
+    if REPLAY_LOG:
+        application.bot_data[REPLAY_KEY] = ReplayLog(REPLAY_LOG,
+                                                     REPLAY_FSYNC_INTERVAL)
+    if METRICS_PORT:
+        application.bot_data[METRICS_SERVER_KEY] = MetricsServer(
+            METRICS_LISTEN, METRICS_PORT
+        )
+
+    if GAME_SNAPSHOT:
+        application.bot_data[SNAPSHOT_KEY] = GameSnapshot(GAME_SNAPSHOT)
+
+    # Games are found by their board message (see handlers.py), so no
+    # per-chat conversation state is kept.
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(
+        CallbackQueryHandler(mode_selection, pattern="^mode_.*$")
+    )
+    application.add_handler(CallbackQueryHandler(join, pattern="^join$"))
+    application.add_handler(
+        CallbackQueryHandler(game, pattern=GAME_CALLBACK_PATTERN)
+    )
+    application.add_handler(CommandHandler("join", join))
+    # Inline games keep their state in the callback data (see inline.py).
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(
+        CallbackQueryHandler(inline_game, pattern=INLINE_CALLBACK_PATTERN)
+    )
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("end", end))
+    application.add_handler(CommandHandler("queue", queue))
+    application.add_handler(CommandHandler("leave", leave))
+    application.add_handler(CommandHandler("tournament", tournament))
+    application.add_handler(CommandHandler("enter", enter))
+    application.add_handler(CommandHandler("begin", begin))
+    application.add_handler(CommandHandler("top", top))
+    application.add_handler(CommandHandler("rank", rank))
+
+    if GAME_TTL or MAX_GAMES:
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, idle games will not "
+                           "expire. Install python-telegram-bot[job-queue].")
+        else:
+            application.job_queue.run_repeating(
+                GameReaper(GAME_TTL, MAX_GAMES, GAME_EXPIRED_NOTICE),
+                interval=GAME_REAP_INTERVAL,
+                name="game_reaper",
+            )
+    return application
+
+
+async def drain_updates(application: Application, timeout: float) -> int:
+    """
+    Waits until every update received so far is handled. Updates still
+    running after `timeout` seconds are cancelled, and later ones dropped.
+
+    Parameters
+    ----------
+    application : Application
+        A running bot whose update source is already stopped.
+    timeout : float
+        Seconds to wait.
+
+    Returns
+    -------
+    int
+        Number of cancelled updates.
+    """
+    processor = application.update_processor
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while application.update_queue.qsize() or processor.in_flight:
+        if loop.time() >= deadline:
+            cancelled = processor.cancel()
+            logger.warning("Cancelled %d updates still running after %.1f s",
+                           cancelled, timeout)
+            return cancelled
+        await asyncio.sleep(DRAIN_POLL_INTERVAL)
+    return 0
+
+
+async def serve_application(application: Application,
+                            start_updates: Callable[[], Awaitable],
+                            stop_updates: Callable[[], Awaitable],
+                            drain_timeout: float) -> None:
+    """
+    Runs a bot until SIGTERM or SIGINT, then shuts it down gracefully:
+    stops receiving updates, lets the received ones finish within
+    `drain_timeout` seconds, flushes the outgoing queue while the bot can
+    still send and runs post_shutdown, which saves the game snapshot.
+
+    Parameters
+    ----------
+    application : Application
+        The bot, built with build_application().
+    start_updates, stop_updates : Callable[[], Awaitable]
+        Start and stop the update source, e.g. Updater.start_polling and
+        Updater.stop.
+    drain_timeout : float
+        Seconds the received updates get to finish.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await start_updates()
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Stopping: draining updates in flight")
+            await stop_updates()
+            await drain_updates(application, drain_timeout)
+            if OUTBOUND_KEY in application.bot_data:
+                await application.bot_data[OUTBOUND_KEY].flush(
+                    timeout=OUTBOUND_FLUSH_TIMEOUT
+                )
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
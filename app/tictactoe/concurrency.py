@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Hashable
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatLockManager:
+    """
+    Hands out one asyncio.Lock per chat.
+
+    A lock exists only while some coroutine holds it or waits for it and
+    is evicted as soon as the chat goes idle, so memory stays proportional
+    to the number of chats with updates in flight.
+    """
+
+    def __init__(self) -> None:
+        # key -> [lock, number of holders and waiters]
+        self._locks: dict[Hashable, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """
+        Holds the lock of a chat. Waiters acquire it in FIFO order.
+
+        Parameters
+        ----------
+        key : Hashable
+            Usually the chat id.
+        """
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+def serial_key(update: object) -> Hashable | None:
+    """
+    Returns the key whose updates are handled one by one: (chat id,
+    message id) of a button click, otherwise the chat id; None for
+    updates without a chat.
+    """
+    chat = getattr(update, "effective_chat", None)
+    if chat is None:
+        return None
+    query = getattr(update, "callback_query", None)
+    message = getattr(query, "message", None)
+    if message is not None:
+        return chat.id, message.message_id
+    return chat.id
+
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different games concurrently and updates of the
+    same game one by one, in the order they were received.
+
+    A button click belongs to the game of its message, (chat id, message
+    id); any other update, e.g. a command, to its chat. Clicks on one
+    board therefore never interleave, while the games of a busy group
+    and slow chats do not hold back the others. On shutdown, cancel()
+    aborts the updates that outlived the drain deadline.
+
+    Parameters
+    ----------
+    max_concurrent_updates : int
+        Maximum number of updates being handled at the same time.
+    max_pending_updates : int or None
+        Maximum number of accepted updates, running or waiting for their
+        chat. Defaults to 64 * max_concurrent_updates.
+    """
+
+    def __init__(self, max_concurrent_updates: int,
+                 max_pending_updates: int | None = None) -> None:
+        # The base class semaphore is taken before do_process_update(), so
+        # it only bounds pending updates. Updates waiting for a busy chat
+        # must not take the running slots of other chats.
+        super().__init__(max_pending_updates or 64 * max_concurrent_updates)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._tasks: set[asyncio.Task] = set()
+        self._cancelled = False
+        self.locks = ChatLockManager()
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of updates running or waiting for their chat.
+        """
+        return len(self._tasks)
+
+    def cancel(self) -> int:
+        """
+        Cancels the updates in flight and drops every later one.
+
+        Returns
+        -------
+        int
+            Number of cancelled updates.
+        """
+        self._cancelled = True
+        for task in self._tasks:
+            task.cancel()
+        return len(self._tasks)
+
+    async def do_process_update(self, update: object,
+                                coroutine: Awaitable[Any]) -> None:
+        if self._cancelled:
+            coroutine.close()
+            return
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._tasks.discard(task)
+
+    async def _process(self, update: object,
+                       coroutine: Awaitable[Any]) -> None:
+        key = serial_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        async with self.locks.hold(key):
+            async with self._running:
+                await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -3,10 +3,132 @@ import os
 os.environ["TOKEN"] = "ВАШ_ТОКЕН"
 TOKEN = os.getenv("TOKEN", "")
 
-SELECT_MODE, CONTINUE_GAME, FINISH_GAME = range(3)
+# Serving mode: "polling" or "webhook". Can be overridden with --mode.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Bot API server, e.g. a local stand-in for tests (see fake_telegram.py).
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Supervisor mode (--mode supervisor): bot processes behind the webhook and
+# the seconds a process gets to finish its updates when it is stopped.
+# "{worker}" in GAME_STORE and REPLAY_LOG is replaced by the process index.
+SUPERVISOR_WORKERS = int(os.getenv("SUPERVISOR_WORKERS",
+                                   str(os.cpu_count() or 1)))
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30"))
+# Number of updates processed at the same time. Clicks on one board and
+# commands of one chat are still handled one by one (see
+# concurrency.ChatSerialUpdateProcessor).
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Outgoing request limits (requests per second), see outbound.OutboundQueue.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+
+# Game state store: "memory", "sqlite:<path>" or "file:<path>".
+# With several shards "{shard}" in the path is replaced by the shard index.
+GAME_STORE = os.getenv("GAME_STORE", "memory")
+GAME_STORE_SHARDS = int(os.getenv("GAME_STORE_SHARDS", "1"))
+GAME_STORE_FLUSH_INTERVAL = float(os.getenv("GAME_STORE_FLUSH_INTERVAL", "1"))
 
 FREE_SPACE = "⬜️"
 CROSS = "❌"
 ZERO = "⭕️"
 
 DEFAULT_STATE = [[FREE_SPACE for _ in range(3)] for _ in range(3)]
+
+# Board variants offered in the main menu: name -> (size, k in a row).
+BOARD_VARIANTS = {
+    "3": (3, 3),
+    "7": (7, 4),
+    "15": (15, 5),
+}
+# Boards larger than this are shown through a scrollable window, since
+# Telegram allows at most 8 buttons in a row and 100 in a keyboard.
+GRID_VIEWPORT = 8
+
+# Board callbacks: "rc" on 3x3, "c<cell>" and "v<cell>" (scroll the window
+# to a cell) on larger boards, cells in base 36. Boards of games found by
+# /queue or a tournament prefix them with "L<match id in hex>:".
+GAME_CALLBACK_PATTERN = (
+    r"^(L[0-9a-f]+:)?(stop_game|[0-2][0-2]|c[0-9a-z]{1,2}|v[0-9a-z]{1,2})$"
+)
+MATCH_CALLBACK = "L"
+# Games found by /queue or a tournament are stored once, under
+# (LOBBY_CHAT, match id). The supervisor sends them, LOBBY_COMMANDS and
+# clicks on their boards to one worker, which also keeps the queue and
+# the tournaments.
+LOBBY_CHAT = 0
+LOBBY_COMMANDS = ("queue", "leave", "tournament", "enter", "begin")
+# Inline games (@bot in any chat) carry their whole state in the callback
+# data, "i" + base64url, signed with INLINE_SECRET (TOKEN if empty). Bot
+# processes serving the same inline games must share the secret.
+INLINE_CALLBACK_PATTERN = r"^i[0-9A-Za-z_-]{43}$"
+INLINE_SECRET = os.getenv("INLINE_SECRET", "")
+
+# Board keyboards cache: "lru" keeps the last KEYBOARD_CACHE_SIZE boards,
+# "full" prebuilds every reachable board on first use, "off" disables it.
+KEYBOARD_CACHE = os.getenv("KEYBOARD_CACHE", "lru")
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "1024"))
+
+# AI on boards larger than 3x3: "alphabeta", "mcts" or "heuristic" (one
+# ply, no search). A search stops after AI_TIME_LIMIT seconds or
+# AI_NODE_LIMIT nodes (0 means no node limit).
+AI_ENGINE = os.getenv("AI_ENGINE", "alphabeta")
+AI_TIME_LIMIT = float(os.getenv("AI_TIME_LIMIT", "0.5"))
+AI_NODE_LIMIT = int(os.getenv("AI_NODE_LIMIT", "0"))
+# AI moves of large-board positions remembered across games, up to
+# rotations and reflections (see position_cache.py); 0 disables it.
+POSITION_CACHE_SIZE = int(os.getenv("POSITION_CACHE_SIZE", "100000"))
+# Opening book and endgame tables of large boards built with
+# "python -m tictactoe.book" (see book.py); its moves are played without a
+# search. The file is memory-mapped, so all processes share one copy.
+# Empty disables it.
+AI_BOOK = os.getenv("AI_BOOK", "")
+
+# Worker processes computing large-board AI moves (0: a thread in the bot
+# process) and the number of searches in flight before moves fall back to
+# the one-ply heuristic.
+AI_WORKERS = int(os.getenv("AI_WORKERS", str(os.cpu_count() or 1)))
+AI_MAX_PENDING = int(os.getenv("AI_MAX_PENDING", "32"))
+
+# Prometheus-style metrics endpoint served on
+# http://METRICS_LISTEN:METRICS_PORT/metrics. Port 0 disables it.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Games idle for GAME_TTL seconds are expired, and at most MAX_GAMES games
+# are kept (least recently active ones are expired first); 0 disables
+# either limit. The check runs every GAME_REAP_INTERVAL seconds. With
+# GAME_EXPIRED_NOTICE=1 the board message of an expired game is edited to
+# say so.
+GAME_TTL = float(os.getenv("GAME_TTL", "3600"))
+MAX_GAMES = int(os.getenv("MAX_GAMES", "100000"))
+GAME_REAP_INTERVAL = float(os.getenv("GAME_REAP_INTERVAL", "60"))
+GAME_EXPIRED_NOTICE = os.getenv("GAME_EXPIRED_NOTICE", "1") == "1"
+
+# Matchmaking (/queue): waiting players are grouped by rating into buckets
+# of MATCH_BUCKET points and paired with the nearest bucket at most
+# MATCH_MAX_GAP points away. Players start with DEFAULT_RATING.
+DEFAULT_RATING = float(os.getenv("DEFAULT_RATING", "1200"))
+MATCH_BUCKET = int(os.getenv("MATCH_BUCKET", "50"))
+MATCH_MAX_GAP = float(os.getenv("MATCH_MAX_GAP", "300"))
+
+# Player ratings (/top, /rank): "memory" or "sqlite:<path>". Changed
+# ratings are written every GAME_STORE_FLUSH_INTERVAL seconds. A SQLite
+# file is shared by all processes of the supervisor (see ratings.py).
+RATING_STORE = os.getenv("RATING_STORE", "memory")
+
+# On SIGTERM, updates already received get SHUTDOWN_TIMEOUT seconds to be
+# handled, then live games are saved to GAME_SNAPSHOT and restored on the
+# next start (see snapshot.py). An empty path disables the snapshot;
+# "{worker}" is replaced by the process index.
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+GAME_SNAPSHOT = os.getenv("GAME_SNAPSHOT", "")
+
+# Append-only log of finished games (see replay.py); empty disables it.
+REPLAY_LOG = os.getenv("REPLAY_LOG", "")
+REPLAY_FSYNC_INTERVAL = float(os.getenv("REPLAY_FSYNC_INTERVAL", "1"))
@@ -1,144 +1,315 @@
+import logging
 import random
-from copy import deepcopy
-
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from tictactoe.board import Board, GridBoard
+from tictactoe.book import book_move
 from tictactoe.constants import (
-    FREE_SPACE,
-    DEFAULT_STATE
+    AI_ENGINE,
+    AI_NODE_LIMIT,
+    AI_TIME_LIMIT,
+    MATCH_CALLBACK
 )
+from tictactoe.position_cache import canonical, get_position_cache
+from tictactoe.search import get_engine, heuristic_move
+from tictactoe.solver import lookup
+
+logger = logging.getLogger(__name__)
+
+_BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def as_board(
+    board: Board | GridBoard | list[list[str]]
+) -> Board | GridBoard:
+    """
+    Adapts a legacy 3x3 matrix of emoji to a Board.
+
+    Parameters
+    ----------
+    board : Board, GridBoard or list[list[str]]
+        A board or a 3x3 matrix with CROSS / ZERO / FREE_SPACE.
+
+    Returns
+    -------
+    Board or GridBoard
+        The board itself or its converted copy.
+    """
+    if isinstance(board, list):
+        return Board.from_rows(board)
+    return board
 
 
-def get_default_state() -> list[list[str]]:
+def get_default_state() -> Board:
     """
     Returns the default state of the game board.
 
     Returns
     -------
-    list[list[str]]
-        A 3x3 matrix of FREE_SPACE.
+    Board
+        An empty 3x3 board.
+    """
+    return Board()
+
+
+def new_board(size: int = 3, k: int = 3) -> Board | GridBoard:
+    """
+    Returns an empty board of the given variant.
+
+    Parameters
+    ----------
+    size : int
+        Board side.
+    k : int
+        Number in a row needed to win.
+
+    Returns
+    -------
+    Board or GridBoard
+        Board for classic 3x3, GridBoard otherwise.
+    """
+    if (size, k) == (3, 3):
+        return Board()
+    return GridBoard(size, k)
+
+
+def cell_callback(index: int, size: int) -> str:
+    """
+    Encodes a cell for callback_data: "rc" on 3x3, "c<index in base 36>"
+    on larger boards.
+
+    Parameters
+    ----------
+    index : int
+        Cell index, row * size + col.
+    size : int
+        Board side.
+
+    Returns
+    -------
+    str
+        Callback data of the cell button.
     """
-    return deepcopy(DEFAULT_STATE)
+    if size == 3:
+        return "%d%d" % divmod(index, 3)
+    high, low = divmod(index, 36)
+    return "c" + (_BASE36[high] if high else "") + _BASE36[low]
 
 
-def check_win(board: list[list[str]]) -> str | None:
+def parse_cell(data: str, size: int) -> int:
+    """
+    Decodes callback data made by cell_callback().
+
+    Parameters
+    ----------
+    data : str
+        Callback data.
+    size : int
+        Board side.
+
+    Returns
+    -------
+    int
+        Cell index.
+
+    Raises
+    ------
+    ValueError
+        If the data does not describe a cell of the board.
+    """
+    if data[0] in "cv":
+        index = int(data[1:], 36)
+    else:
+        index = int(data[0]) * 3 + int(data[1])
+    if not 0 <= index < size * size:
+        raise ValueError(f"Cell out of board: {data}")
+    return index
+
+
+def match_callback(match_id: int, data: str) -> str:
+    """
+    Prefixes the callback data of a board button with the match of a
+    game found by /queue or a tournament.
+
+    Parameters
+    ----------
+    match_id : int
+        Id of the match.
+    data : str
+        Callback data of the button.
+
+    Returns
+    -------
+    str
+        "L<match id in hex>:<data>".
+    """
+    return f"{MATCH_CALLBACK}{match_id:x}:{data}"
+
+
+def parse_match(data: str) -> tuple[int | None, str]:
+    """
+    Splits callback data made by match_callback().
+
+    Parameters
+    ----------
+    data : str
+        Callback data.
+
+    Returns
+    -------
+    tuple[int | None, str]
+        The match id, None for boards of other games, and the callback
+        data of the button.
+    """
+    if not data.startswith(MATCH_CALLBACK):
+        return None, data
+    match_id, _, data = data[len(MATCH_CALLBACK):].partition(":")
+    return int(match_id, 16), data
+
+
+def check_win(board: Board | list[list[str]]) -> str | None:
     """
     Checks if there is a winner on the board.
 
     Parameters
     ----------
-    board : list[list[str]]
-        A 3x3 matrix with CROSS / ZERO / FREE_SPACE.
+    board : Board or list[list[str]]
+        A Board or a 3x3 matrix with CROSS / ZERO / FREE_SPACE.
 
     Returns
     -------
     str or None
         CROSS or ZERO if there's a winner, otherwise None.
     """
-    for r in range(3):
-        if board[r][0] == board[r][1] == board[r][2] != FREE_SPACE:
-            return board[r][0]
-    for c in range(3):
-        if board[0][c] == board[1][c] == board[2][c] != FREE_SPACE:
-            return board[0][c]
-    if board[0][0] == board[1][1] == board[2][2] != FREE_SPACE:
-        return board[0][0]
-    if board[0][2] == board[1][1] == board[2][0] != FREE_SPACE:
-        return board[0][2]
-    return None
+    return as_board(board).winner()
 
 
-def is_draw(board: list[list[str]]) -> bool:
+def is_draw(board: Board | list[list[str]]) -> bool:
     """
     Checks if the game ends without a winner.
 
     Parameters
     ----------
-    board : list[list[str]]
-        A 3x3 matrix with CROSS / ZERO / FREE_SPACE.
+    board : Board or list[list[str]]
+        A Board or a 3x3 matrix with CROSS / ZERO / FREE_SPACE.
 
     Returns
     -------
     bool
         True if nobody wins and there are no free cells, False otherwise.
     """
-    for row in board:
-        if FREE_SPACE in row:
-            return False
-    return True
+    return as_board(board).is_full()
 
 
-def find_best_move(board: list[list[str]]) -> tuple[int, int] | None:
+def search_move(size: int, k: int, x: int, o: int,
+                cached: bool = True) -> int | None:
     """
-    Finds the best move for the AI - just a random free cell.
+    Searches a large-board position with the configured engine. Positions
+    of the AI_BOOK opening book and endgame tables are played from it
+    without a search. Other moves are looked up in and added to the
+    position cache first, so a position or any of its symmetric copies is
+    searched only once.
 
     Parameters
     ----------
-    board : list[list[str]]
-        Current 3x3 board.
+    size, k : int
+        Board variant.
+    x, o : int
+        Masks of CROSS and ZERO.
+    cached : bool
+        Use the book and the position cache; False when the caller
+        checks them itself.
 
     Returns
     -------
-    tuple[int, int] or None
-        (row, col) of the chosen cell or None if no free cells.
+    int or None
+        Cell index or None if the board is full.
     """
-    free_cells = [
-        (r, c) for r in range(3) for c in range(3)
-        if board[r][c] == FREE_SPACE
-        ]
-    if not free_cells:
-        return None
-    return random.choice(free_cells)
+    if cached:
+        move = book_move(size, k, x, o)
+        if move is not None:
+            return move
+        cache = get_position_cache()
+        key, transform = canonical(size, k, x, o)
+        move = cache.get(key, transform)
+        if move is None:
+            move = search_move(size, k, x, o, cached=False)
+            cache.put(key, transform, move)
+        return move
+
+    if AI_ENGINE == "heuristic":
+        return heuristic_move(size, k, x, o)
+    result = get_engine(AI_ENGINE).search(size, k, x, o, AI_TIME_LIMIT,
+                                          AI_NODE_LIMIT)
+    logger.debug("%s search %dx%d: depth=%d nodes=%d nps=%.0f",
+                 AI_ENGINE, size, size, result.depth, result.nodes,
+                 result.nps)
+    return result.move
 
 
-def generate_keyboard(state: list[list[str]]) -> InlineKeyboardMarkup:
+def find_best_move(
+    board: Board | GridBoard | list[list[str]]
+) -> tuple[int, int] | None:
     """
-    Generates an inline keyboard for the gameboard.
+    Finds the best move for the side to move. On 3x3 it uses the
+    precomputed perfect-play table: ties between equally good moves are
+    broken randomly, positions that cannot occur in a legal game fall back
+    to a random free cell. Larger boards are searched by the AI_ENGINE
+    engine within the AI_TIME_LIMIT / AI_NODE_LIMIT budget. The search
+    blocks, so handlers call find_best_move_async() instead.
 
     Parameters
     ----------
-    state : list[list[str]]
-        3x3 board.
+    board : Board, GridBoard or list[list[str]]
+        Current board.
 
     Returns
     -------
-    InlineKeyboardMarkup
-        Inline keyboard with 3 rows of buttons and a stop button.
+    tuple[int, int] or None
+        (row, col) of the chosen cell or None if no free cells.
     """
-    keyboard = []
-    for row in range(3):
-        row_buttons = []
-        for col in range(3):
-            row_buttons.append(
-                InlineKeyboardButton(
-                    text=state[row][col],
-                    callback_data=f"{row}{col}"
-                )
-            )
-        keyboard.append(row_buttons)
+    board = as_board(board)
+    if (board.size, board.k) != (3, 3):
+        index = search_move(board.size, board.k, board.x, board.o)
+        return None if index is None else divmod(index, board.size)
 
-    stop_button = [
-        InlineKeyboardButton("Завершить игру", callback_data="stop_game")
-    ]
-    keyboard.append(stop_button)
-    return InlineKeyboardMarkup(keyboard)
+    solved = lookup(board.x, board.o)
+    if solved is not None and solved[1]:
+        moves = solved[1]
+    else:
+        moves = board.free_mask
+    if not moves:
+        return None
+
+    cells = [i for i in range(9) if moves >> i & 1]
+    cell = random.choice(cells)
+    return divmod(cell, 3)
 
 
-def main_menu_keyboard() -> InlineKeyboardMarkup:
+async def find_best_move_async(
+    board: Board | GridBoard | list[list[str]]
+) -> tuple[int, int] | None:
     """
-    Generates a main menu keyboard.
+    Same as find_best_move(), but searches large boards in a worker thread
+    so that the event loop keeps serving other chats meanwhile.
+
+    Parameters
+    ----------
+    board : Board, GridBoard or list[list[str]]
+        Current board.
 
     Returns
     -------
-    InlineKeyboardMarkup
-        Inline keyboard with mode selection.
-    """
-    buttons = [
-        [
-            InlineKeyboardButton("Одиночный режим (🤖)",
-                                 callback_data="mode_single"),
-            InlineKeyboardButton("Мультиплеер (👥)",
-                                 callback_data="mode_multi"),
-        ]
-    ]
-    return InlineKeyboardMarkup(buttons)
+    tuple[int, int] or None
+        (row, col) of the chosen cell or None if no free cells.
+    """
+    board = as_board(board)
+    if (board.size, board.k) == (3, 3):
+        return find_best_move(board)
+    # asyncio is imported here to keep the game logic quick to import for
+    # code that never runs an event loop (the simulator, AI workers).
+    import asyncio
+
+    # The thread gets plain masks, not the board the handler owns.
+    index = await asyncio.to_thread(search_move, board.size, board.k,
+                                   board.x, board.o)
+    return None if index is None else divmod(index, board.size)
@@ -1,37 +1,78 @@
+"""
+Handlers of the games started in a chat with /start.
+
+A chat may have any number of games at once. Each game is stored under
+its board message (see storage.GameKey), so a click finds its game by
+the message it was made on, and /join and /end find the games of a chat
+with GameStore.games_of(). Games found by /queue are stored once per
+match instead (see lobby.py).
+"""
 import logging
+from typing import Any
 
 from telegram import Update
 from telegram.constants import ChatType
-from telegram.ext import (
-    ContextTypes,
-    ConversationHandler
-)
+from telegram.ext import ContextTypes
 
 from tictactoe.constants import (
-    FREE_SPACE,
-    SELECT_MODE,
-    CONTINUE_GAME,
-    FINISH_GAME,
+    BOARD_VARIANTS,
     CROSS,
     ZERO
 )
 
 from tictactoe.game_logic import (
-    get_default_state,
+    new_board,
+    parse_cell,
+    parse_match,
     check_win,
-    is_draw,
-    find_best_move,
-    main_menu_keyboard,
-    generate_keyboard
+    is_draw
+)
+from tictactoe.keyboards import (
+    generate_keyboard,
+    join_keyboard,
+    main_menu_keyboard
+)
+from tictactoe.ai_pool import get_ai_pool
+from tictactoe.lobby import (
+    delete_game,
+    end_match,
+    find_game,
+    finish_match,
+    mirror_board,
+    resign,
+    save_game
+)
+from tictactoe.metrics import (
+    GAMES_FINISHED,
+    HANDLER_ERRORS,
+    MOVES,
+    instrument
+)
+from tictactoe.outbound import get_outbound
+from tictactoe.replay import (
+    DRAW,
+    outcome_of,
+    record_abort,
+    record_game
 )
+from tictactoe.storage import LEGACY_GAME_ID, GameKey, get_store
 
 logger = logging.getLogger(__name__)
 
 
+def _rules(board: Any) -> str:
+    if board.size == 3:
+        return ""
+    return f"Поле {board.size}×{board.size}, для победы нужно " \
+           f"{board.k} в ряд.\n"
+
+
+@instrument("start")
 async def start(update: Update,
-                context: ContextTypes.DEFAULT_TYPE) -> int:
+                context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    /start handler - start conversation, show mode menu.
+    /start handler - shows the mode menu. Every menu starts a new game,
+    other games of the chat go on.
 
     Parameters
     ----------
@@ -39,56 +80,53 @@ async def start(update: Update,
         The incoming update.
     context : CallbackContext
         The context object.
-
-    Returns
-    -------
-    int
-        The next state (SELECT_MODE).
     """
     try:
-        user_info = f"user={update.effective_user.id}"
-        chat_info = f"chat_id={update.effective_chat.id}"
-        logger.info(f"/start from {user_info}, {chat_info}")
+        logger.info("/start from user=%s, chat_id=%s",
+                    update.effective_user.id, update.effective_chat.id)
 
         if update.message is not None:
             await update.message.reply_text(
                 "Привет! Выберите режим игры:",
                 reply_markup=main_menu_keyboard()
             )
-        return SELECT_MODE
     except Exception as exc:
-        logger.warning(f"Ошибка в start(): {exc}")
+        HANDLER_ERRORS.labels("start").inc()
+        logger.warning("Ошибка в start(): %s", exc)
         if update.message:
             await update.message.reply_text("Ошибка при обработке /start.")
-        return ConversationHandler.END
 
 
+@instrument("mode_selection")
 async def mode_selection(update: Update,
-                         context: ContextTypes.DEFAULT_TYPE) -> int:
+                         context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     CallbackQuery for choosing the mode: single or multi.
 
+    A single-player game is stored under the board message sent in
+    reply. A multiplayer game turns the menu message into its invitation
+    and, once the second player joins, into its board, so it is stored
+    under the menu message.
+
     Parameters
     ----------
     update : Update
         The incoming update.
     context : CallbackContext
         The context object.
-
-    Returns
-    -------
-    int
-        The next state (CONTINUE_GAME).
     """
     query = update.callback_query
     if not query:
-        return ConversationHandler.END
+        return
     await query.answer()
 
     try:
-        chosen_mode = query.data
+        _, mode_name, *variant = query.data.split("_")
+        chosen_mode = f"mode_{mode_name}"
+        size, k = BOARD_VARIANTS[variant[0] if variant else "3"]
         chat_id = query.message.chat_id
-        logger.info(f"mode_selection: chosen={chosen_mode}, chat_id={chat_id}")
+        logger.info("mode_selection: chosen=%s, chat_id=%s",
+                    query.data, chat_id)
 
         if chosen_mode == "mode_multi":
             chat_type = update.effective_chat.type
@@ -97,18 +135,17 @@ async def mode_selection(update: Update,
                     "Мультиплеер невозможен в личном чате или канале!\n"
                     "Добавьте бота в группу, чтобы играть вдвоём."
                 )
-                return ConversationHandler.END
+                return
 
-        if "games" not in context.chat_data:
-            context.chat_data["games"] = {}
-
-        context.chat_data["games"][chat_id] = {
-            "board": get_default_state(),
+        game_data = {
+            "board": new_board(size, k),
             "current_player": CROSS,
             "players": [],
+            "moves": [],
             "mode": None
         }
-        game_data = context.chat_data["games"][chat_id]
+        store = get_store(context)
+        rules = _rules(game_data["board"])
 
         user_id = query.from_user.id
         user_name = (query.from_user.username
@@ -122,44 +159,65 @@ async def mode_selection(update: Update,
             text_single = (
                 f"Вы выбрали одиночный режим.\n"
                 f"Игрок: @{user_name} (❌) против ИИ (⭕️).\n"
+                f"{rules}"
                 "Игра начинается!"
             )
 
-            logger.info(f"Single mode started by {user_id} in chat={chat_id}")
+            logger.info("Single mode started by %s in chat=%s",
+                        user_id, chat_id)
             await query.message.edit_text(text_single)
 
             board = game_data["board"]
             markup = generate_keyboard(board)
             msg = f"Ходит {game_data['current_player']} (вы, @{user_name})."
-            await query.message.reply_text(msg, reply_markup=markup)
-            return CONTINUE_GAME
+            board_message = await query.message.reply_text(
+                msg, reply_markup=markup
+            )
+            store.put((chat_id, board_message.message_id), game_data)
+            return
 
         if chosen_mode == "mode_multi":
             game_data["mode"] = "multi"
             game_data["players"].append({"id": user_id, "name": user_name})
+            store.put((chat_id, query.message.message_id), game_data)
 
             text_multi = (
                 f"Вы выбрали мультиплеерный режим.\n"
-                f"Первый игрок: @{user_name}.\n\n"
-                "Попросите второго игрока в этом же групповом чате "
-                "ввести команду /join, чтобы присоединиться к партии.\n\n"
+                f"Первый игрок: @{user_name}.\n"
+                f"{rules}\n"
+                "Второй игрок может нажать «Присоединиться» или ввести "
+                "команду /join в этом же групповом чате.\n\n"
             )
-            logger.info(f"Multiplayer started by {user_id} in chat={chat_id}")
-            await query.message.edit_text(text_multi)
-            return CONTINUE_GAME
-
-        return ConversationHandler.END
+            logger.info("Multiplayer started by %s in chat=%s",
+                        user_id, chat_id)
+            await query.message.edit_text(text_multi,
+                                          reply_markup=join_keyboard())
 
     except Exception as exc:
-        logger.warning(f"Ошибка в mode_selection(): {exc}")
+        HANDLER_ERRORS.labels("mode_selection").inc()
+        logger.warning("Ошибка в mode_selection(): %s", exc)
         await query.message.reply_text("Произошла ошибка при выборе режима.")
-        return ConversationHandler.END
 
 
+def _open_game(store: Any, chat_id: int, user_id: int) -> GameKey | None:
+    # The oldest game of the chat waiting for a second player, other
+    # than the user's own.
+    for game_id in store.games_of(chat_id):
+        game_data = store.get((chat_id, game_id))
+        if game_data is not None and game_data["mode"] == "multi" \
+                and len(game_data["players"]) == 1 \
+                and game_data["players"][0]["id"] != user_id:
+            return chat_id, game_id
+    return None
+
+
+@instrument("join")
 async def join(update: Update,
-               context: ContextTypes.DEFAULT_TYPE) -> int:
+               context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    /join handler - second player wants to join the multiplayer game.
+    Join button and /join handler - the second player joins a
+    multiplayer game. /join joins the game of the message it replies
+    to, otherwise the oldest game of the chat waiting for a player.
 
     Parameters
     ----------
@@ -167,75 +225,119 @@ async def join(update: Update,
         The incoming update.
     context : CallbackContext
         The context object.
-
-    Returns
-    -------
-    int
-        The next state (CONTINUE_GAME).
     """
+    query = update.callback_query
+    outbound = get_outbound(context)
+    if query is not None:
+        await query.answer()
+
+    async def reply(text: str) -> None:
+        if query is not None:
+            outbound.notify(query.message, text)
+        else:
+            await update.message.reply_text(text)
+
     try:
         chat_id = update.effective_chat.id
-        logger.info(f"/join from {update.effective_user.id} in chat={chat_id}")
-
-        games = context.chat_data.get("games", {})
-        if chat_id not in games:
-            await update.message.reply_text(
-                "Нет активной игры. Сначала используйте /start (мультиплеер)."
+        user = update.effective_user
+        logger.info("join from %s in chat=%s", user.id, chat_id)
+
+        store = get_store(context)
+        if query is not None:
+            key = (chat_id, query.message.message_id)
+        elif update.message.reply_to_message is not None:
+            key = (chat_id, update.message.reply_to_message.message_id)
+        else:
+            key = _open_game(store, chat_id, user.id)
+        game_data = store.get(key) if key is not None else None
+        if game_data is None:
+            await reply(
+                "Нет игры, ожидающей игрока. Сначала используйте /start "
+                "(мультиплеер)."
             )
-            return ConversationHandler.END
+            return
 
-        game_data = games[chat_id]
         if game_data["mode"] != "multi":
-            warn_text = "Сейчас нет активной игры (или режим не мультиплеер)."
-            await update.message.reply_text(warn_text)
-            return ConversationHandler.END
+            await reply("Это не мультиплеерная игра.")
+            return
 
         if len(game_data["players"]) >= 2:
-            await update.message.reply_text("В игре уже есть два игрока.")
-            return FINISH_GAME
+            await reply("В игре уже есть два игрока.")
+            return
 
-        user_id = update.effective_user.id
-        user_name = (update.effective_user.username
-                     or update.effective_user.full_name
-                     or "Player2")
-
-        if len(game_data["players"]) == 1:
-            first_player_id = game_data["players"][0]["id"]
-            if user_id == first_player_id:
-                await update.message.reply_text(
-                    "Нельзя присоединиться к мультиплееру с тем же аккаунтом!"
-                )
-                return ConversationHandler.END
-
-        game_data["players"].append({"id": user_id, "name": user_name})
-        logger.info(f"Second player joined: user={user_id}, chat_id={chat_id}")
+        user_name = user.username or user.full_name or "Player2"
+        if user.id == game_data["players"][0]["id"]:
+            await reply(
+                "Нельзя присоединиться к мультиплееру с тем же аккаунтом!"
+            )
+            return
 
-        await update.message.reply_text(
-            f"Вы (@{user_name}) присоединились к игре!\n"
-            f"Игрок 1: @{game_data['players'][0]['name']}\n"
-            f"Игрок 2: @{user_name}\n\n"
-            "Игра начинается!"
-        )
+        game_data["players"].append({"id": user.id, "name": user_name})
+        store.put(key, game_data)
+        logger.info("Second player joined: user=%s, chat_id=%s",
+                    user.id, chat_id)
 
+        first_name = game_data["players"][0]["name"]
         board = game_data["board"]
-        markup = generate_keyboard(board)
-        msg = (
-            f"Ходит {game_data['current_player']} "
-            f"(игрок 1: @{game_data['players'][0]['name']})."
+        text = (
+            f"Игрок 1 (❌): @{first_name}\n"
+            f"Игрок 2 (⭕️): @{user_name}\n"
+            f"{_rules(board)}"
+            f"Ходит {game_data['current_player']} (игрок 1: @{first_name})."
         )
-        await update.message.reply_text(msg, reply_markup=markup)
-        return CONTINUE_GAME
+        markup = generate_keyboard(board)
+        if query is not None:
+            outbound.edit_text(query.message, text, markup)
+        else:
+            if key[1] == LEGACY_GAME_ID:
+                # Waiting since before games were kept under their board
+                # message: the game gets a board now.
+                board_message = await update.message.reply_text(
+                    text, reply_markup=markup
+                )
+                store.delete(key)
+                store.put((chat_id, board_message.message_id), game_data)
+            else:
+                await context.bot.edit_message_text(
+                    text, chat_id=chat_id, message_id=key[1],
+                    reply_markup=markup
+                )
+            await update.message.reply_text(
+                f"Вы (@{user_name}) присоединились к игре!"
+            )
 
     except Exception as exc:
-        logger.warning(f"Ошибка в join(): {exc}")
-        await update.message.reply_text("Произошла ошибка при /join.")
-        return ConversationHandler.END
+        HANDLER_ERRORS.labels("join").inc()
+        logger.warning("Ошибка в join(): %s", exc)
+        await reply("Произошла ошибка при /join.")
+
+
+async def _leave_match(context: ContextTypes.DEFAULT_TYPE,
+                       game_data: dict, key: GameKey, user_id: int) -> None:
+    # Leaving a game found by /queue or a tournament before its end loses
+    # it. A finished game stays on the opponent's board.
+    board = game_data["board"]
+    if board.winner() is None and not board.is_full():
+        outcome = resign(game_data, user_id)
+        record_game(context, game_data, outcome)
+        await end_match(context, game_data, key, outcome)
 
 
+async def _stop(context: ContextTypes.DEFAULT_TYPE, game_data: dict,
+                key: GameKey, user_id: int) -> None:
+    delete_game(get_store(context), key, game_data)
+    if game_data["mode"] == "lobby":
+        await _leave_match(context, game_data, key, user_id)
+    else:
+        record_abort(context, game_data)
+
+
+@instrument("game")
 async def game(update: Update,
-               context: ContextTypes.DEFAULT_TYPE) -> int:
+               context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    CallbackQuery handler for game moves (clicks on the board).
+    CallbackQuery handler for game moves (clicks on the board) and for
+    scrolling large boards. A finished game is removed from the store.
 
     Parameters
     ----------
@@ -243,66 +345,84 @@ async def game(update: Update,
         The incoming update.
     context : CallbackContext
         The context object.
-
-    Returns
-    -------
-    int
-        The next state (CONTINUE_GAME or FINISH_GAME).
     """
     query = update.callback_query
     if not query:
-        return ConversationHandler.END
+        return
     await query.answer()
+    outbound = get_outbound(context)
 
     try:
         chat_id = query.message.chat_id
-        games = context.chat_data.get("games", {})
-        game_data = games.get(chat_id)
+        key = (chat_id, query.message.message_id)
+        store = get_store(context)
+        match_id, data = parse_match(query.data)
+        game_data = find_game(store, key, match_id)
 
         if not game_data:
-            await query.message.reply_text("Нет игры. Используйте /start.")
-            return ConversationHandler.END
+            if data == "stop_game":
+                outbound.edit_text(query.message,
+                                   "Игра завершена. Введите /start.")
+            else:
+                outbound.notify(query.message,
+                                "Нет игры. Используйте /start.")
+            return
 
         board = game_data["board"]
+        size = board.size
         current_player = game_data["current_player"]
         players = game_data["players"]
         mode = game_data["mode"]
 
-        data = query.data
         if data == "stop_game":
-            logger.info(f"stop_game pressed in chat_id={chat_id}")
-            del games[chat_id]
-            await query.message.edit_text("Игра завершена. Введите /start.")
-            return ConversationHandler.END
-
-        row, col = int(data[0]), int(data[1])
-        if board[row][col] != FREE_SPACE:
-            await query.message.reply_text("Клетка занята. Выберите другую.")
-            return ConversationHandler.END
-
-        if mode == "multi" and len(players) == 2:
+            logger.info("stop_game pressed in chat_id=%s", chat_id)
+            outbound.edit_text(query.message,
+                               "Игра завершена. Введите /start.")
+            await _stop(context, game_data, key, query.from_user.id)
+            return
+
+        if data[0] == "v":
+            markup = generate_keyboard(board, focus=parse_cell(data, size),
+                                       match=match_id)
+            outbound.edit_text(query.message, query.message.text, markup)
+            return
+
+        cell = parse_cell(data, size)
+        if not board.is_free(cell):
+            outbound.notify(query.message, "Клетка занята. Выберите другую.")
+            return
+
+        if mode in ("multi", "lobby") and len(players) == 2:
             user_id = query.from_user.id
             cross_player_id = players[0]["id"]
             zero_player_id = players[1]["id"]
 
             if current_player == CROSS and user_id != cross_player_id:
-                await query.message.reply_text(
+                outbound.notify(
+                    query.message,
                     "Сейчас ходит ❌ (игрок 1). Дождитесь своей очереди."
                 )
-                return ConversationHandler.END
+                return
             if current_player == ZERO and user_id != zero_player_id:
-                await query.message.reply_text(
+                outbound.notify(
+                    query.message,
                     "Сейчас ходит ⭕️ (игрок 2). Дождитесь своей очереди."
                 )
-                return ConversationHandler.END
+                return
 
-        board[row][col] = current_player
+        board.place(cell, current_player)
+        game_data.setdefault("moves", []).append(cell)
+        save_game(store, key, game_data)
+        MOVES.labels("human").inc()
         winner = check_win(board)
         if winner:
-            logger.info(f"Game over: winner={winner} in chat_id={chat_id}")
-            markup = generate_keyboard(board)
+            record_game(context, game_data, outcome_of(winner))
+            GAMES_FINISHED.labels("win").inc()
+            logger.info("Game over: winner=%s in chat_id=%s",
+                        winner, chat_id)
+            markup = generate_keyboard(board, focus=cell, match=match_id)
 
-            if mode == "multi":
+            if mode != "single":
                 if winner == CROSS:
                     winner_name = "@" + players[0]["name"]
                 else:
@@ -313,87 +433,113 @@ async def game(update: Update,
                 else:
                     winner_name = "ИИ"
 
-            await query.message.edit_text(
-                text=f"Победил {winner} ({winner_name}). Игра окончена.",
-                reply_markup=markup
-            )
-            return FINISH_GAME
+            text = f"Победил {winner} ({winner_name}). Игра окончена."
+            outbound.edit_text(query.message, text=text, reply_markup=markup)
+            mirror_board(context, game_data, key, text, markup)
+            delete_game(store, key, game_data)
+            await finish_match(context, game_data, outcome_of(winner))
+            return
 
         if is_draw(board):
-            logger.info(f"Game over: draw in chat_id={chat_id}")
-            markup = generate_keyboard(board)
-            await query.message.edit_text(
-                text="Ничья! Игра окончена.",
-                reply_markup=markup
-            )
-            return FINISH_GAME
+            record_game(context, game_data, DRAW)
+            GAMES_FINISHED.labels("draw").inc()
+            logger.info("Game over: draw in chat_id=%s", chat_id)
+            markup = generate_keyboard(board, focus=cell, match=match_id)
+            text = "Ничья! Игра окончена."
+            outbound.edit_text(query.message, text=text, reply_markup=markup)
+            mirror_board(context, game_data, key, text, markup)
+            delete_game(store, key, game_data)
+            await finish_match(context, game_data, DRAW)
+            return
 
         next_player = ZERO if current_player == CROSS else CROSS
-        game_data["current_player"] = next_player
 
-        if mode == "multi" and len(players) == 2:
-            markup = generate_keyboard(board)
+        if mode in ("multi", "lobby") and len(players) == 2:
+            game_data["current_player"] = next_player
+            save_game(store, key, game_data)
+            markup = generate_keyboard(board, focus=cell, match=match_id)
             if next_player == CROSS:
                 name = "@" + players[0]["name"]
             else:
                 name = "@" + players[1]["name"]
 
-            await query.message.edit_text(
-                text=f"Сейчас ходит {next_player} ({name}).",
-                reply_markup=markup
-            )
-            return CONTINUE_GAME
+            text = f"Сейчас ходит {next_player} ({name})."
+            outbound.edit_text(query.message, text=text, reply_markup=markup)
+            mirror_board(context, game_data, key, text, markup)
+            return
 
         ai_symbol = next_player
-        human_symbol = CROSS if ai_symbol == ZERO else ZERO
-
-        best_move = find_best_move(board)
+        human_symbol = current_player
+
+        # The stored game keeps the human's symbol until the AI move is
+        # applied, so a failed or cancelled search leaves the human to
+        # move instead of placing the AI's symbol for them.
+        try:
+            best_move = await get_ai_pool(context).best_move(board)
+        finally:
+            game_data["current_player"] = human_symbol
+        if store.get(key) is not game_data:
+            # Ended with /end while the AI was thinking.
+            return
         if best_move is not None:
             r_ai, c_ai = best_move
-            board[r_ai][c_ai] = ai_symbol
+            cell = r_ai * size + c_ai
+            board.place(cell, ai_symbol)
+            game_data.setdefault("moves", []).append(cell)
+            save_game(store, key, game_data)
+            MOVES.labels("ai").inc()
 
         new_winner = check_win(board)
         if new_winner:
-            log = f"Game over: winner={new_winner} in chat_id={chat_id}"
-            logger.info(log)
-            markup = generate_keyboard(board)
+            record_game(context, game_data, outcome_of(new_winner))
+            GAMES_FINISHED.labels("win").inc()
+            logger.info("Game over: winner=%s in chat_id=%s",
+                        new_winner, chat_id)
+            markup = generate_keyboard(board, focus=cell)
             if new_winner == CROSS:
                 winner_name = f"игрок @{players[0]['name']}"
             else:
                 winner_name = "ИИ"
 
-            await query.message.edit_text(
+            outbound.edit_text(
+                query.message,
                 text=f"Победил {new_winner} ({winner_name}). Игра окончена.",
                 reply_markup=markup
             )
-            return FINISH_GAME
+            delete_game(store, key, game_data)
+            return
 
         if is_draw(board):
-            logger.info(f"Single game draw in chat_id={chat_id}")
-            markup = generate_keyboard(board)
-            await query.message.edit_text(
+            record_game(context, game_data, DRAW)
+            GAMES_FINISHED.labels("draw").inc()
+            logger.info("Single game draw in chat_id=%s", chat_id)
+            markup = generate_keyboard(board, focus=cell)
+            outbound.edit_text(
+                query.message,
                 text="Ничья! Игра окончена.",
                 reply_markup=markup
             )
-            return FINISH_GAME
+            delete_game(store, key, game_data)
+            return
 
-        game_data["current_player"] = human_symbol
-        markup = generate_keyboard(board)
-        await query.message.edit_text(
+        markup = generate_keyboard(board, focus=cell)
+        outbound.edit_text(
+            query.message,
             text=f"Ваш ход ({human_symbol}), @{players[0]['name']}.",
             reply_markup=markup
         )
-        return CONTINUE_GAME
 
     except Exception as exc:
-        logger.warning(f"Ошибка в game(): {exc}")
-        await query.message.reply_text("Произошла ошибка в ходе игры.")
-        return ConversationHandler.END
+        HANDLER_ERRORS.labels("game").inc()
+        logger.warning("Ошибка в game(): %s", exc)
+        outbound.notify(query.message, "Произошла ошибка в ходе игры.")
 
 
-async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@instrument("end")
+async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    /end handler - forcibly ends the current game.
+    /end handler - forcibly ends the game of the board message it
+    replies to, otherwise every game of the user in this chat.
 
     Parameters
     ----------
@@ -401,26 +547,46 @@ async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         The incoming update.
     context : CallbackContext
         The context object.
-
-    Returns
-    -------
-    int
-        The next state (ConversationHandler.END).
     """
     try:
         chat_id = update.effective_chat.id
-        games = context.chat_data.get("games", {})
-        if chat_id in games:
-            del games[chat_id]
+        user_id = update.effective_user.id
+        store = get_store(context)
+        reply_to = update.message and update.message.reply_to_message
+        if reply_to:
+            keys = [(chat_id, reply_to.message_id)]
+        else:
+            keys = [(chat_id, game_id)
+                    for game_id in store.games_of(chat_id)]
+
+        ended = 0
+        for key in keys:
+            game_data = store.get(key)
+            if game_data is None or not reply_to and user_id not in (
+                    player["id"] for player in game_data["players"]):
+                continue
+            await _stop(context, game_data, key, user_id)
+            get_outbound(context).submit(
+                chat_id,
+                lambda key=key: context.bot.edit_message_text(
+                    "Игра завершена. Введите /start.",
+                    chat_id=key[0], message_id=key[1]
+                ),
+                key=key,
+            )
+            ended += 1
 
         if update.message:
-            await update.message.reply_text("Игра сброшена. Введите /start.")
-        return ConversationHandler.END
+            await update.message.reply_text(
+                "Игра сброшена. Введите /start." if ended
+                else "У вас нет активных игр в этом чате. Введите /start."
+            )
     except Exception as exc:
-        logger.warning(f"Ошибка в end(): {exc}")
-        return ConversationHandler.END
+        HANDLER_ERRORS.labels("end").inc()
+        logger.warning("Ошибка в end(): %s", exc)
 
 
+@instrument("help_command")
 async def help_command(update: Update,
                        context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -440,8 +606,15 @@ async def help_command(update: Update,
         "Список команд:\n\n"
         "/start — начать игру (выбрать режим).\n"
         "/join — присоединиться к мультиплеерной игре (в группе).\n"
+        "@имя_бота в любом чате — сыграть прямо в нём.\n"
+        "/queue [7|15] — найти соперника по рейтингу (в личке).\n"
+        "/leave — отменить поиск, выйти из турнира или сдаться.\n"
+        "/top — лучшие игроки, /rank — ваш рейтинг.\n"
+        "/tournament [7|15] — открыть турнир в группе, "
+        "/enter — участвовать, /begin — начать.\n"
         "/help — показать справку.\n"
-        "/end — принудительно завершить игру.\n"
+        "/end — завершить ваши игры в чате; ответом на доску — "
+        "только эту игру.\n"
     )
     if update.message:
         await update.message.reply_text(text)
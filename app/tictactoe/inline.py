@@ -0,0 +1,318 @@
+"""
+Inline mode: 3x3 games started with @bot in any chat, with no state kept
+by the bot.
+
+The whole game travels in the callback data of its buttons: both 9-bit
+masks, the cell of the button, the mode and the player ids, followed by
+an HMAC tag, so clients cannot forge positions. Any bot process that
+knows the secret handles any click without a store, a conversation or
+a shared lookup.
+
+Without server state the old buttons of a message stay valid, so a
+click on a stale keyboard still counts. Positions after the first move
+are signed together with their inline message id, so they cannot be
+moved to another game.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import struct
+from typing import NamedTuple
+
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update
+)
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import ContextTypes
+
+from tictactoe.board import Board
+from tictactoe.constants import CROSS, INLINE_SECRET, TOKEN, ZERO
+from tictactoe.game_logic import check_win, find_best_move, is_draw
+from tictactoe.metrics import (
+    GAMES_FINISHED,
+    HANDLER_ERRORS,
+    MOVES,
+    instrument
+)
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_PREFIX = "i"
+# x | o << 9 | cell << 18 | ai << 22, cross id, zero id (0: none yet).
+PAYLOAD = struct.Struct("<IQQ")
+TAG_SIZE = 12
+# Cell value of the stop button.
+STOP = 15
+
+
+class InlineGame(NamedTuple):
+    x: int
+    o: int
+    cross: int
+    zero: int
+    ai: bool
+
+    @property
+    def board(self) -> Board:
+        return Board(self.x, self.o)
+
+    @property
+    def turn(self) -> str:
+        return CROSS if self.x.bit_count() == self.o.bit_count() else ZERO
+
+
+def _key() -> bytes:
+    return (INLINE_SECRET or TOKEN).encode()
+
+
+def _tag(body: bytes, game: InlineGame, message_id: str,
+         key: bytes) -> bytes:
+    # The first keyboard is built before its message has an id.
+    if not game.x | game.o:
+        message_id = ""
+    digest = hmac.new(key, body + message_id.encode(), hashlib.sha256)
+    return digest.digest()[:TAG_SIZE]
+
+
+def pack_callback(game: InlineGame, cell: int, message_id: str = "",
+                  key: bytes | None = None) -> str:
+    """
+    Packs a game and the cell of a button into signed callback data.
+
+    Parameters
+    ----------
+    game : InlineGame
+        Position and players.
+    cell : int
+        Cell index, row * 3 + col, or STOP.
+    message_id : str
+        Inline message id; empty for the first keyboard.
+    key : bytes or None
+        HMAC key; INLINE_SECRET, or TOKEN if it is not set, by default.
+
+    Returns
+    -------
+    str
+        "i" + base64url, 44 characters.
+    """
+    key = _key() if key is None else key
+    state = game.x | game.o << 9 | cell << 18 | game.ai << 22
+    body = PAYLOAD.pack(state, game.cross, game.zero)
+    raw = body + _tag(body, game, message_id, key)
+    return CALLBACK_PREFIX + base64.urlsafe_b64encode(raw).decode() \
+        .rstrip("=")
+
+
+def unpack_callback(data: str, message_id: str = "",
+                    key: bytes | None = None) -> tuple[InlineGame, int]:
+    """
+    Reads callback data made by pack_callback().
+
+    Parameters
+    ----------
+    data : str
+        The callback data.
+    message_id : str
+        Inline message id of the clicked message.
+    key : bytes or None
+        HMAC key, as for pack_callback().
+
+    Returns
+    -------
+    tuple[InlineGame, int]
+        The game and the cell of the button.
+
+    Raises
+    ------
+    ValueError
+        If the data is malformed or its signature does not match.
+    """
+    key = _key() if key is None else key
+    try:
+        raw = base64.urlsafe_b64decode(data[len(CALLBACK_PREFIX):] + "=")
+    except ValueError as exc:
+        raise ValueError("Malformed inline callback") from exc
+    if len(raw) != PAYLOAD.size + TAG_SIZE:
+        raise ValueError("Malformed inline callback")
+    body, tag = raw[:PAYLOAD.size], raw[PAYLOAD.size:]
+    state, cross, zero = PAYLOAD.unpack(body)
+    game = InlineGame(state & 0x1FF, state >> 9 & 0x1FF, cross, zero,
+                      bool(state >> 22 & 1))
+    if not hmac.compare_digest(tag, _tag(body, game, message_id, key)):
+        raise ValueError("Bad inline callback signature")
+    return game, state >> 18 & 0xF
+
+
+def _player(user_id: int, symbol: str) -> str:
+    return f'<a href="tg://user?id={user_id}">{symbol}</a>'
+
+
+def status_text(game: InlineGame) -> str:
+    """
+    Returns the message text of a game, with the players mentioned.
+    """
+    if game.ai:
+        lines = [f"Крестики-нолики: {_player(game.cross, CROSS)} против ИИ."]
+    else:
+        zero = _player(game.zero, ZERO) if game.zero else ZERO
+        lines = [f"Крестики-нолики: {_player(game.cross, CROSS)} против "
+                 f"{zero}."]
+    board = game.board
+    winner = check_win(board)
+    if winner:
+        lines.append(f"Победил {winner}. Игра окончена.")
+    elif is_draw(board):
+        lines.append("Ничья! Игра окончена.")
+    elif game.turn == ZERO and not game.ai and not game.zero:
+        lines.append(f"Ходит {ZERO}: первый, кто нажмёт на клетку, "
+                     "станет соперником.")
+    else:
+        player = game.cross if game.turn == CROSS else game.zero
+        lines.append(f"Ходит {_player(player, game.turn)}.")
+    return "\n".join(lines)
+
+
+def inline_keyboard(game: InlineGame,
+                    message_id: str = "") -> InlineKeyboardMarkup:
+    """
+    Builds the keyboard of a game. Every button carries the whole game,
+    so keyboards are never cached.
+    """
+    board = game.board
+    keyboard = [
+        [InlineKeyboardButton(board.cell(row * 3 + col),
+                              callback_data=pack_callback(
+                                  game, row * 3 + col, message_id))
+         for col in range(3)]
+        for row in range(3)
+    ]
+    if not check_win(board) and not is_draw(board):
+        keyboard.append([InlineKeyboardButton(
+            "Завершить игру",
+            callback_data=pack_callback(game, STOP, message_id)
+        )])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@instrument("inline_query")
+async def inline_query(update: Update,
+                       context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Inline query handler - offers a game against the AI and a game for
+    two in the chat the query was typed in.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    query = update.inline_query
+    results = []
+    for ai, title, description in (
+            (True, "Играть с ИИ", f"Вы {CROSS}, ИИ {ZERO}"),
+            (False, "Играть вдвоём",
+             f"Вы {CROSS}, соперник — первый, кто сделает ход {ZERO}")):
+        game = InlineGame(0, 0, query.from_user.id, 0, ai)
+        results.append(InlineQueryResultArticle(
+            id="ai" if ai else "duel",
+            title=title,
+            description=description,
+            input_message_content=InputTextMessageContent(
+                status_text(game), parse_mode=ParseMode.HTML
+            ),
+            reply_markup=inline_keyboard(game),
+        ))
+    # The keyboards hold the sender's id, so results are not shared.
+    await query.answer(results, cache_time=0, is_personal=True)
+
+
+def _move(game: InlineGame, cell: int,
+          user_id: int) -> tuple[InlineGame | None, str | None]:
+    # Returns the game after the move (and the AI reply), or a notice
+    # for the user if the click is not a valid move.
+    board = game.board
+    if check_win(board) or is_draw(board):
+        return None, "Игра окончена."
+    if cell > 8 or not board.is_free(cell):
+        return None, "Клетка занята. Выберите другую."
+
+    turn = game.turn
+    if turn == CROSS or game.ai:
+        if user_id != game.cross:
+            return None, f"Сейчас ходит {turn}."
+    elif not game.zero:
+        if user_id == game.cross:
+            return None, f"Ход {ZERO} делает соперник."
+        game = game._replace(zero=user_id)
+    elif user_id != game.zero:
+        return None, f"Сейчас ходит {turn}."
+
+    board.place(cell, turn)
+    MOVES.labels("human").inc()
+    if game.ai and not check_win(board) and not is_draw(board):
+        best_move = find_best_move(board)
+        if best_move is not None:
+            board.place(best_move[0] * 3 + best_move[1], ZERO)
+            MOVES.labels("ai").inc()
+    return game._replace(x=board.x, o=board.o), None
+
+
+@instrument("inline_game")
+async def inline_game(update: Update,
+                      context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    CallbackQuery handler for the buttons of inline games. The game is
+    read from the callback data and written back into the new keyboard.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    query = update.callback_query
+    message_id = query.inline_message_id or ""
+    try:
+        try:
+            game, cell = unpack_callback(query.data, message_id)
+        except ValueError as exc:
+            logger.warning("Rejected inline callback: %s", exc)
+            await query.answer("Эта кнопка недействительна.")
+            return
+
+        user_id = query.from_user.id
+        if cell == STOP:
+            if user_id not in (game.cross, game.zero):
+                await query.answer("Завершить игру может только её участник.")
+                return
+            await query.answer()
+            await query.edit_message_text("Игра завершена.")
+            return
+
+        game, notice = _move(game, cell, user_id)
+        await query.answer(notice)
+        if game is None:
+            return
+        board = game.board
+        winner = check_win(board)
+        if winner or is_draw(board):
+            GAMES_FINISHED.labels("win" if winner else "draw").inc()
+        await query.edit_message_text(
+            status_text(game), parse_mode=ParseMode.HTML,
+            reply_markup=inline_keyboard(game, message_id)
+        )
+    except Exception as exc:
+        # Two clicks on the same stale keyboard make the same edit.
+        if isinstance(exc, BadRequest) and "not modified" in str(exc):
+            return
+        HANDLER_ERRORS.labels("inline_game").inc()
+        logger.warning("Ошибка в inline_game(): %s", exc)
@@ -0,0 +1,222 @@
+"""
+Telegram keyboards of the game: the board and the main menu.
+
+This is the only module of the game that builds Telegram objects, so the
+board, the win checks and the AI can be imported without telegram.
+"""
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from tictactoe.board import Board, GridBoard
+from tictactoe.constants import (
+    KEYBOARD_CACHE,
+    KEYBOARD_CACHE_SIZE,
+    GRID_VIEWPORT
+)
+from tictactoe.game_logic import as_board, cell_callback, match_callback
+from tictactoe.solver import encode, reachable_positions
+
+# Markups are immutable, so the same object is safely shared by every game
+# that shows the same position.
+_keyboard_cache: OrderedDict[int, InlineKeyboardMarkup] = OrderedDict()
+_keyboard_stats = {"hits": 0, "misses": 0}
+
+
+def _build_keyboard(state: Board) -> InlineKeyboardMarkup:
+    keyboard = []
+    for row in range(3):
+        row_buttons = []
+        for col in range(3):
+            row_buttons.append(
+                InlineKeyboardButton(
+                    text=state.cell(row * 3 + col),
+                    callback_data=f"{row}{col}"
+                )
+            )
+        keyboard.append(row_buttons)
+
+    stop_button = [
+        InlineKeyboardButton("Завершить игру", callback_data="stop_game")
+    ]
+    keyboard.append(stop_button)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _build_grid_keyboard(state: GridBoard,
+                         focus: int | None) -> InlineKeyboardMarkup:
+    size = state.size
+    view = min(size, GRID_VIEWPORT)
+    if focus is None:
+        focus = (size // 2) * size + size // 2
+    focus_row, focus_col = divmod(focus, size)
+    top = min(max(focus_row - view // 2, 0), size - view)
+    left = min(max(focus_col - view // 2, 0), size - view)
+
+    keyboard = []
+    for row in range(top, top + view):
+        keyboard.append([
+            InlineKeyboardButton(
+                text=state.cell(row * size + col),
+                callback_data=cell_callback(row * size + col, size)
+            )
+            for col in range(left, left + view)
+        ])
+
+    if view < size:
+        # Each arrow scrolls the window by half its size.
+        step = view // 2
+        nav_buttons = []
+        for label, dr, dc in (("⬅️", 0, -1), ("⬆️", -1, 0),
+                              ("⬇️", 1, 0), ("➡️", 0, 1)):
+            new_top = min(max(top + dr * step, 0), size - view)
+            new_left = min(max(left + dc * step, 0), size - view)
+            if (new_top, new_left) == (top, left):
+                continue
+            center = ((new_top + view // 2) * size + new_left + view // 2)
+            nav_buttons.append(InlineKeyboardButton(
+                label, callback_data="v" + cell_callback(center, size)[1:]
+            ))
+        keyboard.append(nav_buttons)
+
+    keyboard.append([
+        InlineKeyboardButton("Завершить игру", callback_data="stop_game")
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _prebuild_keyboards() -> None:
+    for x_mask, o_mask in reachable_positions():
+        _keyboard_cache[encode(x_mask, o_mask)] = _build_keyboard(
+            Board(x_mask, o_mask)
+        )
+
+
+def generate_keyboard(state: Board | GridBoard | list[list[str]],
+                      focus: int | None = None,
+                      match: int | None = None) -> InlineKeyboardMarkup:
+    """
+    Returns an inline keyboard for the gameboard. 3x3 keyboards are taken
+    from the cache configured by KEYBOARD_CACHE when possible. Boards larger
+    than GRID_VIEWPORT show a window around `focus` with scroll buttons.
+
+    Parameters
+    ----------
+    state : Board, GridBoard or list[list[str]]
+        Current board.
+    focus : int or None
+        Cell to keep visible on large boards, the center by default.
+    match : int or None
+        Match of a game found by /queue or a tournament; its buttons
+        carry the match id (see game_logic.match_callback()).
+
+    Returns
+    -------
+    InlineKeyboardMarkup
+        Inline keyboard with the board rows and a stop button.
+    """
+    if match is not None:
+        markup = generate_keyboard(state, focus)
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(
+                button.text,
+                callback_data=match_callback(match, button.callback_data)
+            ) for button in row]
+            for row in markup.inline_keyboard
+        ])
+    state = as_board(state)
+    if state.size != 3:
+        return _build_grid_keyboard(state, focus)
+    if KEYBOARD_CACHE == "off":
+        return _build_keyboard(state)
+    if KEYBOARD_CACHE == "full" and not _keyboard_cache:
+        _prebuild_keyboards()
+
+    key = encode(state.x, state.o)
+    markup = _keyboard_cache.get(key)
+    if markup is not None:
+        _keyboard_stats["hits"] += 1
+        if KEYBOARD_CACHE == "lru":
+            _keyboard_cache.move_to_end(key)
+        return markup
+
+    _keyboard_stats["misses"] += 1
+    markup = _build_keyboard(state)
+    if KEYBOARD_CACHE == "lru":
+        _keyboard_cache[key] = markup
+        if len(_keyboard_cache) > KEYBOARD_CACHE_SIZE:
+            _keyboard_cache.popitem(last=False)
+    return markup
+
+
+def keyboard_cache_stats() -> dict[str, int | float | str]:
+    """
+    Returns usage statistics of the board keyboards cache.
+
+    Returns
+    -------
+    dict[str, int | float | str]
+        Cache mode, number of cached markups, hits, misses and hit rate.
+    """
+    hits = _keyboard_stats["hits"]
+    misses = _keyboard_stats["misses"]
+    total = hits + misses
+    return {
+        "mode": KEYBOARD_CACHE,
+        "size": len(_keyboard_cache),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
+
+
+_MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Одиночный режим (🤖)",
+                             callback_data="mode_single"),
+        InlineKeyboardButton("Мультиплеер (👥)",
+                             callback_data="mode_multi"),
+    ],
+    [
+        InlineKeyboardButton("7×7, 4 в ряд (🤖)",
+                             callback_data="mode_single_7"),
+        InlineKeyboardButton("7×7, 4 в ряд (👥)",
+                             callback_data="mode_multi_7"),
+    ],
+    [
+        InlineKeyboardButton("Гомоку 15×15 (🤖)",
+                             callback_data="mode_single_15"),
+        InlineKeyboardButton("Гомоку 15×15 (👥)",
+                             callback_data="mode_multi_15"),
+    ],
+])
+
+
+def main_menu_keyboard() -> InlineKeyboardMarkup:
+    """
+    Returns the main menu keyboard. It never changes, so it is built once.
+
+    Returns
+    -------
+    InlineKeyboardMarkup
+        Inline keyboard with mode selection.
+    """
+    return _MAIN_MENU_KEYBOARD
+
+
+_JOIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Присоединиться", callback_data="join")],
+])
+
+
+def join_keyboard() -> InlineKeyboardMarkup:
+    """
+    Returns the keyboard of a multiplayer game waiting for its second
+    player.
+
+    Returns
+    -------
+    InlineKeyboardMarkup
+        Inline keyboard with the join button.
+    """
+    return _JOIN_KEYBOARD
@@ -0,0 +1,634 @@
+"""
+Cross-chat play: the rating queue (/queue, /leave), Swiss tournaments of
+group chats (/tournament, /enter, /begin) and the leaderboard (/top,
+/rank).
+
+A game found here is played in the private chats of its two players.
+The game data is stored once, under (LOBBY_CHAT, match id), and the
+buttons of both boards carry the match id, so moves go through
+handlers.game like in any other game. Under the supervisor, the commands
+of this module and the clicks on these boards all go to one worker (see
+supervisor.worker_of()): the queue and the tournaments live in its
+memory.
+"""
+import logging
+from typing import Any
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.constants import ChatType
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes
+
+from tictactoe.constants import BOARD_VARIANTS, CROSS, LOBBY_CHAT, ZERO
+from tictactoe.game_logic import new_board
+from tictactoe.keyboards import generate_keyboard
+from tictactoe.matchmaking import (
+    MATCHMAKER_KEY,
+    Matchmaker,
+    Tournament,
+    new_waiting
+)
+from tictactoe.metrics import HANDLER_ERRORS, instrument
+from tictactoe.outbound import get_outbound
+from tictactoe.ratings import get_ratings, rate_game
+from tictactoe.replay import ABORTED, CROSS_WIN, ZERO_WIN, record_game
+from tictactoe.storage import GameKey, get_store
+
+logger = logging.getLogger(__name__)
+
+
+def get_matchmaker(context: Any) -> Matchmaker:
+    """
+    Returns the matchmaker of the application, creating one if none was
+    configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+
+    Returns
+    -------
+    Matchmaker
+        The matchmaker.
+    """
+    matchmaker = context.bot_data.get(MATCHMAKER_KEY)
+    if matchmaker is None:
+        matchmaker = context.bot_data[MATCHMAKER_KEY] = Matchmaker()
+    return matchmaker
+
+
+def game_keys(game_data: dict[str, Any], key: GameKey) -> list[GameKey]:
+    """
+    Returns the board messages that show a game: one in each player's
+    private chat for a game found here, otherwise `key` alone.
+    """
+    boards = game_data.get("boards")
+    return [(chat, message_id) for chat, message_id in boards] \
+        if boards else [key]
+
+
+def store_key(game_data: dict[str, Any], key: GameKey) -> GameKey:
+    """
+    Returns the key a game is stored under: (LOBBY_CHAT, match id) for a
+    game found here, otherwise its board message `key`.
+    """
+    match_id = game_data.get("match")
+    return key if match_id is None else (LOBBY_CHAT, match_id)
+
+
+def find_game(store: Any, key: GameKey,
+              match_id: int | None) -> dict[str, Any] | None:
+    """
+    Returns the game shown by the board message `key`, or None.
+
+    Parameters
+    ----------
+    store : GameStore
+        The game store.
+    key : GameKey
+        Board message.
+    match_id : int or None
+        Match named by the callback data of the board, see
+        game_logic.parse_match().
+
+    Returns
+    -------
+    dict[str, Any] or None
+        The game; None if there is none or the board is not one of its
+        boards.
+    """
+    if match_id is None:
+        return store.get(key)
+    game_data = store.get((LOBBY_CHAT, match_id))
+    if game_data is None or list(key) not in game_data["boards"]:
+        return None
+    return game_data
+
+
+def save_game(store: Any, key: GameKey, game_data: dict[str, Any]) -> None:
+    """
+    Puts a game shown on the board message `key` into the store.
+    """
+    store.put(store_key(game_data, key), game_data)
+
+
+def delete_game(store: Any, key: GameKey,
+                game_data: dict[str, Any]) -> None:
+    """
+    Removes a game shown on the board message `key` from the store.
+    """
+    store.delete(store_key(game_data, key))
+
+
+def mirror_board(context: Any, game_data: dict[str, Any], key: GameKey,
+                 text: str, reply_markup: InlineKeyboardMarkup | None) -> None:
+    """
+    Queues the edit already made to the board message `key` for the
+    other board messages of a game.
+    """
+    outbound = get_outbound(context)
+    for chat, message_id in game_data.get("boards", ()):
+        if (chat, message_id) != key:
+            outbound.submit(
+                chat,
+                _edit(context.bot, chat, message_id, text, reply_markup),
+                key=(chat, message_id),
+            )
+
+
+def _edit(bot: Any, chat_id: int, message_id: int, text: str,
+          reply_markup: InlineKeyboardMarkup | None) -> Any:
+    return lambda: bot.edit_message_text(text, chat_id=chat_id,
+                                         message_id=message_id,
+                                         reply_markup=reply_markup)
+
+
+def _name(user: Any) -> str:
+    return user.username or user.full_name or "Player"
+
+
+async def start_match(context: Any, players: list[dict[str, Any]],
+                      variant: str, tournament: int | None = None) -> None:
+    """
+    Sends the board of a new game to the private chats of two players.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    players : list[dict[str, Any]]
+        {"id", "name", "chat_id"} of CROSS and ZERO.
+    variant : str
+        Key of BOARD_VARIANTS.
+    tournament : int or None
+        Chat id of the tournament the game belongs to.
+
+    Raises
+    ------
+    TelegramError
+        If a board could not be sent, e.g. a player has never started
+        the bot. The match is then closed and nothing is stored. Other
+        games of the players' chats go on.
+    """
+    matchmaker = get_matchmaker(context)
+    store = get_store(context)
+    size, k = BOARD_VARIANTS[variant]
+    match_id = matchmaker.open_match((players[0]["id"], players[1]["id"]),
+                                     tournament)
+    game_data = {
+        "board": new_board(size, k),
+        "current_player": CROSS,
+        "players": players,
+        "moves": [],
+        "mode": "lobby",
+        "match": match_id,
+        "boards": [],
+    }
+    rules = f"Поле {size}×{size}, {k} в ряд.\n" if size != 3 else ""
+    markup = generate_keyboard(game_data["board"], match=match_id)
+    try:
+        for player, symbol, opponent in ((players[0], CROSS, players[1]),
+                                         (players[1], ZERO, players[0])):
+            message = await context.bot.send_message(
+                player["chat_id"],
+                f"Соперник: @{opponent['name']}. Вы играете {symbol}.\n"
+                f"{rules}Ходит {CROSS} (@{players[0]['name']}).",
+                reply_markup=markup,
+            )
+            game_data["boards"].append([player["chat_id"],
+                                        message.message_id])
+    except TelegramError:
+        matchmaker.close_match(match_id)
+        raise
+
+    store.put((LOBBY_CHAT, match_id), game_data)
+    logger.info("Match %d started: %s vs %s", match_id,
+                players[0]["id"], players[1]["id"])
+
+
+async def finish_match(context: Any, game_data: dict[str, Any],
+                       outcome: int) -> None:
+    """
+    Rates a finished game between two players. For a game found here it
+    also releases the players and, in a tournament, records the result
+    and starts the next round once every game of the round is over.
+    Calling it again for the same game does nothing.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    game_data : dict[str, Any]
+        The game.
+    outcome : int
+        CROSS_WIN, ZERO_WIN, DRAW or ABORTED.
+    """
+    rate_game(context, game_data, outcome)
+    matchmaker = get_matchmaker(context)
+    match = matchmaker.close_match(game_data.get("match"))
+    if match is None or match.tournament is None:
+        return
+    tournament = matchmaker.tournaments.get(match.tournament)
+    if tournament is not None and tournament.report(*match.players,
+                                                    outcome):
+        await next_round(context, tournament)
+
+
+def resign(game_data: dict[str, Any], user_id: int) -> int:
+    """
+    Returns the outcome of a game found here that `user_id` leaves before
+    its end: a win of the opponent, or ABORTED for anyone else.
+    """
+    players = [player["id"] for player in game_data["players"]]
+    if user_id not in players:
+        return ABORTED
+    return ZERO_WIN if players.index(user_id) == 0 else CROSS_WIN
+
+
+async def end_match(context: Any, game_data: dict[str, Any], key: GameKey,
+                    outcome: int) -> None:
+    """
+    Ends a game found here before its end: deletes it from the store,
+    tells the other chat and finishes the match.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    game_data : dict[str, Any]
+        The game.
+    key : GameKey
+        Board message the game was ended from; the caller edits it.
+    outcome : int
+        Result of the game, see resign().
+    """
+    delete_game(get_store(context), key, game_data)
+    text = "Соперник покинул игру. Введите /queue, чтобы сыграть ещё."
+    if outcome == ABORTED:
+        text = "Игра прервана. Введите /queue, чтобы сыграть ещё."
+    mirror_board(context, game_data, key, text, None)
+    await finish_match(context, game_data, outcome)
+
+
+async def next_round(context: Any, tournament: Tournament) -> None:
+    """
+    Announces the final standings of a finished tournament or pairs and
+    starts its next round.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    tournament : Tournament
+        A tournament with no games in progress.
+    """
+    matchmaker = get_matchmaker(context)
+    while not tournament.finished:
+        pairs, bye = tournament.pair_round()
+        lines = [f"Тур {tournament.round} из {tournament.rounds}:"]
+        lines += [f"❌ @{cross.name} — ⭕️ @{zero.name}"
+                  for cross, zero in pairs]
+        if bye is not None:
+            lines.append(f"@{bye.name} пропускает тур (+1 очко).")
+        await context.bot.send_message(tournament.chat_id, "\n".join(lines))
+
+        for cross, zero in pairs:
+            players = [{"id": p.user_id, "name": p.name, "chat_id": p.user_id}
+                       for p in (cross, zero)]
+            try:
+                await start_match(context, players, tournament.variant,
+                                  tournament.chat_id)
+            except TelegramError as exc:
+                # A player who never opened a private chat with the bot
+                # cannot get a board; both are scored as an aborted game.
+                logger.warning("Tournament game not started: %s", exc)
+                await context.bot.send_message(
+                    tournament.chat_id,
+                    f"Не удалось начать партию @{cross.name} — "
+                    f"@{zero.name}: оба игрока должны написать боту /start "
+                    "в личных сообщениях."
+                )
+                tournament.report(cross.user_id, zero.user_id, ABORTED)
+        if tournament.pending:
+            return
+
+    matchmaker.close_tournament(tournament.chat_id)
+    lines = ["Турнир окончен! Итоги:"]
+    lines += [f"{place}. @{player.name} — {player.score:g}"
+              for place, player in enumerate(tournament.standings(), 1)]
+    await context.bot.send_message(tournament.chat_id, "\n".join(lines))
+
+
+def _variant(context: Any) -> str | None:
+    variant = context.args[0] if context.args else "3"
+    return variant if variant in BOARD_VARIANTS else None
+
+
+@instrument("queue")
+async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /queue [3|7|15] handler - finds an opponent of a close rating or
+    waits for one.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        if update.effective_chat.type != ChatType.PRIVATE:
+            await update.message.reply_text(
+                "Поиск соперника доступен в личных сообщениях с ботом."
+            )
+            return
+        variant = _variant(context)
+        if variant is None:
+            await update.message.reply_text(
+                "Укажите поле: /queue, /queue 7 или /queue 15."
+            )
+            return
+
+        user = update.effective_user
+        chat_id = update.effective_chat.id
+        matchmaker = get_matchmaker(context)
+        if matchmaker.queued(user.id) is not None:
+            await update.message.reply_text(
+                "Вы уже ищете соперника. /leave — отменить поиск."
+            )
+            return
+        if (matchmaker.match_of(user.id) is not None
+                or matchmaker.tournament_of(user.id) is not None):
+            await update.message.reply_text(
+                "Сначала завершите текущую игру (/leave) или турнир."
+            )
+            return
+
+        rating = matchmaker.rating_of(user.id)
+        player = new_waiting(user.id, rating, chat_id, _name(user))
+        opponent = matchmaker.enqueue(player, variant)
+        if opponent is None:
+            await update.message.reply_text(
+                f"Ищем соперника (рейтинг {rating:.0f})... "
+                "/leave — отменить поиск."
+            )
+            return
+
+        # The player who waited longer moves first.
+        players = [{"id": p.user_id, "name": p.name, "chat_id": p.chat_id}
+                   for p in (opponent, player)]
+        try:
+            await start_match(context, players, variant)
+        except TelegramError as exc:
+            logger.warning("Match not started: %s", exc)
+            await update.message.reply_text(
+                "Не удалось начать игру с найденным соперником. "
+                "Попробуйте /queue ещё раз."
+            )
+    except Exception as exc:
+        HANDLER_ERRORS.labels("queue").inc()
+        logger.warning("Ошибка в queue(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /queue.")
+
+
+@instrument("leave")
+async def leave(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /leave handler - stops waiting for an opponent, withdraws from a
+    tournament that has not started yet or resigns the game found here.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        user_id = update.effective_user.id
+        matchmaker = get_matchmaker(context)
+        if matchmaker.leave(user_id):
+            await update.message.reply_text("Поиск соперника отменён.")
+            return
+        left = matchmaker.withdraw(user_id)
+        if left is not None:
+            await update.message.reply_text(
+                f"Вы вышли из турнира. Участников: {len(left.players)}."
+            )
+            return
+        match_id = matchmaker.match_of(user_id)
+        game_data = None
+        if match_id is not None:
+            game_data = get_store(context).get((LOBBY_CHAT, match_id))
+        if game_data is None:
+            await update.message.reply_text(
+                "Вы не ищете соперника, не записаны в турнир и не играете."
+            )
+            return
+
+        players = [player["id"] for player in game_data["players"]]
+        chat, message_id = game_data["boards"][players.index(user_id)]
+        outcome = resign(game_data, user_id)
+        record_game(context, game_data, outcome)
+        await end_match(context, game_data, (chat, message_id), outcome)
+        get_outbound(context).submit(
+            chat,
+            _edit(context.bot, chat, message_id,
+                  "Вы покинули игру. Введите /queue, чтобы сыграть ещё.",
+                  None),
+            key=(chat, message_id),
+        )
+        await update.message.reply_text("Вы сдали партию.")
+    except Exception as exc:
+        HANDLER_ERRORS.labels("leave").inc()
+        logger.warning("Ошибка в leave(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /leave.")
+
+
+@instrument("tournament")
+async def tournament(update: Update,
+                     context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /tournament [3|7|15] handler - opens registration for a tournament of
+    the group; the organizer takes part too.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        chat = update.effective_chat
+        if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+            await update.message.reply_text(
+                "Турнир можно провести только в групповом чате."
+            )
+            return
+        variant = _variant(context)
+        if variant is None:
+            await update.message.reply_text(
+                "Укажите поле: /tournament, /tournament 7 или /tournament 15."
+            )
+            return
+        matchmaker = get_matchmaker(context)
+        if chat.id in matchmaker.tournaments:
+            await update.message.reply_text("В этом чате уже идёт турнир.")
+            return
+
+        user = update.effective_user
+        matchmaker.open_tournament(Tournament(chat.id, variant, user.id))
+        matchmaker.enter(matchmaker.tournaments[chat.id], user.id, _name(user))
+        size, k = BOARD_VARIANTS[variant]
+        await update.message.reply_text(
+            f"Открыта регистрация на турнир (поле {size}×{size}, {k} в ряд).\n"
+            "/enter — участвовать, /leave — выйти, "
+            "/begin — начать (организатор).\n"
+            "Партии играются в личных сообщениях с ботом, поэтому каждому "
+            "участнику нужно написать боту /start."
+        )
+    except Exception as exc:
+        HANDLER_ERRORS.labels("tournament").inc()
+        logger.warning("Ошибка в tournament(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /tournament.")
+
+
+@instrument("enter")
+async def enter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /enter handler - registers for the tournament of the group.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        matchmaker = get_matchmaker(context)
+        current = matchmaker.tournaments.get(update.effective_chat.id)
+        if current is None or current.started:
+            await update.message.reply_text(
+                "Нет открытой регистрации. /tournament — открыть."
+            )
+            return
+        user = update.effective_user
+        if matchmaker.queued(user.id) is not None \
+                or matchmaker.match_of(user.id) is not None \
+                or not matchmaker.enter(current, user.id, _name(user)):
+            await update.message.reply_text(
+                "Вы уже участвуете в турнире, играете или ищете соперника."
+            )
+            return
+        await update.message.reply_text(
+            f"@{_name(user)} в турнире. Участников: {len(current.players)}."
+        )
+    except Exception as exc:
+        HANDLER_ERRORS.labels("enter").inc()
+        logger.warning("Ошибка в enter(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /enter.")
+
+
+@instrument("begin")
+async def begin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /begin handler - the organizer starts the tournament of the group.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        matchmaker = get_matchmaker(context)
+        current = matchmaker.tournaments.get(update.effective_chat.id)
+        if current is None or current.started:
+            await update.message.reply_text("Нет турнира, ожидающего начала.")
+            return
+        if update.effective_user.id != current.organizer:
+            await update.message.reply_text(
+                "Начать турнир может только организатор."
+            )
+            return
+        if len(current.players) < 2:
+            await update.message.reply_text("Нужно хотя бы два участника.")
+            return
+        await next_round(context, current)
+    except Exception as exc:
+        HANDLER_ERRORS.labels("begin").inc()
+        logger.warning("Ошибка в begin(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /begin.")
+
+
+@instrument("top")
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /top [N] handler - shows the N (10 by default, 50 at most) highest
+    rated players.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        count = 10
+        if context.args and context.args[0].isdigit():
+            count = min(max(int(context.args[0]), 1), 50)
+        leaders = get_ratings(context).top(count)
+        if not leaders:
+            await update.message.reply_text(
+                "Рейтинг пока пуст: сыграйте партию с другим игроком."
+            )
+            return
+        lines = ["Лучшие игроки:"]
+        lines += [f"{place}. @{player.name} — {player.rating:.0f} "
+                  f"({player.wins}/{player.draws}/{player.losses})"
+                  for place, (_, player) in enumerate(leaders, 1)]
+        await update.message.reply_text("\n".join(lines))
+    except Exception as exc:
+        HANDLER_ERRORS.labels("top").inc()
+        logger.warning("Ошибка в top(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /top.")
+
+
+@instrument("rank")
+async def rank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /rank handler - shows the rating and place of the user.
+
+    Parameters
+    ----------
+    update : Update
+        The incoming update.
+    context : CallbackContext
+        The context object.
+    """
+    try:
+        ratings = get_ratings(context)
+        user_id = update.effective_user.id
+        place = ratings.rank(user_id)
+        if place is None:
+            await update.message.reply_text(
+                f"У вас пока нет рейтинговых партий. Начальный рейтинг — "
+                f"{ratings.rating_of(user_id):.0f}."
+            )
+            return
+        player = ratings.players[user_id]
+        await update.message.reply_text(
+            f"Ваш рейтинг: {player.rating:.0f}, место {place} из "
+            f"{len(ratings)}.\nПобед: {player.wins}, ничьих: {player.draws}, "
+            f"поражений: {player.losses}."
+        )
+    except Exception as exc:
+        HANDLER_ERRORS.labels("rank").inc()
+        logger.warning("Ошибка в rank(): %s", exc)
+        await update.message.reply_text("Произошла ошибка при /rank.")
@@ -0,0 +1,551 @@
+"""
+Matchmaking across chats: a waiting pool indexed by rating and
+Swiss-system tournaments.
+
+Nothing here talks to Telegram; the commands that drive it live in
+lobby.py.
+"""
+import math
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Callable, NamedTuple
+
+from tictactoe.constants import DEFAULT_RATING, MATCH_BUCKET, MATCH_MAX_GAP
+from tictactoe.replay import CROSS_WIN, ZERO_WIN, DRAW
+
+MATCHMAKER_KEY = "matchmaker"
+
+# Pairs tried when looking for a round without rematches.
+PAIRING_BUDGET = 10000
+
+
+class Waiting(NamedTuple):
+    """
+    A player in the waiting pool.
+
+    Attributes
+    ----------
+    user_id : int
+        Telegram user id.
+    rating : float
+        Rating the player is matched by.
+    chat_id : int
+        Private chat the player's board is sent to.
+    name : str
+        Display name.
+    since : float
+        time.monotonic() when the player joined the pool.
+    """
+    user_id: int
+    rating: float
+    chat_id: int
+    name: str
+    since: float
+
+
+class WaitingPool:
+    """
+    Players waiting for an opponent, indexed by rating.
+
+    Ratings are split into buckets `bucket_width` points wide. Each bucket
+    is a FIFO of its players, and the numbers of non-empty buckets are
+    kept sorted, so finding the nearest opponent is a binary search and
+    leaving the queue is a dict lookup: nothing scans the players.
+
+    Parameters
+    ----------
+    bucket_width : int
+        Rating points per bucket.
+    """
+
+    def __init__(self, bucket_width: int = MATCH_BUCKET) -> None:
+        self.bucket_width = bucket_width
+        self._buckets: dict[int, OrderedDict[int, Waiting]] = {}
+        self._keys: list[int] = []
+        self._bucket_of: dict[int, int] = {}
+
+    def add(self, player: Waiting) -> None:
+        """
+        Puts a player at the end of the FIFO of their rating bucket.
+
+        Parameters
+        ----------
+        player : Waiting
+            The player; must not be in the pool yet.
+        """
+        if player.user_id in self._bucket_of:
+            raise ValueError(f"User {player.user_id} is already waiting")
+        key = int(player.rating // self.bucket_width)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = OrderedDict()
+            insort(self._keys, key)
+        bucket[player.user_id] = player
+        self._bucket_of[player.user_id] = key
+
+    def remove(self, user_id: int) -> Waiting | None:
+        """
+        Takes a player out of the pool.
+
+        Parameters
+        ----------
+        user_id : int
+            Telegram user id.
+
+        Returns
+        -------
+        Waiting or None
+            The player or None if they were not waiting.
+        """
+        key = self._bucket_of.pop(user_id, None)
+        if key is None:
+            return None
+        bucket = self._buckets[key]
+        player = bucket.pop(user_id)
+        if not bucket:
+            self._drop_bucket(key)
+        return player
+
+    def pop_match(self, rating: float, max_gap: float) -> Waiting | None:
+        """
+        Takes the longest waiting player of the nearest non-empty bucket.
+
+        Parameters
+        ----------
+        rating : float
+            Rating of the player looking for an opponent.
+        max_gap : float
+            Largest rating difference, rounded to whole buckets.
+
+        Returns
+        -------
+        Waiting or None
+            The opponent or None if nobody is close enough.
+        """
+        key = int(rating // self.bucket_width)
+        index = bisect_left(self._keys, key)
+        # The nearest buckets are the first one at or above the rating
+        # and the last one below it; a tie goes to the longer wait.
+        best = None
+        for candidate in self._keys[max(index - 1, 0):index + 1]:
+            head = next(iter(self._buckets[candidate].values()))
+            rank = (abs(candidate - key), head.since)
+            if best is None or rank < best[0]:
+                best = (rank, head)
+        if best is None or best[0][0] > max_gap // self.bucket_width:
+            return None
+        return self.remove(best[1].user_id)
+
+    def _drop_bucket(self, key: int) -> None:
+        del self._buckets[key]
+        del self._keys[bisect_left(self._keys, key)]
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._bucket_of
+
+    def __len__(self) -> int:
+        return len(self._bucket_of)
+
+
+class Match(NamedTuple):
+    """
+    A game between two players of the pool or of a tournament.
+
+    Attributes
+    ----------
+    players : tuple[int, int]
+        User ids, CROSS first.
+    tournament : int or None
+        Chat id of the tournament the game belongs to.
+    """
+    players: tuple[int, int]
+    tournament: int | None
+
+
+class TournamentPlayer:
+    """
+    Standing of one tournament player.
+    """
+    __slots__ = ("user_id", "name", "rating", "score", "opponents",
+                 "crosses", "byes")
+
+    def __init__(self, user_id: int, name: str, rating: float) -> None:
+        self.user_id = user_id
+        self.name = name
+        self.rating = rating
+        self.score = 0.0
+        self.opponents: set[int] = set()
+        self.crosses = 0
+        self.byes = 0
+
+
+class Tournament:
+    """
+    Swiss-system tournament of a group chat.
+
+    Every round pairs players with equal or close scores who have not met
+    yet; the number of rounds is enough to single out a winner,
+    ceil(log2(players)). A win is worth 1 point, a draw 1/2, a bye 1.
+
+    Parameters
+    ----------
+    chat_id : int
+        Group chat the tournament is announced in.
+    variant : str
+        Key of BOARD_VARIANTS all games are played on.
+    organizer : int
+        User id of the player allowed to start it.
+    """
+
+    def __init__(self, chat_id: int, variant: str, organizer: int) -> None:
+        self.chat_id = chat_id
+        self.variant = variant
+        self.organizer = organizer
+        self.players: dict[int, TournamentPlayer] = {}
+        self.round = 0
+        self.rounds = 0
+        self.pending = 0
+
+    @property
+    def started(self) -> bool:
+        return self.round > 0
+
+    @property
+    def finished(self) -> bool:
+        return self.started and self.round >= self.rounds \
+            and not self.pending
+
+    def register(self, user_id: int, name: str, rating: float) -> bool:
+        """
+        Adds a player before the first round.
+
+        Returns
+        -------
+        bool
+            False if the player is already registered or it is too late.
+        """
+        if self.started or user_id in self.players:
+            return False
+        self.players[user_id] = TournamentPlayer(user_id, name, rating)
+        return True
+
+    def withdraw(self, user_id: int) -> bool:
+        """
+        Removes a player before the first round.
+
+        Returns
+        -------
+        bool
+            False if the player is not registered or it is too late.
+        """
+        if self.started or user_id not in self.players:
+            return False
+        del self.players[user_id]
+        return True
+
+    def pair_round(self) -> tuple[list[tuple[TournamentPlayer,
+                                             TournamentPlayer]],
+                                  TournamentPlayer | None]:
+        """
+        Starts the next round.
+
+        Returns
+        -------
+        tuple
+            (pairs, bye): (CROSS, ZERO) pairs and the player without an
+            opponent this round, if the number of players is odd.
+        """
+        if not self.started:
+            self.rounds = max(1, math.ceil(math.log2(len(self.players))))
+        self.round += 1
+        order = sorted(self.players.values(),
+                       key=lambda p: (-p.score, -p.rating, p.user_id))
+        bye = None
+        if len(order) % 2:
+            # The lowest ranked player who has not had a bye yet.
+            bye = min(reversed(order), key=lambda p: p.byes)
+            order.remove(bye)
+            bye.byes += 1
+            bye.score += 1
+
+        pairs = _pair_new_opponents(order, PAIRING_BUDGET)
+        if pairs is None:
+            # Everyone left has met: pair neighbours in the standings.
+            pairs = list(zip(order[::2], order[1::2]))
+        for index, (first, second) in enumerate(pairs):
+            first.opponents.add(second.user_id)
+            second.opponents.add(first.user_id)
+            if first.crosses > second.crosses:
+                first, second = second, first
+            first.crosses += 1
+            pairs[index] = (first, second)
+        self.pending = len(pairs)
+        return pairs, bye
+
+    def report(self, cross: int, zero: int, outcome: int) -> bool:
+        """
+        Records the result of a game of the current round.
+
+        Parameters
+        ----------
+        cross, zero : int
+            User ids of the players.
+        outcome : int
+            CROSS_WIN, ZERO_WIN, DRAW or ABORTED (nobody scores).
+
+        Returns
+        -------
+        bool
+            True if it was the last game of the round.
+        """
+        if outcome == CROSS_WIN:
+            self.players[cross].score += 1
+        elif outcome == ZERO_WIN:
+            self.players[zero].score += 1
+        elif outcome == DRAW:
+            self.players[cross].score += 0.5
+            self.players[zero].score += 0.5
+        self.pending -= 1
+        return not self.pending
+
+    def standings(self) -> list[TournamentPlayer]:
+        """
+        Returns the players by score, then by rating.
+        """
+        return sorted(self.players.values(),
+                      key=lambda p: (-p.score, -p.rating, p.user_id))
+
+
+def _pair_new_opponents(
+    players: list[TournamentPlayer], budget: int
+) -> list[tuple[TournamentPlayer, TournamentPlayer]] | None:
+    # Pairs every player, in standings order, with the highest ranked
+    # player they have not met, backtracking when the rest cannot be
+    # paired. `budget` bounds the number of tried pairs. The chosen pairs
+    # are kept on a stack of indices, so neither the depth of the search
+    # nor list copies grow with the number of players.
+    count = len(players)
+    paired = [False] * count
+    stack: list[tuple[int, int]] = []
+    first = start = 0
+    while True:
+        while first < count and paired[first]:
+            first += 1
+        if first == count:
+            return [(players[a], players[b]) for a, b in stack]
+        opponents = players[first].opponents
+        second = next((index for index in range(max(start, first + 1),
+                                                count)
+                       if not paired[index]
+                       and players[index].user_id not in opponents), None)
+        if second is None:
+            # No opponent left for `first`: undo the previous pair and
+            # try the next opponent of its first player.
+            if not stack:
+                return None
+            first, second = stack.pop()
+            paired[first] = paired[second] = False
+            start = second + 1
+            continue
+        budget -= 1
+        if budget < 0:
+            return None
+        paired[first] = paired[second] = True
+        stack.append((first, second))
+        start = 0
+
+
+class Matchmaker:
+    """
+    Waiting pools, games in progress and tournaments of the application.
+
+    Every user is in at most one of: a waiting pool, a game of a match.
+    Both are indexed by user id, so the active game of a player is found
+    without looking through the games.
+
+    Parameters
+    ----------
+    max_gap : float
+        Largest rating difference of a pool match.
+    bucket_width : int
+        Rating points per pool bucket.
+    rating_of : Callable[[int], float] or None
+        Returns the rating of a user; everyone has DEFAULT_RATING if None.
+    """
+
+    def __init__(self, max_gap: float = MATCH_MAX_GAP,
+                 bucket_width: int = MATCH_BUCKET,
+                 rating_of: Callable[[int], float] | None = None) -> None:
+        self.max_gap = max_gap
+        self.bucket_width = bucket_width
+        self.rating_of = rating_of or (lambda user_id: DEFAULT_RATING)
+        self.pools: dict[str, WaitingPool] = {}
+        self._queued: dict[int, str] = {}
+        self.matches: dict[int, Match] = {}
+        self._active: dict[int, int] = {}
+        # The queue, matches and tournaments live in memory only, but a
+        # game and its boards keep their match id in the game store and
+        # the snapshot, so ids must not be reused by the next process.
+        self._next_match = time.time_ns()
+        self.tournaments: dict[int, Tournament] = {}
+        self._entrants: dict[int, int] = {}
+
+    def enqueue(self, player: Waiting, variant: str) -> Waiting | None:
+        """
+        Pairs a player with the nearest waiting opponent or queues them.
+
+        Parameters
+        ----------
+        player : Waiting
+            The player; must be neither waiting nor playing a match.
+        variant : str
+            Key of BOARD_VARIANTS.
+
+        Returns
+        -------
+        Waiting or None
+            The opponent, taken out of the pool, or None if the player
+            now waits.
+        """
+        pool = self.pools.get(variant)
+        if pool is None:
+            pool = self.pools[variant] = WaitingPool(self.bucket_width)
+        opponent = pool.pop_match(player.rating, self.max_gap)
+        if opponent is None:
+            pool.add(player)
+            self._queued[player.user_id] = variant
+            return None
+        del self._queued[opponent.user_id]
+        return opponent
+
+    def leave(self, user_id: int) -> bool:
+        """
+        Takes a user out of the waiting pool.
+
+        Returns
+        -------
+        bool
+            False if the user was not waiting.
+        """
+        variant = self._queued.pop(user_id, None)
+        if variant is None:
+            return False
+        self.pools[variant].remove(user_id)
+        return True
+
+    def queued(self, user_id: int) -> str | None:
+        """
+        Returns the variant a user waits for, None if they do not.
+        """
+        return self._queued.get(user_id)
+
+    def open_match(self, players: tuple[int, int],
+                   tournament: int | None = None) -> int:
+        """
+        Registers a game between two players.
+
+        Returns
+        -------
+        int
+            Match id, kept in the game data.
+        """
+        match_id = self._next_match
+        self._next_match += 1
+        self.matches[match_id] = Match(players, tournament)
+        for user_id in players:
+            self._active[user_id] = match_id
+        return match_id
+
+    def close_match(self, match_id: int | None) -> Match | None:
+        """
+        Forgets a finished game. Closing it again does nothing.
+
+        Returns
+        -------
+        Match or None
+            The match or None if it was already closed.
+        """
+        match = self.matches.pop(match_id, None)
+        if match is not None:
+            for user_id in match.players:
+                if self._active.get(user_id) == match_id:
+                    del self._active[user_id]
+        return match
+
+    def match_of(self, user_id: int) -> int | None:
+        """
+        Returns the id of the match a user is playing, if any.
+        """
+        return self._active.get(user_id)
+
+    def open_tournament(self, tournament: Tournament) -> None:
+        """
+        Registers a tournament of a chat.
+        """
+        self.tournaments[tournament.chat_id] = tournament
+
+    def enter(self, tournament: Tournament, user_id: int,
+              name: str) -> bool:
+        """
+        Registers a user for a tournament at their current rating.
+
+        Returns
+        -------
+        bool
+            False if the user already plays in a tournament or it has
+            started.
+        """
+        if user_id in self._entrants:
+            return False
+        if not tournament.register(user_id, name, self.rating_of(user_id)):
+            return False
+        self._entrants[user_id] = tournament.chat_id
+        return True
+
+    def withdraw(self, user_id: int) -> Tournament | None:
+        """
+        Takes a user out of a tournament that has not started yet.
+
+        Returns
+        -------
+        Tournament or None
+            The tournament left, None if the user was not registered for
+            one or it has started.
+        """
+        tournament = self.tournament_of(user_id)
+        if tournament is None or not tournament.withdraw(user_id):
+            return None
+        del self._entrants[user_id]
+        return tournament
+
+    def tournament_of(self, user_id: int) -> Tournament | None:
+        """
+        Returns the tournament a user is registered for, if any.
+        """
+        chat_id = self._entrants.get(user_id)
+        return None if chat_id is None else self.tournaments.get(chat_id)
+
+    def close_tournament(self, chat_id: int) -> Tournament | None:
+        """
+        Forgets a tournament and releases its players.
+        """
+        tournament = self.tournaments.pop(chat_id, None)
+        if tournament is not None:
+            for user_id in tournament.players:
+                self._entrants.pop(user_id, None)
+        return tournament
+
+    def waiting(self) -> int:
+        """
+        Returns the number of players in all waiting pools.
+        """
+        return len(self._queued)
+
+
+def new_waiting(user_id: int, rating: float, chat_id: int,
+                name: str) -> Waiting:
+    """
+    Creates a pool entry stamped with the current time.
+    """
+    return Waiting(user_id, rating, chat_id, name, time.monotonic())
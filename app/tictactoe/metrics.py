@@ -0,0 +1,369 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, TypeVar
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_SERVER_KEY = "metrics_server"
+
+Handler = TypeVar("Handler", bound=Callable[..., Awaitable[Any]])
+
+# Seconds; Telegram round trips are usually 10-500 ms.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    """
+    Base of the metric types: a family of values, one per combination of
+    label values.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], Any] = {}
+        if not labelnames:
+            self._children[()] = self._new_child()
+        REGISTRY.append(self)
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> Any:
+        """
+        Returns the value for the given label values, in the order of
+        `labelnames`.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _label_text(self, values: tuple[str, ...],
+                    extra: str = "") -> str:
+        pairs = [f'{name}="{value}"'
+                 for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: tuple[str, ...],
+                      child: Any) -> list[str]:
+        return [f"{self.name}{self._label_text(values)} {child.get()}"]
+
+
+class _Value:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function: Callable[[], float] | None = None
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        # The value is read from `function` when the metrics are scraped.
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count.
+    """
+
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._children[()].inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, or is read from a function on scrape.
+    """
+
+    kind = "gauge"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._children[()].set_function(function)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values over fixed buckets.
+
+    Parameters
+    ----------
+    buckets : tuple[float, ...]
+        Sorted upper bounds of the buckets; +Inf is implied.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def _render_child(self, values: tuple[str, ...],
+                      child: _HistogramValue) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            label = self._label_text(values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{label} {cumulative}")
+        label = self._label_text(values, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{label} {child.count}")
+        label = self._label_text(values)
+        lines.append(f"{self.name}_sum{label} {child.sum}")
+        lines.append(f"{self.name}_count{label} {child.count}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+HANDLER_SECONDS = Histogram(
+    "tictactoe_handler_seconds",
+    "Handler latency.", ("handler",)
+)
+HANDLER_API_SECONDS = Histogram(
+    "tictactoe_handler_api_seconds",
+    "Time a handler spent awaiting the Telegram API.", ("handler",)
+)
+HANDLER_LOGIC_SECONDS = Histogram(
+    "tictactoe_handler_logic_seconds",
+    "Handler time outside Telegram API calls.", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "tictactoe_handler_errors_total",
+    "Errors caught or raised in handlers.", ("handler",)
+)
+API_SECONDS = Histogram(
+    "tictactoe_telegram_api_seconds",
+    "Telegram Bot API request latency.", ("method",)
+)
+ACTIVE_GAMES = Gauge(
+    "tictactoe_active_games",
+    "Games held in the game store."
+)
+MOVES = Counter(
+    "tictactoe_moves_total",
+    "Moves made.", ("player",)
+)
+GAMES_FINISHED = Counter(
+    "tictactoe_games_finished_total",
+    "Finished games.", ("result",)
+)
+POSITION_CACHE_LOOKUPS = Counter(
+    "tictactoe_position_cache_lookups_total",
+    "AI position cache lookups.", ("result",)
+)
+POSITION_CACHE_SIZE = Gauge(
+    "tictactoe_position_cache_size",
+    "Positions held in the AI position cache."
+)
+BOOK_LOOKUPS = Counter(
+    "tictactoe_book_lookups_total",
+    "AI opening book lookups.", ("result",)
+)
+MATCH_QUEUE = Gauge(
+    "tictactoe_match_queue",
+    "Players waiting for an opponent in /queue."
+)
+
+# Seconds the current handler has spent in Telegram API requests.
+_api_time: contextvars.ContextVar[list[float] | None] = \
+    contextvars.ContextVar("api_time", default=None)
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    Returns
+    -------
+    str
+        Metrics text.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument(name: str) -> Callable[[Handler], Handler]:
+    """
+    Decorator recording latency, Telegram API time and errors of a handler.
+
+    Parameters
+    ----------
+    name : str
+        Value of the "handler" label.
+
+    Returns
+    -------
+    Callable
+        The decorator.
+    """
+    total = HANDLER_SECONDS.labels(name)
+    api = HANDLER_API_SECONDS.labels(name)
+    logic = HANDLER_LOGIC_SECONDS.labels(name)
+    errors = HANDLER_ERRORS.labels(name)
+
+    def decorator(handler: Handler) -> Handler:
+        @functools.wraps(handler)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            spent = [0.0]
+            token = _api_time.set(spent)
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                _api_time.reset(token)
+                total.observe(elapsed)
+                api.observe(spent[0])
+                logic.observe(elapsed - spent[0])
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records the latency of every Bot API request and
+    adds it to the API time of the handler that awaits it.
+    """
+
+    async def do_request(self, url: str, method: str, *args: Any,
+                         **kwargs: Any) -> tuple[int, bytes]:
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            API_SECONDS.labels(url.rpartition("/")[2]).observe(elapsed)
+            spent = _api_time.get()
+            if spent is not None:
+                spent[0] += elapsed
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server answering GET /metrics with render().
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on.
+    port : int
+        Port to listen on.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9090) -> None:
+        self.host = host
+        self.port = port
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host,
+                                                  self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" \
+                    and parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,281 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from telegram import InlineKeyboardMarkup, Message
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_KEY = "outbound"
+
+SendFactory = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : float
+        Maximum number of tokens, i.e. the allowed burst.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def try_take(self) -> bool:
+        """
+        Takes a token if one is available right now.
+
+        Returns
+        -------
+        bool
+            True if a token was taken.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def take(self) -> None:
+        """
+        Waits until a token is available and takes it.
+        """
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ("key", "factory")
+
+    def __init__(self, key: Hashable | None, factory: SendFactory) -> None:
+        self.key = key
+        self.factory = factory
+
+
+class OutboundQueue:
+    """
+    Rate-limited queue of outgoing Telegram requests.
+
+    Every chat has its own FIFO and token bucket, and all chats share a
+    global bucket. A chat is drained by its own task, so a flood wait
+    (RetryAfter) pauses only that chat. If an edit of a message is still
+    queued when a newer edit of the same message arrives, the queued one
+    is replaced and only the latest text is sent.
+
+    Parameters
+    ----------
+    global_rate : float
+        Requests per second for the whole bot.
+    chat_rate : float
+        Requests per second for one chat.
+    chat_burst : float
+        Requests one chat may send at once before chat_rate applies.
+    max_retries : int
+        Attempts for a request that keeps getting RetryAfter.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, max_retries: int = 3) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._queues: dict[int, deque[_Job]] = {}
+        self._pending: dict[Hashable, _Job] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._sweep_at = 1024
+        self.metrics = {
+            "queued": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "retried": 0,
+            "failed": 0,
+        }
+
+    def submit(self, chat_id: int, factory: SendFactory,
+               key: Hashable | None = None,
+               droppable: bool = False) -> None:
+        """
+        Queues a request.
+
+        Parameters
+        ----------
+        chat_id : int
+            Chat the request goes to.
+        factory : Callable[[], Awaitable]
+            Creates the request coroutine when it is time to send it.
+        key : Hashable or None
+            Requests with the same key replace each other while queued.
+        droppable : bool
+            Drop the request instead of queueing it if the chat already
+            has requests waiting.
+        """
+        if key is not None and key in self._pending:
+            self._pending[key].factory = factory
+            self.metrics["coalesced"] += 1
+            return
+
+        queue = self._queues.get(chat_id)
+        if droppable and queue:
+            self.metrics["dropped"] += 1
+            return
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+
+        job = _Job(key, factory)
+        queue.append(job)
+        if key is not None:
+            self._pending[key] = job
+        self.metrics["queued"] += 1
+
+        if chat_id not in self._workers:
+            # A fresh context keeps the requests of this chat from being
+            # counted as API time of the handler that submitted the first.
+            self._workers[chat_id] = asyncio.create_task(
+                self._drain(chat_id), context=contextvars.Context()
+            )
+
+    def edit_text(self, message: Message, text: str,
+                  reply_markup: InlineKeyboardMarkup | None = None) -> None:
+        """
+        Queues an edit of a message; only the latest pending edit is sent.
+        """
+        self.submit(
+            message.chat_id,
+            lambda: message.edit_text(text=text, reply_markup=reply_markup),
+            key=(message.chat_id, message.message_id),
+        )
+
+    def notify(self, message: Message, text: str) -> None:
+        """
+        Queues a reply that is dropped if the chat is already busy.
+        """
+        self.submit(message.chat_id,
+                    lambda: message.reply_text(text),
+                    droppable=True)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self._sweep_at:
+                self._sweep_buckets()
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate,
+                                                          self.chat_burst)
+        return bucket
+
+    def _sweep_buckets(self) -> None:
+        # A full bucket carries no state, so buckets of idle chats are
+        # dropped and recreated on the next request.
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._workers and bucket.is_full():
+                del self._buckets[chat_id]
+        self._sweep_at = max(1024, 2 * len(self._buckets))
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        bucket = self._bucket(chat_id)
+        try:
+            while queue:
+                await bucket.take()
+                await self.global_bucket.take()
+                job = queue.popleft()
+                if job.key is not None:
+                    del self._pending[job.key]
+                await self._send(chat_id, job)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+
+    async def _send(self, chat_id: int, job: _Job) -> None:
+        for _ in range(self.max_retries):
+            try:
+                await job.factory()
+                self.metrics["sent"] += 1
+                return
+            except RetryAfter as exc:
+                self.metrics["retried"] += 1
+                logger.info("Flood wait %ss in chat_id=%s",
+                            exc.retry_after, chat_id)
+                await asyncio.sleep(float(exc.retry_after))
+                if job.key is not None and job.key in self._pending:
+                    # A newer edit of the message arrived while waiting.
+                    self.metrics["coalesced"] += 1
+                    return
+            except Exception as exc:
+                logger.warning("Outbound request failed in chat_id=%s: %s",
+                               chat_id, exc)
+                break
+        self.metrics["failed"] += 1
+
+    async def flush(self, timeout: float | None = None) -> None:
+        """
+        Waits until every queued request is sent.
+
+        Parameters
+        ----------
+        timeout : float or None
+            Seconds to wait at most.
+        """
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns request counters and the number of requests still queued.
+
+        Returns
+        -------
+        dict[str, int]
+            queued, sent, coalesced, dropped, retried, failed and pending.
+        """
+        pending = sum(len(queue) for queue in self._queues.values())
+        return dict(self.metrics, pending=pending)
+
+
+def get_outbound(context: Any) -> OutboundQueue:
+    """
+    Returns the outbound queue of the application, creating one with
+    default limits if none was configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+
+    Returns
+    -------
+    OutboundQueue
+        The outbound queue.
+    """
+    outbound = context.bot_data.get(OUTBOUND_KEY)
+    if outbound is None:
+        outbound = context.bot_data[OUTBOUND_KEY] = OutboundQueue()
+    return outbound
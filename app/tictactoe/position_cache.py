@@ -0,0 +1,195 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from tictactoe.constants import POSITION_CACHE_SIZE
+
+# (size, k, x, o) of the canonical orientation of a position.
+Key = tuple[int, int, int, int]
+
+
+@lru_cache(maxsize=None)
+def symmetries(size: int) -> tuple[tuple[tuple[int, ...], ...],
+                                   tuple[tuple[int, ...], ...]]:
+    """
+    Cell permutations of the 8 symmetries of a square board (rotations
+    and reflections) and their inverses.
+
+    Parameters
+    ----------
+    size : int
+        Board side.
+
+    Returns
+    -------
+    tuple
+        (forward, inverse): forward[t][cell] is the image of `cell` under
+        symmetry t, inverse[t] undoes it.
+    """
+    last = size - 1
+    maps = (
+        lambda r, c: (r, c),
+        lambda r, c: (c, last - r),
+        lambda r, c: (last - r, last - c),
+        lambda r, c: (last - c, r),
+        lambda r, c: (r, last - c),
+        lambda r, c: (last - r, c),
+        lambda r, c: (c, r),
+        lambda r, c: (last - c, last - r),
+    )
+    forward = []
+    inverse = []
+    for transform in maps:
+        image = [0] * (size * size)
+        back = [0] * (size * size)
+        for cell in range(size * size):
+            row, col = transform(*divmod(cell, size))
+            image[cell] = row * size + col
+            back[row * size + col] = cell
+        forward.append(tuple(image))
+        inverse.append(tuple(back))
+    return tuple(forward), tuple(inverse)
+
+
+def _permute(mask: int, permutation: tuple[int, ...]) -> int:
+    # Walks the set bits only: positions worth caching have few stones.
+    result = 0
+    while mask:
+        low = mask & -mask
+        result |= 1 << permutation[low.bit_length() - 1]
+        mask ^= low
+    return result
+
+
+def canonical(size: int, k: int, x: int, o: int) -> tuple[Key, int]:
+    """
+    Finds the canonical orientation of a position: the smallest (x, o)
+    over the 8 symmetries, so symmetric positions share one key.
+
+    Parameters
+    ----------
+    size, k : int
+        Board variant.
+    x, o : int
+        Masks of CROSS and ZERO.
+
+    Returns
+    -------
+    tuple[Key, int]
+        The key and the index of the symmetry that maps the position onto
+        it.
+    """
+    best = (x, o)
+    best_transform = 0
+    for transform, permutation in enumerate(symmetries(size)[0][1:], 1):
+        image = (_permute(x, permutation), _permute(o, permutation))
+        if image < best:
+            best = image
+            best_transform = transform
+    return (size, k) + best, best_transform
+
+
+class PositionCache:
+    """
+    Bounded LRU cache of AI moves keyed by canonical positions.
+
+    A move is stored in the canonical orientation and mapped back through
+    the inverse symmetry on lookup, so one search serves every rotation
+    and reflection of a position in every game.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of positions; 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._moves: OrderedDict[Key, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Key, transform: int) -> int | None:
+        """
+        Returns the cached move of a position.
+
+        Parameters
+        ----------
+        key, transform : Key, int
+            Result of canonical() for the position.
+
+        Returns
+        -------
+        int or None
+            Cell index in the orientation of the position or None on a
+            miss.
+        """
+        with self._lock:
+            move = self._moves.get(key)
+            if move is None:
+                self.misses += 1
+                return None
+            self._moves.move_to_end(key)
+            self.hits += 1
+        return symmetries(key[0])[1][transform][move]
+
+    def put(self, key: Key, transform: int, move: int | None) -> None:
+        """
+        Stores the move found for a position.
+
+        Parameters
+        ----------
+        key, transform : Key, int
+            Result of canonical() for the position.
+        move : int or None
+            Cell index in the orientation of the position; None (no free
+            cells) is not stored.
+        """
+        if move is None or not self.max_size:
+            return
+        move = symmetries(key[0])[0][transform][move]
+        with self._lock:
+            self._moves[key] = move
+            self._moves.move_to_end(key)
+            if len(self._moves) > self.max_size:
+                self._moves.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drops every position and resets the counters.
+        """
+        with self._lock:
+            self._moves.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._moves)
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        Returns usage statistics of the cache.
+
+        Returns
+        -------
+        dict[str, int | float]
+            size, hits, misses and hit_rate.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._moves),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_cache = PositionCache(POSITION_CACHE_SIZE)
+
+
+def get_position_cache() -> PositionCache:
+    """
+    Returns the position cache of the process, shared by all games.
+    """
+    return _cache
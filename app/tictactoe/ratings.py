@@ -0,0 +1,513 @@
+"""
+Elo ratings of players and the leaderboard.
+
+Ratings change after every finished game between two players. A Fenwick
+tree counts players per whole rating point, so the rank of a player and
+the top of the leaderboard are found in O(log n) without sorting or
+scanning the players. Changes are written to the backend in batches,
+like games in storage.GameStore, as increments rather than values: bot
+processes sharing one backend add to each other's results instead of
+overwriting them, and read back the rows the others changed.
+"""
+import asyncio
+import logging
+from itertools import islice
+from typing import Any
+
+from tictactoe.constants import DEFAULT_RATING
+from tictactoe.replay import CROSS_WIN, ZERO_WIN, DRAW
+
+logger = logging.getLogger(__name__)
+
+RATINGS_KEY = "ratings"
+
+# Ratings are indexed as whole points in range(RATING_SLOTS).
+RATING_SLOTS = 4096
+# K-factor of the first PROVISIONAL_GAMES games of a player and after.
+PROVISIONAL_K = 40
+ESTABLISHED_K = 20
+PROVISIONAL_GAMES = 30
+
+
+def expected_score(rating: float, opponent: float) -> float:
+    """
+    Expected score of a player against an opponent under Elo.
+    """
+    return 1 / (1 + 10 ** ((opponent - rating) / 400))
+
+
+class RankIndex:
+    """
+    Players ordered by rating, updated incrementally.
+
+    A Fenwick tree over whole rating points counts the players at or
+    below a rating; players of one point are kept in insertion order.
+    add, remove and rank are O(log RATING_SLOTS), top(k) is
+    O(k log RATING_SLOTS).
+    """
+
+    def __init__(self) -> None:
+        self._tree = [0] * (RATING_SLOTS + 1)
+        self._slots: dict[int, dict[int, None]] = {}
+        self._count = 0
+
+    @staticmethod
+    def slot(rating: float) -> int:
+        return min(max(int(round(rating)), 0), RATING_SLOTS - 1)
+
+    def _update(self, slot: int, delta: int) -> None:
+        slot += 1
+        while slot <= RATING_SLOTS:
+            self._tree[slot] += delta
+            slot += slot & -slot
+
+    def _at_most(self, slot: int) -> int:
+        # Number of players with a slot <= `slot`.
+        slot += 1
+        total = 0
+        while slot > 0:
+            total += self._tree[slot]
+            slot -= slot & -slot
+        return total
+
+    def _find(self, count: int) -> int:
+        # Smallest slot with at least `count` players at or below it.
+        position = 0
+        step = 1 << RATING_SLOTS.bit_length()
+        while step:
+            following = position + step
+            if following <= RATING_SLOTS and self._tree[following] < count:
+                position = following
+                count -= self._tree[following]
+            step >>= 1
+        return position
+
+    def add(self, user_id: int, rating: float) -> None:
+        slot = self.slot(rating)
+        self._slots.setdefault(slot, {})[user_id] = None
+        self._update(slot, 1)
+        self._count += 1
+
+    def remove(self, user_id: int, rating: float) -> None:
+        slot = self.slot(rating)
+        users = self._slots[slot]
+        del users[user_id]
+        if not users:
+            del self._slots[slot]
+        self._update(slot, -1)
+        self._count -= 1
+
+    def rank(self, rating: float) -> int:
+        """
+        Returns 1 + the number of players with a higher rating.
+        """
+        return self._count - self._at_most(self.slot(rating)) + 1
+
+    def top(self, k: int) -> list[int]:
+        """
+        Returns the user ids of the `k` highest rated players.
+        """
+        result: list[int] = []
+        while len(result) < min(k, self._count):
+            # The slot holding the (len(result) + 1)-th best player.
+            slot = self._find(self._count - len(result))
+            result.extend(islice(self._slots[slot], k - len(result)))
+        return result
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class PlayerRating:
+    """
+    Rating and record of one player.
+    """
+    __slots__ = ("name", "rating", "games", "wins", "draws", "losses")
+
+    def __init__(self, name: str = "", rating: float = DEFAULT_RATING,
+                 games: int = 0, wins: int = 0, draws: int = 0,
+                 losses: int = 0) -> None:
+        self.name = name
+        self.rating = rating
+        self.games = games
+        self.wins = wins
+        self.draws = draws
+        self.losses = losses
+
+    def row(self) -> tuple:
+        return (self.name, self.rating, self.games, self.wins, self.draws,
+                self.losses)
+
+    def add_result(self, change: float, score: float) -> None:
+        self.rating += change
+        self.games += 1
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+
+class RatingTable:
+    """
+    Ratings of all players, kept in memory with write-behind batching.
+
+    Every rated game adds to the pending changes of its two players:
+    rating points and game counts, not the new values. flush(), which
+    runs every `flush_interval` seconds once start() is called, adds them
+    to the backend rows in one transaction and then reloads every row
+    changed since the last reload, by this process or another one, so
+    the leaderboard follows the shared table. Ratings of a game are
+    computed from the values in memory, which may be up to one flush
+    behind the other processes.
+
+    Subclasses implement the backend methods _load_changed, _write and
+    _close; this class keeps ratings in memory only.
+
+    Parameters
+    ----------
+    flush_interval : float
+        Seconds between batched writes.
+    """
+
+    def __init__(self, flush_interval: float = 1.0) -> None:
+        self.flush_interval = flush_interval
+        self.players: dict[int, PlayerRating] = {}
+        self.index = RankIndex()
+        # user id -> changes not written yet, rating as a difference.
+        self._pending: dict[int, PlayerRating] = {}
+        # Change counter of the backend rows already loaded.
+        self._seq = -1
+        self._task: asyncio.Task | None = None
+        self._apply(*self._load_changed(self._seq))
+
+    def rating_of(self, user_id: int) -> float:
+        """
+        Returns the rating of a user, DEFAULT_RATING for a new one.
+        """
+        player = self.players.get(user_id)
+        return DEFAULT_RATING if player is None else player.rating
+
+    def record(self, cross: tuple[int, str], zero: tuple[int, str],
+               outcome: int) -> tuple[float, float]:
+        """
+        Updates both ratings after a game.
+
+        Parameters
+        ----------
+        cross, zero : tuple[int, str]
+            (user_id, name) of the players.
+        outcome : int
+            CROSS_WIN, ZERO_WIN or DRAW.
+
+        Returns
+        -------
+        tuple[float, float]
+            Rating changes of CROSS and ZERO.
+        """
+        score = {CROSS_WIN: 1.0, ZERO_WIN: 0.0, DRAW: 0.5}[outcome]
+        first = self._player(*cross)
+        second = self._player(*zero)
+        expected = expected_score(first.rating, second.rating)
+        changes = (self._k(first) * (score - expected),
+                   self._k(second) * (expected - score))
+        for (user_id, name), player, change, result in (
+                (cross, first, changes[0], score),
+                (zero, second, changes[1], 1 - score)):
+            self.index.remove(user_id, player.rating)
+            player.add_result(change, result)
+            self.index.add(user_id, player.rating)
+            pending = self._pending.get(user_id)
+            if pending is None:
+                pending = self._pending[user_id] = PlayerRating(name, 0.0)
+            pending.name = name
+            pending.add_result(change, result)
+        return changes
+
+    def rank(self, user_id: int) -> int | None:
+        """
+        Returns the place of a user on the leaderboard, None if they
+        have not played a rated game.
+        """
+        player = self.players.get(user_id)
+        return None if player is None else self.index.rank(player.rating)
+
+    def top(self, k: int) -> list[tuple[int, PlayerRating]]:
+        """
+        Returns (user_id, player) of the `k` highest rated players.
+        """
+        return [(user_id, self.players[user_id])
+                for user_id in self.index.top(k)]
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+    def _player(self, user_id: int, name: str) -> PlayerRating:
+        player = self.players.get(user_id)
+        if player is None:
+            player = self.players[user_id] = PlayerRating(name)
+            self.index.add(user_id, player.rating)
+        player.name = name
+        return player
+
+    @staticmethod
+    def _k(player: PlayerRating) -> float:
+        if player.games < PROVISIONAL_GAMES:
+            return PROVISIONAL_K
+        return ESTABLISHED_K
+
+    def _take_batch(self) -> dict[int, tuple]:
+        changes = {user_id: pending.row()
+                   for user_id, pending in self._pending.items()}
+        self._pending = {}
+        return changes
+
+    def _restore_batch(self, changes: dict[int, tuple]) -> None:
+        # Puts back the changes of a failed write, merged with the ones
+        # recorded meanwhile.
+        for user_id, (name, *counts) in changes.items():
+            pending = self._pending.get(user_id)
+            if pending is None:
+                self._pending[user_id] = PlayerRating(name, *counts)
+                continue
+            pending.rating += counts[0]
+            pending.games += counts[1]
+            pending.wins += counts[2]
+            pending.draws += counts[3]
+            pending.losses += counts[4]
+
+    def _apply(self, rows: list[tuple[int, tuple]], seq: int) -> None:
+        # Backend rows replace the players in memory; changes not written
+        # yet are added on top of them.
+        for user_id, row in rows:
+            player = self.players.get(user_id)
+            if player is not None:
+                self.index.remove(user_id, player.rating)
+            player = self.players[user_id] = PlayerRating(*row)
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                player.name = pending.name
+                player.rating += pending.rating
+                player.games += pending.games
+                player.wins += pending.wins
+                player.draws += pending.draws
+                player.losses += pending.losses
+            self.index.add(user_id, player.rating)
+        self._seq = max(self._seq, seq)
+
+    def flush(self) -> None:
+        """
+        Writes all pending changes to the backend and reloads the rows
+        changed since the last reload.
+        """
+        changes = self._take_batch()
+        if changes:
+            self._write(changes)
+        self._apply(*self._load_changed(self._seq))
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            changes = self._take_batch()
+            if changes:
+                try:
+                    await asyncio.to_thread(self._write, changes)
+                except Exception as exc:
+                    logger.warning("Rating flush failed: %s", exc)
+                    self._restore_batch(changes)
+                    continue
+            try:
+                rows, seq = await asyncio.to_thread(self._load_changed,
+                                                    self._seq)
+            except Exception as exc:
+                logger.warning("Rating reload failed: %s", exc)
+                continue
+            self._apply(rows, seq)
+
+    async def start(self) -> None:
+        """
+        Starts the periodic background flush.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flush and writes the remaining changes.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        self._close()
+
+    def _load_changed(self, seq: int) -> tuple[list[tuple[int, tuple]],
+                                                int]:
+        return [], seq
+
+    def _write(self, changes: dict[int, tuple]) -> None:
+        pass
+
+    def _close(self) -> None:
+        pass
+
+
+class SQLiteRatingTable(RatingTable):
+    """
+    Rating table backed by a SQLite database file, which all bot
+    processes may share.
+
+    Every batch takes the write lock, adds its changes to the rows and
+    stamps them with the next value of the `seq` column, so a process
+    reloads only the rows changed since the highest `seq` it has seen.
+
+    Parameters
+    ----------
+    path : str
+        Path to the database file; may be shared with the game store.
+    flush_interval : float
+        Seconds between batched writes.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0) -> None:
+        import sqlite3
+
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ratings ("
+            "user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+            "rating REAL NOT NULL, games INTEGER NOT NULL, "
+            "wins INTEGER NOT NULL, draws INTEGER NOT NULL, "
+            "losses INTEGER NOT NULL, seq INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Tables of earlier versions have no change counter.
+        if "seq" not in [row[1] for row in self._conn.execute(
+                "PRAGMA table_info(ratings)")]:
+            self._conn.execute("ALTER TABLE ratings ADD COLUMN "
+                               "seq INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ratings_seq ON ratings (seq)"
+        )
+        self._conn.commit()
+        super().__init__(flush_interval)
+
+    def _load_changed(self, seq: int) -> tuple[list[tuple[int, tuple]],
+                                                int]:
+        rows = self._conn.execute(
+            "SELECT user_id, name, rating, games, wins, draws, losses, seq "
+            "FROM ratings WHERE seq > ?", (seq,)
+        ).fetchall()
+        return ([(row[0], row[1:7]) for row in rows],
+                max((row[7] for row in rows), default=seq))
+
+    def _write(self, changes: dict[int, tuple]) -> None:
+        with self._conn:
+            # The write lock is taken before reading the counter, so
+            # batches of different processes get increasing values.
+            self._conn.execute("BEGIN IMMEDIATE")
+            seq = self._conn.execute(
+                "SELECT coalesce(max(seq), 0) + 1 FROM ratings"
+            ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT INTO ratings (user_id, name, rating, games, wins, "
+                "draws, losses, seq) VALUES (:user_id, :name, "
+                ":base + :rating, :games, :wins, :draws, :losses, :seq) "
+                "ON CONFLICT (user_id) DO UPDATE SET name = :name, "
+                "rating = rating + :rating, games = games + :games, "
+                "wins = wins + :wins, draws = draws + :draws, "
+                "losses = losses + :losses, seq = :seq",
+                ({"user_id": user_id, "name": name, "base": DEFAULT_RATING,
+                  "rating": rating, "games": games, "wins": wins,
+                  "draws": draws, "losses": losses, "seq": seq}
+                 for user_id, (name, rating, games, wins, draws, losses)
+                 in changes.items())
+            )
+
+    def _close(self) -> None:
+        self._conn.close()
+
+
+def create_rating_table(url: str,
+                        flush_interval: float = 1.0) -> RatingTable:
+    """
+    Creates a rating table from a URL-like description.
+
+    Parameters
+    ----------
+    url : str
+        "memory" or "sqlite:<path>".
+    flush_interval : float
+        Seconds between batched writes.
+
+    Returns
+    -------
+    RatingTable
+        The configured table.
+    """
+    scheme, _, path = url.partition(":")
+    if scheme == "memory":
+        return RatingTable(flush_interval)
+    if scheme == "sqlite":
+        return SQLiteRatingTable(path, flush_interval)
+    raise ValueError(f"Unknown rating store: {url}")
+
+
+def get_ratings(context: Any) -> RatingTable:
+    """
+    Returns the rating table of the application, creating an in-memory
+    one if none was configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+
+    Returns
+    -------
+    RatingTable
+        The rating table.
+    """
+    ratings = context.bot_data.get(RATINGS_KEY)
+    if ratings is None:
+        ratings = context.bot_data[RATINGS_KEY] = RatingTable()
+    return ratings
+
+
+def rate_game(context: Any, game: dict[str, Any],
+              outcome: int) -> tuple[float, float] | None:
+    """
+    Updates the ratings of the two players of a finished game, once.
+    Games against the AI and aborted games are not rated.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    game : dict[str, Any]
+        Game data as kept in the game store.
+    outcome : int
+        CROSS_WIN, ZERO_WIN, DRAW or ABORTED.
+
+    Returns
+    -------
+    tuple[float, float] or None
+        Rating changes of CROSS and ZERO, None if the game is not rated.
+    """
+    players = game.get("players", ())
+    if game.get("mode") == "single" or len(players) != 2 \
+            or outcome not in (CROSS_WIN, ZERO_WIN, DRAW) \
+            or game.get("rated"):
+        return None
+    game["rated"] = True
+    return get_ratings(context).record(
+        (players[0]["id"], players[0]["name"]),
+        (players[1]["id"], players[1]["name"]),
+        outcome,
+    )
@@ -0,0 +1,65 @@
+import logging
+from typing import Any
+
+from telegram.ext import ContextTypes
+
+from tictactoe.lobby import finish_match, game_keys
+from tictactoe.metrics import GAMES_FINISHED
+from tictactoe.outbound import get_outbound
+from tictactoe.replay import ABORTED, record_abort
+from tictactoe.storage import get_store
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_TEXT = "Игра завершена из-за неактивности. Введите /start."
+
+
+class GameReaper:
+    """
+    JobQueue callback that expires idle games.
+
+    Every run deletes the games idle for longer than `ttl` and the least
+    recently active games above `max_games` and, if `notify` is set,
+    edits their board message.
+
+    Parameters
+    ----------
+    ttl : float
+        Idle time in seconds; 0 disables it.
+    max_games : int
+        Maximum number of live games; 0 means no limit.
+    notify : bool
+        Edit the board message of an expired game.
+    """
+
+    def __init__(self, ttl: float, max_games: int = 0,
+                 notify: bool = True) -> None:
+        self.ttl = ttl
+        self.max_games = max_games
+        self.notify = notify
+
+    async def __call__(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        expired = get_store(context).expire(self.ttl, self.max_games)
+        if not expired:
+            return
+
+        outbound = get_outbound(context)
+        for key, game in expired:
+            record_abort(context, game)
+            await finish_match(context, game, ABORTED)
+            if not self.notify:
+                continue
+            # A game found by /queue is shown in two chats.
+            for chat_id, message_id in game_keys(game, key):
+                outbound.submit(
+                    chat_id,
+                    self._edit(context.bot, chat_id, message_id),
+                    key=(chat_id, message_id),
+                )
+        GAMES_FINISHED.labels("expired").inc(len(expired))
+        logger.info("Expired %d idle games", len(expired))
+
+    @staticmethod
+    def _edit(bot: Any, chat_id: int, message_id: int) -> Any:
+        return lambda: bot.edit_message_text(EXPIRED_TEXT, chat_id=chat_id,
+                                             message_id=message_id)
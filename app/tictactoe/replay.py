@@ -0,0 +1,362 @@
+"""
+Append-only log of finished games and tools to read it.
+
+File layout: the 5-byte header b"TTTR" + version, then records. A record
+is a fixed 25-byte header (see RECORD_HEADER) followed by one byte per
+move, the cell index (row * size + col) in the order the moves were made.
+
+Aggregate a log from the command line:
+
+    PYTHONPATH=app python -m tictactoe.replay games.log [more.log ...]
+"""
+import argparse
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+from typing import Any, Iterator, NamedTuple
+
+from tictactoe.constants import CROSS, ZERO
+
+logger = logging.getLogger(__name__)
+
+REPLAY_KEY = "replay_log"
+
+MAGIC = b"TTTR\x01"
+# size, k, mode, outcome, number of moves, finished at (unix time),
+# player 1 id, player 2 id (0 for the AI).
+RECORD_HEADER = struct.Struct("<BBBBBIqq")
+
+MODES = ("single", "multi", "lobby")
+CROSS_WIN, ZERO_WIN, DRAW, ABORTED = range(4)
+OUTCOMES = ("cross_win", "zero_win", "draw", "aborted")
+
+
+class GameRecord(NamedTuple):
+    """
+    One game of the log.
+
+    Attributes
+    ----------
+    size, k : int
+        Board variant.
+    mode : int
+        Index in MODES.
+    outcome : int
+        CROSS_WIN, ZERO_WIN, DRAW or ABORTED.
+    finished_at : int
+        Unix time the game ended.
+    player1, player2 : int
+        Telegram user ids; player2 is 0 when playing against the AI.
+    moves : bytes
+        Cell indices of the moves, CROSS first.
+    """
+    size: int
+    k: int
+    mode: int
+    outcome: int
+    finished_at: int
+    player1: int
+    player2: int
+    moves: bytes
+
+
+def pack_record(record: GameRecord) -> bytes:
+    """
+    Packs a record in the log format.
+
+    Parameters
+    ----------
+    record : GameRecord
+        The record.
+
+    Returns
+    -------
+    bytes
+        Record header followed by the moves.
+    """
+    return RECORD_HEADER.pack(
+        record.size, record.k, record.mode, record.outcome,
+        len(record.moves), record.finished_at, record.player1,
+        record.player2
+    ) + record.moves
+
+
+def game_record(game: dict[str, Any], outcome: int) -> GameRecord:
+    """
+    Builds a record from handler game data.
+
+    Parameters
+    ----------
+    game : dict[str, Any]
+        Game data as kept in the game store.
+    outcome : int
+        CROSS_WIN, ZERO_WIN, DRAW or ABORTED.
+
+    Returns
+    -------
+    GameRecord
+        The record.
+    """
+    board = game["board"]
+    players = game["players"]
+    return GameRecord(
+        board.size, board.k, MODES.index(game["mode"] or "single"),
+        outcome, int(time.time()),
+        players[0]["id"] if players else 0,
+        players[1]["id"] if len(players) > 1 else 0,
+        bytes(game.get("moves", ())),
+    )
+
+
+def outcome_of(winner: str | None) -> int:
+    """
+    Maps the result of check_win() on a finished board to an outcome.
+    """
+    if winner == CROSS:
+        return CROSS_WIN
+    if winner == ZERO:
+        return ZERO_WIN
+    return DRAW
+
+
+class ReplayLog:
+    """
+    Buffered writer of the game log.
+
+    Records are packed into an in-memory buffer that is written to the
+    file when it grows past `buffer_size` and, together with an fsync,
+    every `fsync_interval` seconds once start() is called.
+
+    Parameters
+    ----------
+    path : str
+        Log file; created with a header if it does not exist.
+    fsync_interval : float
+        Seconds between flushes to disk.
+    buffer_size : int
+        Bytes buffered before they are written without waiting.
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 1.0,
+                 buffer_size: int = 64 * 1024) -> None:
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._task: asyncio.Task | None = None
+        self.records = 0
+
+    def append(self, record: GameRecord) -> None:
+        """
+        Adds a record to the log.
+
+        Parameters
+        ----------
+        record : GameRecord
+            The record.
+        """
+        self._buffer += pack_record(record)
+        self.records += 1
+        if len(self._buffer) >= self.buffer_size:
+            self._write()
+
+    def _write(self) -> None:
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer.clear()
+
+    def flush(self, fsync: bool = True) -> None:
+        """
+        Writes buffered records and optionally syncs the file to disk.
+        """
+        self._write()
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            self._write()
+            self._file.flush()
+            try:
+                await asyncio.to_thread(os.fsync, self._file.fileno())
+            except OSError as exc:
+                logger.warning("Replay log fsync failed: %s", exc)
+
+    async def start(self) -> None:
+        """
+        Starts the periodic background flush.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flush, writes the remaining records and closes
+        the file.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        self._file.close()
+
+
+def record_game(context: Any, game: dict[str, Any], outcome: int) -> None:
+    """
+    Appends a game to the replay log of the application, if one is
+    configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    game : dict[str, Any]
+        Game data as kept in the game store.
+    outcome : int
+        CROSS_WIN, ZERO_WIN, DRAW or ABORTED.
+    """
+    log = context.bot_data.get(REPLAY_KEY)
+    if log is not None:
+        log.append(game_record(game, outcome))
+
+
+def record_abort(context: Any, game: dict[str, Any]) -> None:
+    """
+    Logs a game that is stopped or expired before its end as ABORTED.
+    Games that already ended were logged with their outcome and are
+    skipped.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+    game : dict[str, Any]
+        Game data as kept in the game store.
+    """
+    board = game["board"]
+    if game.get("mode") and board.winner() is None \
+            and not board.is_full():
+        record_game(context, game, ABORTED)
+
+
+def read_records(path: str) -> Iterator[GameRecord]:
+    """
+    Iterates over the records of a log without reading it into memory:
+    the file is memory-mapped and records are decoded one by one. A
+    record cut short by a crash at the end of the file is skipped.
+
+    Parameters
+    ----------
+    path : str
+        Log file.
+
+    Yields
+    ------
+    GameRecord
+        Records in the order they were written.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a replay log: {path}")
+            unpack_from = RECORD_HEADER.unpack_from
+            header_size = RECORD_HEADER.size
+            end = len(data)
+            offset = len(MAGIC)
+            while offset + header_size <= end:
+                header = unpack_from(data, offset)
+                offset += header_size
+                count = header[4]
+                if offset + count > end:
+                    break
+                yield GameRecord(*header[:4], *header[5:],
+                                 data[offset:offset + count])
+                offset += count
+
+
+def aggregate(paths: list[str]) -> dict[str, Any]:
+    """
+    Aggregates outcome statistics over logs.
+
+    Parameters
+    ----------
+    paths : list[str]
+        Log files.
+
+    Returns
+    -------
+    dict[str, Any]
+        Total number of games and, per "<mode> <size>x<size>" group, the
+        counts of each outcome, the human results against the AI
+        (win / draw / loss of player 1 in single mode) and the average
+        number of moves.
+    """
+    # (mode, size, outcome) -> [games, moves]; group names and human
+    # results are derived once at the end, not per record.
+    counts: dict[tuple[int, int, int], list[int]] = {}
+    for path in paths:
+        for record in read_records(path):
+            key = (record.mode, record.size, record.outcome)
+            entry = counts.get(key)
+            if entry is None:
+                entry = counts[key] = [0, 0]
+            entry[0] += 1
+            entry[1] += len(record.moves)
+
+    groups: dict[str, Counter] = {}
+    for (mode, size, outcome), (games, moves) in counts.items():
+        group = groups.setdefault(f"{MODES[mode]} {size}x{size}", Counter())
+        group[OUTCOMES[outcome]] += games
+        group["games"] += games
+        group["moves"] += moves
+
+    result = {"games": sum(group["games"] for group in groups.values()),
+              "groups": {}}
+    for key, group in sorted(groups.items()):
+        stats = {name: group[name] for name in OUTCOMES}
+        if key.startswith("single"):
+            # Player 1 plays CROSS against the AI.
+            stats["human_win"] = group["cross_win"]
+            stats["human_draw"] = group["draw"]
+            stats["human_loss"] = group["zero_win"]
+        stats["avg_moves"] = group["moves"] / group["games"]
+        result["groups"][key] = stats
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Aggregate win / draw / loss statistics of replay logs"
+    )
+    parser.add_argument("paths", nargs="+", help="replay log files")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    stats = aggregate(args.paths)
+    elapsed = time.perf_counter() - started
+
+    print(f"{stats['games']} games in {elapsed:.2f} s")
+    for key, group in stats["groups"].items():
+        line = ", ".join(f"{name}={value:.1f}" if isinstance(value, float)
+                         else f"{name}={value}"
+                         for name, value in group.items())
+        print(f"{key}: {line}")
+
+
+if __name__ == "__main__":
+    main()
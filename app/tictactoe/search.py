@@ -0,0 +1,647 @@
+import math
+import random
+import threading
+import time
+from typing import NamedTuple
+
+# Score of a won position; wins found sooner score higher.
+WIN_SCORE = 1_000_000
+_INFINITY = WIN_SCORE + 1
+
+_EXACT, _LOWER, _UPPER = 0, 1, 2
+
+# (row step, col step) of the four line directions.
+_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+class SearchResult(NamedTuple):
+    """
+    Outcome of one search.
+
+    Attributes
+    ----------
+    move : int or None
+        Chosen cell index, None if the board is full.
+    score : int
+        Score for the side to move (search-specific scale).
+    depth : int
+        Deepest completed iteration (alpha-beta) or 0 (MCTS).
+    nodes : int
+        Visited nodes (alpha-beta) or playouts (MCTS).
+    elapsed : float
+        Wall time in seconds.
+    """
+    move: int | None
+    score: int
+    depth: int
+    nodes: int
+    elapsed: float
+
+    @property
+    def nps(self) -> float:
+        """
+        Nodes per second.
+        """
+        return self.nodes / self.elapsed if self.elapsed else 0.0
+
+
+class Geometry:
+    """
+    Precomputed lines and neighbourhoods of an N x N board, K in a row.
+
+    Parameters
+    ----------
+    size : int
+        Board side.
+    k : int
+        Number in a row needed to win.
+    """
+
+    _cache: dict[tuple[int, int], "Geometry"] = {}
+
+    def __init__(self, size: int, k: int) -> None:
+        self.size = size
+        self.k = k
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        # rays[index][direction] = (cells forward, cells backward), each at
+        # most k - 1 long and cut at the board edge.
+        self.rays = []
+        self.neighbors = []
+        for index in range(self.cells):
+            row, col = divmod(index, size)
+            cell_rays = []
+            for dr, dc in _DIRECTIONS:
+                sides = []
+                for sign in (1, -1):
+                    side = []
+                    r, c = row + sign * dr, col + sign * dc
+                    while len(side) < k - 1 and 0 <= r < size \
+                            and 0 <= c < size:
+                        side.append(r * size + c)
+                        r += sign * dr
+                        c += sign * dc
+                    sides.append(tuple(side))
+                cell_rays.append(tuple(sides))
+            self.rays.append(tuple(cell_rays))
+
+            near = 0
+            for r in range(max(row - 1, 0), min(row + 2, size)):
+                for c in range(max(col - 1, 0), min(col + 2, size)):
+                    near |= 1 << (r * size + c)
+            self.neighbors.append(near)
+
+    @classmethod
+    def get(cls, size: int, k: int) -> "Geometry":
+        geometry = cls._cache.get((size, k))
+        if geometry is None:
+            geometry = cls._cache[(size, k)] = cls(size, k)
+        return geometry
+
+    def line_lengths(self, index: int, mask: int) -> list[int]:
+        """
+        Lengths of the unbroken lines of `mask` through a cell in the four
+        directions, counting the cell itself as taken.
+        """
+        lengths = []
+        for forward, backward in self.rays[index]:
+            length = 1
+            for cell in forward:
+                if not mask >> cell & 1:
+                    break
+                length += 1
+            for cell in backward:
+                if not mask >> cell & 1:
+                    break
+                length += 1
+            lengths.append(length)
+        return lengths
+
+    def wins(self, index: int, mask: int) -> bool:
+        k = self.k
+        for length in self.line_lengths(index, mask):
+            if length >= k:
+                return True
+        return False
+
+    def candidates(self, me: int, other: int) -> int:
+        """
+        Mask of free cells next to any stone, or the center on an empty
+        board.
+        """
+        stones = me | other
+        if not stones:
+            return 1 << (self.size // 2 * self.size + self.size // 2)
+        near = 0
+        mask = stones
+        while mask:
+            bit = mask & -mask
+            near |= self.neighbors[bit.bit_length() - 1]
+            mask ^= bit
+        return near & ~stones & self.full
+
+    def cell_score(self, index: int, me: int, other: int) -> int:
+        """
+        Heuristic value of playing a cell: own lines weigh more than the
+        opponent's lines the move would block.
+        """
+        score = 0
+        for length in self.line_lengths(index, me):
+            score += 4 ** min(length, self.k)
+        for length in self.line_lengths(index, other):
+            score += 3 ** min(length, self.k)
+        return score
+
+    def evaluate(self, me: int, other: int) -> int:
+        """
+        Static evaluation for the side to move: open runs of each player
+        scored by length, own runs weighted higher since it is our move.
+        """
+        return (self._runs_score(me) * 11) // 10 - self._runs_score(other)
+
+    def _runs_score(self, mask: int) -> int:
+        free = self.full & ~mask
+        score = 0
+        stones = mask
+        while stones:
+            bit = stones & -stones
+            stones ^= bit
+            index = bit.bit_length() - 1
+            for forward, backward in self.rays[index]:
+                # Count each run once, from the stone that starts it.
+                if backward and mask >> backward[0] & 1:
+                    continue
+                length = 1
+                end = None
+                for cell in forward:
+                    if mask >> cell & 1:
+                        length += 1
+                    else:
+                        end = cell
+                        break
+                open_ends = (end is not None and free >> end & 1) + \
+                    (bool(backward) and free >> backward[0] & 1)
+                if open_ends:
+                    score += open_ends * 10 ** min(length, self.k)
+        return score
+
+
+def side_to_move(x: int, o: int) -> tuple[int, int]:
+    """
+    Returns (masks of the side to move, masks of the other side).
+    CROSS moves first.
+    """
+    if x.bit_count() == o.bit_count():
+        return x, o
+    return o, x
+
+
+def heuristic_move(size: int, k: int, x: int, o: int) -> int | None:
+    """
+    Cheap one-ply move: win if possible, otherwise block, otherwise the
+    best cell by Geometry.cell_score().
+
+    Returns
+    -------
+    int or None
+        Cell index or None if the board is full.
+    """
+    geometry = Geometry.get(size, k)
+    me, other = side_to_move(x, o)
+    candidates = geometry.candidates(me, other)
+    best_score, best_cells = -1, []
+    while candidates:
+        bit = candidates & -candidates
+        candidates ^= bit
+        index = bit.bit_length() - 1
+        if geometry.wins(index, me | bit):
+            return index
+        score = geometry.cell_score(index, me, other)
+        if geometry.wins(index, other | bit):
+            score += WIN_SCORE
+        if score > best_score:
+            best_score, best_cells = score, [index]
+        elif score == best_score:
+            best_cells.append(index)
+    return random.choice(best_cells) if best_cells else None
+
+
+class _Timeout(Exception):
+    pass
+
+
+class Zobrist:
+    """
+    Zobrist keys for one board size, fixed by a seed so that hashes are
+    the same in every process.
+    """
+
+    _cache: dict[int, "Zobrist"] = {}
+
+    def __init__(self, cells: int, seed: int = 0x5EED) -> None:
+        rng = random.Random(seed * 1000 + cells)
+        self.keys = (
+            tuple(rng.getrandbits(64) for _ in range(cells)),
+            tuple(rng.getrandbits(64) for _ in range(cells)),
+        )
+        self.side = rng.getrandbits(64)
+
+    @classmethod
+    def get(cls, cells: int) -> "Zobrist":
+        zobrist = cls._cache.get(cells)
+        if zobrist is None:
+            zobrist = cls._cache[cells] = cls(cells)
+        return zobrist
+
+    def hash(self, x: int, o: int) -> int:
+        """
+        Hash of a position; the side to move follows from the masks.
+        """
+        value = 0
+        for player, mask in enumerate((x, o)):
+            keys = self.keys[player]
+            while mask:
+                bit = mask & -mask
+                value ^= keys[bit.bit_length() - 1]
+                mask ^= bit
+        if x.bit_count() != o.bit_count():
+            value ^= self.side
+        return value
+
+
+class TranspositionTable:
+    """
+    Fixed-size transposition table indexed by the low bits of the Zobrist
+    hash. A slot keeps the deeper of two colliding entries.
+
+    Parameters
+    ----------
+    size_bits : int
+        The table holds 2 ** size_bits entries.
+    """
+
+    def __init__(self, size_bits: int = 18) -> None:
+        self.mask = (1 << size_bits) - 1
+        # slot -> (hash, depth, score, flag, move) or None
+        self.slots: list[tuple | None] = [None] * (1 << size_bits)
+        self.hits = 0
+        self.stores = 0
+
+    def probe(self, key: int) -> tuple | None:
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key: int, depth: int, score: int, flag: int,
+              move: int | None) -> None:
+        slot = key & self.mask
+        entry = self.slots[slot]
+        if entry is None or entry[0] == key or entry[1] <= depth:
+            self.slots[slot] = (key, depth, score, flag, move)
+            self.stores += 1
+
+    def clear(self) -> None:
+        self.slots = [None] * (self.mask + 1)
+
+
+class AlphaBetaEngine:
+    """
+    Iterative-deepening negamax with alpha-beta pruning and a shared
+    transposition table.
+
+    Moves are limited to free cells next to existing stones and ordered
+    by Geometry.cell_score(), keeping the best `beam` of them. A move that
+    wins at once is played; if the opponent threatens to win, only the
+    blocking cells are searched.
+
+    Parameters
+    ----------
+    tt_bits : int
+        Transposition table size, 2 ** tt_bits entries.
+    beam : int
+        Maximum number of moves searched in one position.
+    max_depth : int
+        Deepest iteration.
+    """
+
+    def __init__(self, tt_bits: int = 18, beam: int = 10,
+                 max_depth: int = 20) -> None:
+        self.table = TranspositionTable(tt_bits)
+        self.beam = beam
+        self.max_depth = max_depth
+
+    def search(self, size: int, k: int, x: int, o: int,
+               time_limit: float = 0.5,
+               node_limit: int = 0) -> SearchResult:
+        """
+        Searches a position until the time or node budget runs out.
+
+        Parameters
+        ----------
+        size, k : int
+            Board variant.
+        x, o : int
+            Masks of CROSS and ZERO.
+        time_limit : float
+            Seconds for the whole search; 0 means no limit.
+        node_limit : int
+            Maximum number of nodes; 0 means no limit.
+
+        Returns
+        -------
+        SearchResult
+            Best move of the deepest completed iteration.
+        """
+        run = _AlphaBetaRun(self, size, k, time_limit, node_limit)
+        return run.search(x, o)
+
+
+class _AlphaBetaRun:
+    def __init__(self, engine: AlphaBetaEngine, size: int, k: int,
+                 time_limit: float, node_limit: int) -> None:
+        self.engine = engine
+        self.table = engine.table
+        self.geometry = Geometry.get(size, k)
+        self.zobrist = Zobrist.get(size * size)
+        self.started = time.perf_counter()
+        self.deadline = self.started + time_limit if time_limit else 0.0
+        self.node_limit = node_limit
+        self.nodes = 0
+
+    def search(self, x: int, o: int) -> SearchResult:
+        me, other = side_to_move(x, o)
+        key = self.zobrist.hash(x, o)
+        color = 0 if me is x else 1
+        moves = self._moves(me, other, None)
+        if not moves:
+            return SearchResult(None, 0, 0, 0, 0.0)
+
+        best = SearchResult(moves[0], 0, 0, 0, 0.0)
+        if len(moves) == 1:
+            return best._replace(elapsed=time.perf_counter() - self.started)
+
+        for depth in range(1, self.engine.max_depth + 1):
+            try:
+                score, move = self._root(me, other, key, color, depth)
+            except _Timeout:
+                break
+            best = SearchResult(move, score, depth, self.nodes, 0.0)
+            if abs(score) >= WIN_SCORE - self.geometry.cells:
+                break
+        return best._replace(nodes=self.nodes,
+                             elapsed=time.perf_counter() - self.started)
+
+    def _root(self, me: int, other: int, key: int, color: int,
+              depth: int) -> tuple[int, int]:
+        return self._negamax(me, other, key, color, depth,
+                             -_INFINITY, _INFINITY, 0, root=True)
+
+    def _moves(self, me: int, other: int, tt_move: int | None) -> list[int]:
+        geometry = self.geometry
+        candidates = geometry.candidates(me, other)
+        scored = []
+        blocks = []
+        while candidates:
+            bit = candidates & -candidates
+            candidates ^= bit
+            index = bit.bit_length() - 1
+            if geometry.wins(index, me | bit):
+                return [index]
+            if geometry.wins(index, other | bit):
+                blocks.append(index)
+            scored.append((geometry.cell_score(index, me, other), index))
+        if blocks:
+            return blocks
+        scored.sort(reverse=True)
+        moves = [index for _, index in scored[:self.engine.beam]]
+        if tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    def _negamax(self, me: int, other: int, key: int, color: int,
+                 depth: int, alpha: int, beta: int, ply: int,
+                 root: bool = False):
+        self.nodes += 1
+        if self.nodes & 255 == 0:
+            if self.deadline and time.perf_counter() > self.deadline:
+                raise _Timeout
+        if self.node_limit and self.nodes > self.node_limit:
+            raise _Timeout
+
+        if not self.geometry.full & ~(me | other):
+            return (0, None) if root else 0
+        if depth == 0:
+            return self.geometry.evaluate(me, other)
+
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            tt_move = entry[4]
+            if not root and entry[1] >= depth:
+                score, flag = entry[2], entry[3]
+                if flag == _EXACT:
+                    return score
+                if flag == _LOWER:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        keys = self.zobrist.keys[color]
+        side = self.zobrist.side
+        best_score, best_move = -_INFINITY, None
+        for index in self._moves(me, other, tt_move):
+            bit = 1 << index
+            if self.geometry.wins(index, me | bit):
+                score = WIN_SCORE - ply
+            else:
+                score = -self._negamax(other, me | bit,
+                                       key ^ keys[index] ^ side, 1 - color,
+                                       depth - 1, -beta, -alpha, ply + 1)
+            if score > best_score:
+                best_score, best_move = score, index
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= alpha_orig:
+            flag = _UPPER
+        elif best_score >= beta:
+            flag = _LOWER
+        else:
+            flag = _EXACT
+        self.table.store(key, depth, best_score, flag, best_move)
+        return (best_score, best_move) if root else best_score
+
+
+class _MCTSNode:
+    __slots__ = ("move", "parent", "children", "untried", "visits", "wins")
+
+    def __init__(self, move: int | None, parent: "_MCTSNode | None",
+                 untried: list[int]) -> None:
+        self.move = move
+        self.parent = parent
+        self.children: list[_MCTSNode] = []
+        self.untried = untried
+        self.visits = 0
+        # Wins of the player who made `move`.
+        self.wins = 0.0
+
+
+class MCTSEngine:
+    """
+    Monte Carlo tree search with UCT selection and random playouts among
+    cells next to existing stones.
+
+    Parameters
+    ----------
+    exploration : float
+        UCT exploration constant.
+    playout_depth : int
+        Playouts stop as a draw after this many moves.
+    """
+
+    def __init__(self, exploration: float = 1.4,
+                 playout_depth: int = 40) -> None:
+        self.exploration = exploration
+        self.playout_depth = playout_depth
+
+    def search(self, size: int, k: int, x: int, o: int,
+               time_limit: float = 0.5,
+               node_limit: int = 0) -> SearchResult:
+        """
+        Runs playouts until the time or playout budget runs out.
+        Parameters are the same as in AlphaBetaEngine.search().
+        """
+        geometry = Geometry.get(size, k)
+        started = time.perf_counter()
+        deadline = started + time_limit if time_limit else 0.0
+        rng = random.Random()
+        me, other = side_to_move(x, o)
+
+        forced = heuristic_move(size, k, x, o)
+        if forced is None:
+            return SearchResult(None, 0, 0, 0, 0.0)
+        bit = 1 << forced
+        if geometry.wins(forced, me | bit) or \
+                geometry.wins(forced, other | bit):
+            return SearchResult(forced, 0, 0, 0,
+                                time.perf_counter() - started)
+
+        root = _MCTSNode(None, None, self._moves(geometry, me, other))
+        playouts = 0
+        while True:
+            if node_limit and playouts >= node_limit:
+                break
+            if deadline and playouts & 15 == 0 \
+                    and time.perf_counter() > deadline:
+                break
+            self._iterate(geometry, root, me, other, rng)
+            playouts += 1
+
+        if not root.children:
+            return SearchResult(forced, 0, 0, playouts,
+                                time.perf_counter() - started)
+        best = max(root.children, key=lambda child: child.visits)
+        score = int(1000 * best.wins / best.visits) if best.visits else 0
+        return SearchResult(best.move, score, 0, playouts,
+                            time.perf_counter() - started)
+
+    @staticmethod
+    def _moves(geometry: Geometry, me: int, other: int) -> list[int]:
+        candidates = geometry.candidates(me, other)
+        moves = []
+        while candidates:
+            bit = candidates & -candidates
+            candidates ^= bit
+            moves.append(bit.bit_length() - 1)
+        return moves
+
+    def _iterate(self, geometry: Geometry, root: _MCTSNode, me: int,
+                 other: int, rng: random.Random) -> None:
+        node = root
+        winner_is_mover = None
+        # Selection.
+        while not node.untried and node.children:
+            log_visits = math.log(node.visits)
+            node = max(
+                node.children,
+                key=lambda child: child.wins / child.visits
+                + self.exploration * math.sqrt(log_visits / child.visits)
+            )
+            me, other = other, me | (1 << node.move)
+        # Expansion.
+        if node.untried and (node.move is None or not geometry.wins(
+                node.move, other)):
+            move = node.untried.pop(rng.randrange(len(node.untried)))
+            bit = 1 << move
+            me, other = other, me | bit
+            child = _MCTSNode(move, node, [] if geometry.wins(move, other)
+                              else self._moves(geometry, me, other))
+            node.children.append(child)
+            node = child
+
+        # Playout from the position after node.move; `other` just moved.
+        if node.move is not None and geometry.wins(node.move, other):
+            winner_is_mover = True
+        else:
+            mover_turn = False
+            for _ in range(self.playout_depth):
+                candidates = self._moves(geometry, me, other)
+                if not candidates:
+                    break
+                move = rng.choice(candidates)
+                bit = 1 << move
+                me |= bit
+                if geometry.wins(move, me):
+                    winner_is_mover = mover_turn
+                    break
+                me, other = other, me
+                mover_turn = not mover_turn
+
+        # Backpropagation: the result alternates between levels.
+        while node is not None:
+            node.visits += 1
+            if winner_is_mover is None:
+                node.wins += 0.5
+            elif winner_is_mover:
+                node.wins += 1
+            winner_is_mover = None if winner_is_mover is None \
+                else not winner_is_mover
+            node = node.parent
+
+
+_engines: dict[str, AlphaBetaEngine | MCTSEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name: str) -> AlphaBetaEngine | MCTSEngine:
+    """
+    Returns a shared engine instance.
+
+    Parameters
+    ----------
+    name : str
+        "alphabeta" or "mcts".
+
+    Returns
+    -------
+    AlphaBetaEngine or MCTSEngine
+        The engine; its transposition table persists between searches.
+    """
+    with _engines_lock:
+        engine = _engines.get(name)
+        if engine is None:
+            if name == "mcts":
+                engine = MCTSEngine()
+            elif name == "alphabeta":
+                engine = AlphaBetaEngine()
+            else:
+                raise ValueError(f"Unknown AI engine: {name}")
+            _engines[name] = engine
+        return engine
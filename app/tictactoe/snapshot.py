@@ -0,0 +1,161 @@
+"""
+Snapshot of live games across restarts.
+
+On shutdown every game in the store is written to one file, and the next
+process restores the games before it handles any update, so a restart
+loses no game mid-move.
+
+File layout: the 5-byte header b"TTTS" + version, then a zlib stream of
+records. A record is a fixed 16-byte header (see RECORD_HEADER) followed
+by the game serialized with storage.dump_game(), UTF-8 encoded.
+"""
+import logging
+import os
+import struct
+import zlib
+from typing import Any, Iterator
+
+from tictactoe.storage import (
+    GameKey,
+    GameStore,
+    ShardedGameStore,
+    dump_game,
+    load_game
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = "game_snapshot"
+
+MAGIC = b"TTTS\x02"
+# chat id, board message id, length of the game.
+RECORD_HEADER = struct.Struct("<qqI")
+
+Entry = tuple[GameKey, dict[str, Any]]
+
+
+def pack_snapshot(entries: list[Entry]) -> bytes:
+    """
+    Packs games in the snapshot format.
+
+    Parameters
+    ----------
+    entries : list[Entry]
+        (key, game) of every game.
+
+    Returns
+    -------
+    bytes
+        The snapshot file contents.
+    """
+    parts = []
+    for (chat_id, game_id), game in entries:
+        raw = dump_game(game).encode()
+        parts.append(RECORD_HEADER.pack(chat_id, game_id, len(raw)))
+        parts.append(raw)
+    # Level 1: the snapshot is written while the bot is down.
+    return MAGIC + zlib.compress(b"".join(parts), 1)
+
+
+def unpack_snapshot(data: bytes) -> Iterator[Entry]:
+    """
+    Reads the entries of a snapshot packed with pack_snapshot().
+
+    Parameters
+    ----------
+    data : bytes
+        The snapshot file contents.
+
+    Yields
+    ------
+    Entry
+        (key, game) in the order they were packed.
+
+    Raises
+    ------
+    ValueError
+        If the data is not a snapshot of this version.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a game snapshot")
+    body = zlib.decompress(data[len(MAGIC):])
+    offset = 0
+    while offset < len(body):
+        chat_id, game_id, length = RECORD_HEADER.unpack_from(body, offset)
+        offset += RECORD_HEADER.size
+        game = load_game(body[offset:offset + length].decode())
+        offset += length
+        yield (chat_id, game_id), game
+
+
+class GameSnapshot:
+    """
+    Saves and restores the games of a store.
+
+    Parameters
+    ----------
+    path : str
+        Snapshot file. It is removed once restored, so a crash later on
+        does not bring back stale games.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def save(self, store: GameStore | ShardedGameStore) -> int:
+        """
+        Writes the snapshot atomically.
+
+        Parameters
+        ----------
+        store : GameStore or ShardedGameStore
+            Store with the live games.
+
+        Returns
+        -------
+        int
+            Number of saved games.
+        """
+        entries = store.items()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(pack_snapshot(entries))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info("Saved %d games to %s", len(entries), self.path)
+        return len(entries)
+
+    def restore(self, store: GameStore | ShardedGameStore) -> int:
+        """
+        Loads the snapshot, if there is one, into the store, then removes
+        the file. A snapshot of another version, truncated or corrupt, is
+        skipped as a whole and the bot starts with no games.
+
+        Parameters
+        ----------
+        store : GameStore or ShardedGameStore
+            Store to put the games into.
+
+        Returns
+        -------
+        int
+            Number of restored games.
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return 0
+
+        try:
+            entries = list(unpack_snapshot(data))
+        except (ValueError, zlib.error, struct.error,
+                UnicodeDecodeError) as exc:
+            logger.warning("Snapshot %s skipped: %s", self.path, exc)
+            entries = []
+        for key, game in entries:
+            store.put(key, game)
+        os.remove(self.path)
+        logger.info("Restored %d games from %s", len(entries), self.path)
+        return len(entries)
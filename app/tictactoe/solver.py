@@ -0,0 +1,158 @@
+from array import array
+
+from tictactoe.board import FULL_MASK, has_line
+
+# Game-theoretic value of a position for the side to move.
+LOSS, DRAW, WIN = 0, 1, 2
+
+POSITIONS_COUNT = 3 ** 9
+_MOVES_BITS = 9
+_MOVES_MASK = (1 << _MOVES_BITS) - 1
+_UNREACHABLE = 0xFFFF
+
+# _TERNARY[mask] is the base-3 weight of the cells set in a 9-bit mask,
+# so a position (x_mask, o_mask) encodes as _TERNARY[x] + 2 * _TERNARY[o].
+_TERNARY = tuple(
+    sum(3 ** i for i in range(9) if mask >> i & 1)
+    for mask in range(1 << 9)
+)
+
+_table: array | None = None
+
+
+def encode(x_mask: int, o_mask: int) -> int:
+    """
+    Encodes a position as a base-3 number (0 - free, 1 - X, 2 - O).
+
+    Parameters
+    ----------
+    x_mask : int
+        9-bit mask of cells taken by X.
+    o_mask : int
+        9-bit mask of cells taken by O.
+
+    Returns
+    -------
+    int
+        Index of the position in the move table.
+    """
+    return _TERNARY[x_mask] + 2 * _TERNARY[o_mask]
+
+
+def _build_table() -> array:
+    """
+    Solves every position reachable from the empty board.
+
+    Each reachable position gets a 16-bit entry: the low 9 bits are the
+    mask of optimal moves for the side to move, the next 2 bits are the
+    game-theoretic value (LOSS / DRAW / WIN). Terminal positions have an
+    empty move mask. Unreachable positions keep _UNREACHABLE.
+
+    Returns
+    -------
+    array
+        Table of POSITIONS_COUNT unsigned shorts indexed by encode().
+    """
+    table = array("H", [_UNREACHABLE]) * POSITIONS_COUNT
+
+    def solve(me: int, other: int) -> int:
+        # `me` is the side to move, `other` has just moved.
+        key = encode(me, other) if (me | other).bit_count() % 2 == 0 \
+            else encode(other, me)
+        entry = table[key]
+        if entry != _UNREACHABLE:
+            return entry >> _MOVES_BITS
+
+        if has_line(other):
+            value, best = LOSS, 0
+        elif me | other == FULL_MASK:
+            value, best = DRAW, 0
+        else:
+            value, best = -1, 0
+            free = FULL_MASK & ~(me | other)
+            while free:
+                bit = free & -free
+                free ^= bit
+                child = 2 - solve(other, me | bit)
+                if child > value:
+                    value, best = child, bit
+                elif child == value:
+                    best |= bit
+
+        table[key] = value << _MOVES_BITS | best
+        return value
+
+    solve(0, 0)
+    return table
+
+
+def get_table() -> array:
+    """
+    Returns the perfect-play move table, building it on first use.
+
+    Returns
+    -------
+    array
+        Table described in _build_table().
+    """
+    global _table
+    if _table is None:
+        _table = _build_table()
+    return _table
+
+
+def reachable_count() -> int:
+    """
+    Returns the number of positions reachable from the empty board.
+
+    Returns
+    -------
+    int
+        Number of solved entries in the table (5478 for 3x3).
+    """
+    return sum(1 for entry in get_table() if entry != _UNREACHABLE)
+
+
+def reachable_positions():
+    """
+    Iterates over all positions reachable from the empty board.
+
+    Yields
+    ------
+    tuple[int, int]
+        (x_mask, o_mask) of each position.
+    """
+    for code, entry in enumerate(get_table()):
+        if entry == _UNREACHABLE:
+            continue
+        x_mask = o_mask = 0
+        for i in range(9):
+            code, digit = divmod(code, 3)
+            if digit == 1:
+                x_mask |= 1 << i
+            elif digit == 2:
+                o_mask |= 1 << i
+        yield x_mask, o_mask
+
+
+def lookup(x_mask: int, o_mask: int) -> tuple[int, int] | None:
+    """
+    Looks up a position in the move table.
+
+    Parameters
+    ----------
+    x_mask : int
+        9-bit mask of cells taken by X.
+    o_mask : int
+        9-bit mask of cells taken by O.
+
+    Returns
+    -------
+    tuple[int, int] or None
+        (value, moves_mask) for the side to move, or None if the position
+        cannot occur in a legal game.
+    """
+    entry = get_table()[encode(x_mask, o_mask)]
+    if entry == _UNREACHABLE:
+        return None
+    return entry >> _MOVES_BITS, entry & _MOVES_MASK
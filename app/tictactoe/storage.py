@@ -0,0 +1,649 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from tictactoe.board import Board, GridBoard
+
+logger = logging.getLogger(__name__)
+
+STORE_KEY = "game_store"
+
+# A game is keyed by its chat and the id of its board message, so a chat
+# can have any number of games and a board click finds its game directly.
+GameKey = tuple[int, int]
+# Game id of games kept one per chat by earlier versions that have no
+# board message yet: multiplayer games waiting for their second player.
+LEGACY_GAME_ID = 0
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """
+    Returns the shard that owns a chat.
+
+    Parameters
+    ----------
+    chat_id : int
+        Telegram chat id.
+    shards : int
+        Total number of shards.
+
+    Returns
+    -------
+    int
+        Shard index in range(shards).
+    """
+    return chat_id % shards
+
+
+def dump_game(game: dict[str, Any]) -> str:
+    """
+    Serializes a game to a compact JSON string.
+
+    Parameters
+    ----------
+    game : dict[str, Any]
+        Game data as used by the handlers.
+
+    Returns
+    -------
+    str
+        JSON with the board stored as [x, o] on 3x3 and as
+        [x, o, size, k] on larger boards.
+    """
+    data = dict(game)
+    board = data.pop("board")
+    if board.size == 3:
+        data["board"] = [board.x, board.o]
+    else:
+        data["board"] = [board.x, board.o, board.size, board.k]
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_game(raw: str) -> dict[str, Any]:
+    """
+    Restores a game serialized with dump_game().
+
+    Parameters
+    ----------
+    raw : str
+        JSON produced by dump_game().
+
+    Returns
+    -------
+    dict[str, Any]
+        Game data with a Board or GridBoard instance.
+    """
+    data = json.loads(raw)
+    board = data["board"]
+    if len(board) == 2:
+        data["board"] = Board(*board)
+    else:
+        data["board"] = GridBoard(board[2], board[3], board[0], board[1])
+    return data
+
+
+class GameStore:
+    """
+    Game state store with write-behind batching.
+
+    Games are kept in memory and every change only marks the game as dirty.
+    Dirty games are written to the backend in one batch by flush(), which
+    runs every `flush_interval` seconds once start() is called. Subclasses
+    implement the backend methods _load, _load_chat, _write and _close.
+
+    Games in memory are kept in order of last activity (get or put), so
+    expire() finds idle games from the front without scanning them all.
+    """
+
+    def __init__(self, flush_interval: float = 1.0) -> None:
+        self.flush_interval = flush_interval
+        self._games: OrderedDict[GameKey, dict[str, Any]] = OrderedDict()
+        self._seen: dict[GameKey, float] = {}
+        # chat id -> id of its game in memory, or a list of ids once it
+        # has several: most chats have one game, and a bare int is the
+        # smallest way to index it.
+        self._chats: dict[int, int | list[int]] = {}
+        self._dirty: set[GameKey] = set()
+        self._deleted: set[GameKey] = set()
+        self._task: asyncio.Task | None = None
+        # One batch is written at a time, by the flush loop or write().
+        self._write_lock = asyncio.Lock()
+
+    def get(self, key: GameKey) -> dict[str, Any] | None:
+        """
+        Returns a game, loading it from the backend on a miss.
+
+        Parameters
+        ----------
+        key : GameKey
+            (chat id, board message id).
+
+        Returns
+        -------
+        dict[str, Any] or None
+            Game data or None if there is no such game.
+        """
+        game = self._games.get(key)
+        if game is None and key not in self._deleted:
+            raw = self._load(key)
+            if raw is not None:
+                game = self._games[key] = load_game(raw)
+                self._index(key)
+        if game is not None:
+            self._games.move_to_end(key)
+            self._seen[key] = time.monotonic()
+        return game
+
+    def put(self, key: GameKey, game: dict[str, Any]) -> None:
+        """
+        Stores a game. Call it again after changing the game in place.
+
+        Parameters
+        ----------
+        key : GameKey
+            (chat id, board message id).
+        game : dict[str, Any]
+            Game data.
+        """
+        if key not in self._games:
+            self._index(key)
+        self._games[key] = game
+        self._games.move_to_end(key)
+        self._seen[key] = time.monotonic()
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def delete(self, key: GameKey) -> None:
+        """
+        Removes a game.
+
+        Parameters
+        ----------
+        key : GameKey
+            (chat id, board message id).
+        """
+        if self._games.pop(key, None) is not None:
+            self._unindex(key)
+        self._seen.pop(key, None)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def games_of(self, chat_id: int) -> list[int]:
+        """
+        Returns the ids of the games of a chat, oldest first. Unlike
+        get(), it queries the backend, so it is meant for commands such
+        as /join and /end rather than for board clicks.
+
+        Parameters
+        ----------
+        chat_id : int
+            Telegram chat id.
+
+        Returns
+        -------
+        list[int]
+            Board message ids.
+        """
+        ids = self._chats.get(chat_id, ())
+        ids = {ids} if isinstance(ids, int) else set(ids)
+        ids.update(self._load_chat(chat_id))
+        return sorted(game_id for game_id in ids
+                      if (chat_id, game_id) not in self._deleted)
+
+    def _index(self, key: GameKey) -> None:
+        chat_id, game_id = key
+        ids = self._chats.get(chat_id)
+        if ids is None:
+            self._chats[chat_id] = game_id
+        elif isinstance(ids, int):
+            self._chats[chat_id] = [ids, game_id]
+        else:
+            ids.append(game_id)
+
+    def _unindex(self, key: GameKey) -> None:
+        chat_id, game_id = key
+        ids = self._chats[chat_id]
+        if isinstance(ids, int):
+            del self._chats[chat_id]
+            return
+        ids.remove(game_id)
+        if len(ids) == 1:
+            self._chats[chat_id] = ids[0]
+
+    def expire(self, ttl: float,
+               max_games: int = 0) -> list[tuple[GameKey, dict[str, Any]]]:
+        """
+        Deletes games idle for `ttl` seconds or more, then the least
+        recently active games while more than `max_games` are left.
+
+        Parameters
+        ----------
+        ttl : float
+            Idle time in seconds; 0 disables the check.
+        max_games : int
+            Maximum number of games in memory; 0 means no limit.
+
+        Returns
+        -------
+        list[tuple[GameKey, dict[str, Any]]]
+            (key, game) of every deleted game.
+        """
+        expired = []
+        deadline = time.monotonic() - ttl
+        while self._games:
+            key = next(iter(self._games))
+            idle = ttl and self._seen[key] <= deadline
+            if not idle and not 0 < max_games < len(self._games):
+                break
+            expired.append((key, self._games[key]))
+            self.delete(key)
+        return expired
+
+    def items(self) -> list[tuple[GameKey, dict[str, Any]]]:
+        """
+        Returns the games in memory.
+
+        Returns
+        -------
+        list[tuple[GameKey, dict[str, Any]]]
+            (key, game), least recently active first.
+        """
+        return list(self._games.items())
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    async def take(
+        self, moves: Callable[[int], bool]
+    ) -> list[tuple[GameKey, dict[str, Any]]]:
+        """
+        Removes the games of the chats another process takes over, from
+        memory and from the backend, and returns them. Games kept only in
+        the backend are included. The deletes are written before it
+        returns, so they cannot overwrite the games once the new owner
+        stores them in a shared backend.
+
+        Parameters
+        ----------
+        moves : Callable[[int], bool]
+            Tells whether a chat id moves.
+
+        Returns
+        -------
+        list[tuple[GameKey, dict[str, Any]]]
+            (key, game) of every removed game.
+        """
+        keys = set(self._games)
+        keys.update(key for key in self._load_keys()
+                    if key not in self._deleted)
+        taken = []
+        for key in sorted(keys):
+            if moves(key[0]):
+                game = self.get(key)
+                if game is not None:
+                    taken.append((key, game))
+                    self.delete(key)
+        await self.write()
+        return taken
+
+    async def write(self) -> None:
+        """
+        Writes all pending changes to the backend now, in a worker thread.
+        """
+        async with self._write_lock:
+            writes, deletes = self._take_batch()
+            if writes or deletes:
+                await asyncio.to_thread(self._write, writes, deletes)
+                self._deleted -= deletes
+
+    def _take_batch(self) -> tuple[dict[GameKey, str], set[GameKey]]:
+        # Serialization happens here, in the event loop thread, so the
+        # backend never sees a game that a handler is changing. Deleted
+        # games stay in _deleted until the batch is written, so get()
+        # does not load them back from the backend meanwhile.
+        writes = {key: dump_game(self._games[key]) for key in self._dirty}
+        self._dirty = set()
+        return writes, set(self._deleted)
+
+    def flush(self) -> None:
+        """
+        Writes all pending changes to the backend.
+        """
+        writes, deletes = self._take_batch()
+        if writes or deletes:
+            self._write(writes, deletes)
+            self._deleted -= deletes
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            async with self._write_lock:
+                writes, deletes = self._take_batch()
+                if not (writes or deletes):
+                    continue
+                try:
+                    await asyncio.to_thread(self._write, writes, deletes)
+                except Exception as exc:
+                    logger.warning("Game store flush failed: %s", exc)
+                    self._dirty |= writes.keys() & self._games.keys()
+                else:
+                    self._deleted -= deletes
+
+    async def start(self) -> None:
+        """
+        Starts the periodic background flush.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flush and writes the remaining changes.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        self._close()
+
+    def _load(self, key: GameKey) -> str | None:
+        return None
+
+    def _load_chat(self, chat_id: int) -> list[int]:
+        return []
+
+    def _load_keys(self) -> list[GameKey]:
+        return []
+
+    def _write(self, writes: dict[GameKey, str],
+               deletes: set[GameKey]) -> None:
+        pass
+
+    def _close(self) -> None:
+        pass
+
+
+class MemoryGameStore(GameStore):
+    """
+    Store without persistence: games live only in the process memory.
+    """
+
+
+class SQLiteGameStore(GameStore):
+    """
+    Store backed by a SQLite database file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the database file.
+    flush_interval : float
+        Seconds between batched writes.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0) -> None:
+        super().__init__(flush_interval)
+        self.path = path
+        # Loaded here: the default memory store does not need sqlite3.
+        import sqlite3
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Earlier versions kept one game per chat; such games move under
+        # the id of their board message, or LEGACY_GAME_ID without one.
+        legacy = [row[1] for row in self._conn.execute(
+            "PRAGMA table_info(games)"
+        )] == ["chat_id", "data"]
+        with self._conn:
+            if legacy:
+                self._conn.execute(
+                    "ALTER TABLE games RENAME TO games_by_chat"
+                )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS games ("
+                "chat_id INTEGER NOT NULL, game_id INTEGER NOT NULL, "
+                "data TEXT NOT NULL, PRIMARY KEY (chat_id, game_id))"
+            )
+            if legacy:
+                self._conn.execute(
+                    "INSERT INTO games SELECT chat_id, "
+                    "COALESCE(json_extract(data, '$.message_id'), ?), data "
+                    "FROM games_by_chat", (LEGACY_GAME_ID,)
+                )
+                boardless = self._conn.execute(
+                    "SELECT COUNT(*) FROM games WHERE game_id = ?",
+                    (LEGACY_GAME_ID,)
+                ).fetchone()[0]
+                self._conn.execute("DROP TABLE games_by_chat")
+                logger.info("Moved games kept per chat to %s, %d of them "
+                            "without a board message", path, boardless)
+        # get() runs on the event loop and _write() in a worker thread;
+        # with WAL a second connection reads committed games without
+        # waiting for a batch commit on the first one.
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.execute("PRAGMA query_only=ON")
+
+    def _load(self, key: GameKey) -> str | None:
+        row = self._reader.execute(
+            "SELECT data FROM games WHERE chat_id = ? AND game_id = ?", key
+        ).fetchone()
+        return row[0] if row else None
+
+    def _load_chat(self, chat_id: int) -> list[int]:
+        return [row[0] for row in self._reader.execute(
+            "SELECT game_id FROM games WHERE chat_id = ?", (chat_id,)
+        )]
+
+    def _load_keys(self) -> list[GameKey]:
+        return [tuple(row) for row in self._reader.execute(
+            "SELECT chat_id, game_id FROM games"
+        )]
+
+    def _write(self, writes: dict[GameKey, str],
+               deletes: set[GameKey]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO games (chat_id, game_id, data) "
+                "VALUES (?, ?, ?)",
+                (key + (raw,) for key, raw in writes.items())
+            )
+            self._conn.executemany(
+                "DELETE FROM games WHERE chat_id = ? AND game_id = ?",
+                deletes
+            )
+
+    def _close(self) -> None:
+        self._reader.close()
+        self._conn.close()
+
+
+class FileGameStore(GameStore):
+    """
+    Store backed by a single JSON file, a local stand-in for tests.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file.
+    flush_interval : float
+        Seconds between batched writes.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0) -> None:
+        super().__init__(flush_interval)
+        self.path = path
+
+    def _read_all(self) -> dict[str, str]:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _name(key: GameKey) -> str:
+        return f"{key[0]}:{key[1]}"
+
+    def _load(self, key: GameKey) -> str | None:
+        return self._read_all().get(self._name(key))
+
+    def _load_chat(self, chat_id: int) -> list[int]:
+        prefix = f"{chat_id}:"
+        return [int(name[len(prefix):]) for name in self._read_all()
+                if name.startswith(prefix)]
+
+    def _load_keys(self) -> list[GameKey]:
+        return [tuple(map(int, name.split(":")))
+                for name in self._read_all()]
+
+    def _write(self, writes: dict[GameKey, str],
+               deletes: set[GameKey]) -> None:
+        data = self._read_all()
+        for key, raw in writes.items():
+            data[self._name(key)] = raw
+        for key in deletes:
+            data.pop(self._name(key), None)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class ShardedGameStore:
+    """
+    Routes games to several stores by shard_of() of their chat.
+
+    Each shard is an independent store (e.g. its own SQLite file), so
+    worker processes that serve different shards never contend for the
+    same database lock.
+
+    Parameters
+    ----------
+    shards : list[GameStore]
+        One store per shard.
+    """
+
+    def __init__(self, shards: list[GameStore]) -> None:
+        self.shards = shards
+
+    def shard(self, chat_id: int) -> GameStore:
+        return self.shards[shard_of(chat_id, len(self.shards))]
+
+    def get(self, key: GameKey) -> dict[str, Any] | None:
+        return self.shard(key[0]).get(key)
+
+    def put(self, key: GameKey, game: dict[str, Any]) -> None:
+        self.shard(key[0]).put(key, game)
+
+    def delete(self, key: GameKey) -> None:
+        self.shard(key[0]).delete(key)
+
+    def games_of(self, chat_id: int) -> list[int]:
+        return self.shard(chat_id).games_of(chat_id)
+
+    def items(self) -> list[tuple[GameKey, dict[str, Any]]]:
+        return [item for store in self.shards for item in store.items()]
+
+    async def take(
+        self, moves: Callable[[int], bool]
+    ) -> list[tuple[GameKey, dict[str, Any]]]:
+        taken = []
+        for store in self.shards:
+            taken.extend(await store.take(moves))
+        return taken
+
+    async def write(self) -> None:
+        for store in self.shards:
+            await store.write()
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self.shards)
+
+    def expire(self, ttl: float,
+               max_games: int = 0) -> list[tuple[GameKey, dict[str, Any]]]:
+        # The cap is split evenly between the shards.
+        per_shard = -(-max_games // len(self.shards))
+        expired = []
+        for store in self.shards:
+            expired.extend(store.expire(ttl, per_shard))
+        return expired
+
+    def flush(self) -> None:
+        for store in self.shards:
+            store.flush()
+
+    async def start(self) -> None:
+        for store in self.shards:
+            await store.start()
+
+    async def stop(self) -> None:
+        for store in self.shards:
+            await store.stop()
+
+
+def create_store(url: str, shards: int = 1,
+                 flush_interval: float = 1.0) -> GameStore | ShardedGameStore:
+    """
+    Creates a store from a URL-like description.
+
+    Parameters
+    ----------
+    url : str
+        "memory", "sqlite:<path>" or "file:<path>". The path may contain
+        "{shard}", which is replaced with the shard index.
+    shards : int
+        Number of shards. With more than one shard a ShardedGameStore
+        is returned.
+    flush_interval : float
+        Seconds between batched writes.
+
+    Returns
+    -------
+    GameStore or ShardedGameStore
+        The configured store.
+    """
+    scheme, _, path = url.partition(":")
+    backends = {
+        "sqlite": SQLiteGameStore,
+        "file": FileGameStore,
+    }
+    if scheme == "memory":
+        return MemoryGameStore(flush_interval)
+    if scheme not in backends:
+        raise ValueError(f"Unknown game store: {url}")
+    if shards == 1:
+        return backends[scheme](path.format(shard=0), flush_interval)
+    return ShardedGameStore([
+        backends[scheme](path.format(shard=shard), flush_interval)
+        for shard in range(shards)
+    ])
+
+
+def get_store(context: Any) -> GameStore | ShardedGameStore:
+    """
+    Returns the store of the application, creating an in-memory one
+    if none was configured.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The context object.
+
+    Returns
+    -------
+    GameStore or ShardedGameStore
+        The game store.
+    """
+    store = context.bot_data.get(STORE_KEY)
+    if store is None:
+        store = context.bot_data[STORE_KEY] = MemoryGameStore()
+    return store
@@ -0,0 +1,721 @@
+"""
+Supervisor mode: one webhook ingress in front of several bot processes.
+
+The supervisor receives Telegram updates on the webhook and forwards each
+one over HTTP to a worker process chosen by a consistent hash of the chat
+id, so all games of a chat live in one worker. Updates of the lobby (the
+/queue commands, tournaments and clicks on their boards, see lobby.py)
+all go to the lowest worker instead. Workers run the usual Application
+and read updates from a small local HTTP endpoint instead of registering
+a webhook of their own.
+
+Signals of the supervisor process:
+
+- SIGTERM, SIGINT: drain and stop every worker, then exit;
+- SIGHUP: restart the workers one by one without dropping updates;
+- SIGTTIN, SIGTTOU: add or remove a worker; the ring moves only the
+  chats of that worker, and their games move with them.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+from bisect import bisect
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application as WebApplication, RequestHandler
+
+from tictactoe.constants import (
+    AI_WORKERS,
+    GAME_SNAPSHOT,
+    GAME_STORE,
+    LOBBY_CHAT,
+    LOBBY_COMMANDS,
+    MATCH_CALLBACK,
+    METRICS_PORT,
+    RATING_STORE,
+    REPLAY_LOG,
+    TELEGRAM_API_URL,
+    TOKEN
+)
+from tictactoe.snapshot import pack_snapshot, unpack_snapshot
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Updates whose chat is in a "chat" field of the named object.
+_CHAT_UPDATES = ("message", "edited_message", "channel_post",
+                 "edited_channel_post", "my_chat_member", "chat_member",
+                 "chat_join_request")
+
+# Seconds a new worker gets to start listening, and the longest pause
+# between restarts of a worker that keeps crashing.
+READY_TIMEOUT = 60.0
+MAX_RESTART_DELAY = 30.0
+
+
+def _hash(value: str) -> int:
+    # hash() of a str differs between processes, blake2b does not.
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of worker indices.
+
+    Every node owns `replicas` points on the ring and a key belongs to the
+    node of the first point after the hash of the key. Adding or removing
+    a node only moves the keys of that node.
+
+    Parameters
+    ----------
+    nodes : Iterable[int]
+        Initial nodes.
+    replicas : int
+        Points per node; more points spread the keys more evenly.
+    """
+
+    def __init__(self, nodes=(), replicas: int = 64) -> None:
+        self.replicas = replicas
+        self._points: list[int] = []
+        self._owners: list[int] = []
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> set[int]:
+        return set(self._owners)
+
+    def add(self, node: int) -> None:
+        """
+        Adds a node to the ring.
+        """
+        for replica in range(self.replicas):
+            point = _hash(f"{node}:{replica}")
+            index = bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: int) -> None:
+        """
+        Removes a node from the ring.
+        """
+        kept = [(point, owner)
+                for point, owner in zip(self._points, self._owners)
+                if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, key: int) -> int:
+        """
+        Returns the node owning a key.
+
+        Parameters
+        ----------
+        key : int
+            Chat id.
+
+        Returns
+        -------
+        int
+            The node.
+        """
+        if not self._points:
+            raise LookupError("The hash ring is empty")
+        index = bisect(self._points, _hash(str(key)))
+        return self._owners[index % len(self._owners)]
+
+
+def worker_of(ring: HashRing, chat_id: int) -> int:
+    """
+    Returns the worker serving a chat under a ring. LOBBY_CHAT belongs to
+    the lowest worker, which scale() never removes, so the queue and the
+    tournaments it keeps in memory stay with their games.
+
+    Parameters
+    ----------
+    ring : HashRing
+        Ring of the workers.
+    chat_id : int
+        Chat id, see chat_id_of().
+
+    Returns
+    -------
+    int
+        Index of the worker.
+    """
+    if chat_id == LOBBY_CHAT:
+        return min(ring.nodes)
+    return ring.node_for(chat_id)
+
+
+def _lobby_command(text: str) -> bool:
+    words = text[1:].split(maxsplit=1) if text.startswith("/") else ()
+    return bool(words) \
+        and words[0].partition("@")[0].lower() in LOBBY_COMMANDS
+
+
+def chat_id_of(update: dict[str, Any]) -> int:
+    """
+    Extracts the chat an update belongs to from its raw JSON.
+
+    Parameters
+    ----------
+    update : dict[str, Any]
+        Decoded update.
+
+    Returns
+    -------
+    int
+        Chat id; LOBBY_CHAT for LOBBY_COMMANDS and clicks on boards of
+        games found by /queue; the sender id for updates without a chat
+        (e.g. inline queries) or 0.
+    """
+    for field in _CHAT_UPDATES:
+        if field in update:
+            if _lobby_command(update[field].get("text", "")):
+                return LOBBY_CHAT
+            return update[field]["chat"]["id"]
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if str(value.get("data", "")).startswith(MATCH_CALLBACK):
+            return LOBBY_CHAT
+        message = value.get("message")
+        if message:
+            return message["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+class _Worker:
+    __slots__ = ("index", "port", "process", "ready", "in_flight",
+                 "started", "crashes", "monitor")
+
+    def __init__(self, index: int, port: int) -> None:
+        self.index = index
+        self.port = port
+        self.process: asyncio.subprocess.Process | None = None
+        # Cleared while the worker is down: forwards wait instead of
+        # failing.
+        self.ready = asyncio.Event()
+        self.in_flight = 0
+        self.started = 0.0
+        self.crashes = 0
+        self.monitor: asyncio.Task | None = None
+
+
+def _free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class _IngressHandler(RequestHandler):
+    def initialize(self, supervisor: "Supervisor") -> None:
+        self.supervisor = supervisor
+
+    async def post(self) -> None:
+        secret = self.supervisor.secret_token
+        if secret and self.request.headers.get(SECRET_HEADER) != secret:
+            self.send_error(403)
+            return
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            self.send_error(400)
+            return
+        # A non-2xx status makes Telegram deliver the update again later.
+        self.set_status(await self.supervisor.forward(update,
+                                                      self.request.body))
+        self.finish()
+
+
+class Supervisor:
+    """
+    Webhook ingress routing updates to worker processes.
+
+    Parameters
+    ----------
+    command : list[str]
+        Command line of a worker; "--port <port>" is appended.
+    workers : int
+        Number of worker processes.
+    listen, port, url_path : str, int, str
+        Address and path of the webhook.
+    webhook_url : str
+        Public URL registered with setWebhook; empty to skip it.
+    secret_token : str
+        Secret expected in the X-Telegram-Bot-Api-Secret-Token header and
+        passed on to the workers.
+    stop_timeout : float
+        Seconds a worker gets to finish its updates before it is killed,
+        and the longest time an update waits for a restarting worker.
+    """
+
+    def __init__(self, command: list[str], workers: int, listen: str,
+                 port: int, url_path: str, webhook_url: str = "",
+                 secret_token: str = "", stop_timeout: float = 30.0) -> None:
+        self.command = command
+        self.workers = workers
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path.strip("/")
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.stop_timeout = stop_timeout
+        self.ring = HashRing()
+        self._workers: dict[int, _Worker] = {}
+        self._server: HTTPServer | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        # Cleared while games move between workers: forwards wait.
+        self._routing = asyncio.Event()
+        self._routing.set()
+
+    def worker_for(self, chat_id: int) -> int:
+        """
+        Returns the index of the worker serving a chat.
+        """
+        return worker_of(self.ring, chat_id)
+
+    async def start(self) -> None:
+        """
+        Starts the workers, then the ingress, and registers the webhook.
+        """
+        self._client = httpx.AsyncClient(
+            timeout=self.stop_timeout,
+            limits=httpx.Limits(max_connections=None),
+        )
+        if RATING_STORE == "memory" and self.workers > 1:
+            logger.warning("RATING_STORE=memory: every worker keeps its "
+                           "own ratings, use sqlite:<path> to share them")
+        try:
+            await asyncio.gather(*(self._add_worker(index)
+                                   for index in range(self.workers)))
+            app = WebApplication([
+                (rf"/{self.url_path}/?", _IngressHandler,
+                 {"supervisor": self}),
+            ])
+            sockets = bind_sockets(self.port, self.listen)
+            self.port = sockets[0].getsockname()[1]
+            self._server = HTTPServer(app)
+            self._server.add_sockets(sockets)
+            if self.webhook_url:
+                await self._set_webhook()
+        except BaseException:
+            # Do not leave workers behind.
+            await self.stop()
+            raise
+        logger.info("Supervisor is running %d workers, webhook on %s:%d/%s",
+                    len(self._workers), self.listen, self.port,
+                    self.url_path)
+
+    async def stop(self) -> None:
+        """
+        Stops accepting updates and stops every worker once it has handled
+        the updates it was given.
+        """
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        async with self._lock:
+            await asyncio.gather(*(self._stop_worker(worker)
+                                   for worker in self._workers.values()))
+            self._workers.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def forward(self, update: dict[str, Any], body: bytes) -> int:
+        """
+        Sends an update to the worker of its chat.
+
+        Parameters
+        ----------
+        update : dict[str, Any]
+            Decoded update.
+        body : bytes
+            The update as received.
+
+        Returns
+        -------
+        int
+            HTTP status for Telegram: the status of the worker, or 503 if
+            it stayed down for `stop_timeout` seconds.
+        """
+        chat_id = chat_id_of(update)
+        headers = {"Content-Type": "application/json"}
+        if self.secret_token:
+            headers[SECRET_HEADER] = self.secret_token
+        for _ in range(3):
+            try:
+                await asyncio.wait_for(self._routing.wait(),
+                                       self.stop_timeout)
+            except asyncio.TimeoutError:
+                break
+            worker = self._workers.get(self.worker_for(chat_id))
+            if worker is None:
+                # Removed by scale() after the lookup; look up again.
+                await asyncio.sleep(0)
+                continue
+            try:
+                await asyncio.wait_for(worker.ready.wait(),
+                                       self.stop_timeout)
+            except asyncio.TimeoutError:
+                break
+            worker.in_flight += 1
+            try:
+                response = await self._client.post(
+                    f"http://127.0.0.1:{worker.port}/{self.url_path}",
+                    content=body, headers=headers,
+                )
+                return response.status_code
+            except httpx.TransportError as exc:
+                # The worker died after it was marked ready; its monitor
+                # restarts it and clears `ready` meanwhile.
+                logger.warning("Worker %d is unreachable: %s",
+                               worker.index, exc)
+                await asyncio.sleep(0.1)
+            finally:
+                worker.in_flight -= 1
+        logger.error("Update %s for chat %d was not delivered",
+                     update.get("update_id"), chat_id)
+        return 503
+
+    async def restart(self, index: int) -> None:
+        """
+        Restarts a worker gracefully: updates for its chats are held until
+        the new process is up, none are lost.
+        """
+        async with self._lock:
+            worker = self._workers[index]
+            await self._stop_worker(worker)
+            await self._start_worker(worker)
+            logger.info("Worker %d restarted", index)
+
+    async def rolling_restart(self) -> None:
+        """
+        Restarts every worker, one at a time.
+        """
+        for index in sorted(self._workers):
+            await self.restart(index)
+
+    async def scale(self, count: int) -> None:
+        """
+        Changes the number of workers. The ring moves the chats of added or
+        removed workers only, and their games go with them: new workers
+        are started first, then every worker hands the games of its
+        moving chats over to their new worker (see _rebalance()), and only
+        then are the removed workers stopped.
+
+        Parameters
+        ----------
+        count : int
+            New number of workers, at least 1.
+        """
+        count = max(1, count)
+        async with self._lock:
+            nodes = sorted(self._workers)
+            while len(nodes) < count:
+                nodes.append(nodes[-1] + 1)
+                await self._add_worker(nodes[-1], route=False)
+            nodes = nodes[:count]
+            await self._rebalance(nodes)
+            for index in sorted(set(self._workers) - set(nodes)):
+                await self._stop_worker(self._workers.pop(index))
+            self.workers = count
+        logger.info("Scaled to %d workers", count)
+
+    async def _rebalance(self, nodes: list[int]) -> None:
+        # Holds new updates until the workers are idle, moves the games
+        # of the chats whose worker changes and switches the ring.
+        if set(nodes) == self.ring.nodes:
+            return
+        self._routing.clear()
+        try:
+            while any(worker.in_flight for worker in self._workers.values()):
+                await asyncio.sleep(0.01)
+            ring = HashRing(nodes, self.ring.replicas)
+            headers = {}
+            if self.secret_token:
+                headers[SECRET_HEADER] = self.secret_token
+            moved: dict[int, list] = {}
+            for index in sorted(self.ring.nodes):
+                worker = self._workers[index]
+                try:
+                    response = await self._client.post(
+                        f"http://127.0.0.1:{worker.port}/{self.url_path}"
+                        "/handoff",
+                        json={"nodes": nodes, "index": index},
+                        headers=headers,
+                    )
+                    response.raise_for_status()
+                except httpx.HTTPError as exc:
+                    logger.error("Worker %d did not hand over its games: %s",
+                                 index, exc)
+                    continue
+                for key, game in unpack_snapshot(response.content):
+                    moved.setdefault(worker_of(ring, key[0]), []).append(
+                        (key, game)
+                    )
+            for index, entries in moved.items():
+                worker = self._workers[index]
+                try:
+                    response = await self._client.post(
+                        f"http://127.0.0.1:{worker.port}/{self.url_path}"
+                        "/games",
+                        content=pack_snapshot(entries), headers=headers,
+                    )
+                    response.raise_for_status()
+                except httpx.HTTPError as exc:
+                    logger.error("%d games were not moved to worker %d: %s",
+                                 len(entries), index, exc)
+                    continue
+                logger.info("Moved %d games to worker %d", len(entries),
+                            index)
+            self.ring = ring
+        finally:
+            self._routing.set()
+
+    async def _add_worker(self, index: int, route: bool = True) -> None:
+        worker = _Worker(index, _free_port("127.0.0.1"))
+        self._workers[index] = worker
+        await self._start_worker(worker)
+        if route:
+            self.ring.add(index)
+
+    def _env(self, worker: _Worker) -> dict[str, str]:
+        env = dict(os.environ)
+        # Files and ports of a worker must not clash with the others.
+        env["GAME_STORE"] = GAME_STORE.replace("{worker}", str(worker.index))
+        env["REPLAY_LOG"] = REPLAY_LOG.replace("{worker}", str(worker.index))
+        env["GAME_SNAPSHOT"] = GAME_SNAPSHOT.replace("{worker}",
+                                                     str(worker.index))
+        env["METRICS_PORT"] = str(METRICS_PORT + 1 + worker.index
+                                  if METRICS_PORT else 0)
+        if "AI_WORKERS" not in os.environ:
+            env["AI_WORKERS"] = str(max(1, AI_WORKERS // self.workers))
+        return env
+
+    async def _start_worker(self, worker: _Worker) -> None:
+        await self._spawn(worker)
+        worker.monitor = asyncio.create_task(self._monitor(worker))
+
+    async def _spawn(self, worker: _Worker) -> None:
+        loop = asyncio.get_running_loop()
+        worker.started = loop.time()
+        worker.process = await asyncio.create_subprocess_exec(
+            *self.command, "--port", str(worker.port),
+            env=self._env(worker),
+        )
+        deadline = loop.time() + READY_TIMEOUT
+        while True:
+            if worker.process.returncode is not None:
+                raise RuntimeError(f"Worker {worker.index} exited with code "
+                                   f"{worker.process.returncode}")
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1",
+                                                          worker.port)
+            except OSError:
+                if loop.time() > deadline:
+                    worker.process.kill()
+                    raise RuntimeError(f"Worker {worker.index} did not "
+                                       f"start in time")
+                await asyncio.sleep(0.05)
+                continue
+            writer.close()
+            break
+        worker.ready.set()
+
+    async def _monitor(self, worker: _Worker) -> None:
+        # Restarts a worker that exits on its own, backing off while it
+        # keeps crashing. Updates of its chats wait on `ready` meanwhile.
+        loop = asyncio.get_running_loop()
+        while True:
+            code = await worker.process.wait()
+            worker.ready.clear()
+            if loop.time() - worker.started > MAX_RESTART_DELAY:
+                worker.crashes = 0
+            worker.crashes += 1
+            delay = min(MAX_RESTART_DELAY, 0.5 * 2 ** (worker.crashes - 1))
+            logger.warning("Worker %d exited with code %s, restarting in "
+                           "%.1f s", worker.index, code, delay)
+            await asyncio.sleep(delay)
+            try:
+                await self._spawn(worker)
+            except RuntimeError as exc:
+                logger.error("%s", exc)
+
+    async def _stop_worker(self, worker: _Worker) -> None:
+        # New updates wait on `ready`; the ones already sent are finished
+        # by the worker before it exits on SIGTERM.
+        worker.ready.clear()
+        while worker.in_flight:
+            await asyncio.sleep(0.01)
+        if worker.monitor is not None:
+            worker.monitor.cancel()
+            try:
+                await worker.monitor
+            except asyncio.CancelledError:
+                pass
+            worker.monitor = None
+        process = worker.process
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), self.stop_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Worker %d did not stop in time, killing it",
+                               worker.index)
+                process.kill()
+                await process.wait()
+
+    async def _set_webhook(self) -> None:
+        base_url = TELEGRAM_API_URL or "https://api.telegram.org/bot"
+        params = {"url": self.webhook_url,
+                  "max_connections": 100}
+        if self.secret_token:
+            params["secret_token"] = self.secret_token
+        response = await self._client.post(f"{base_url}{TOKEN}/setWebhook",
+                                           json=params)
+        response.raise_for_status()
+
+    def _spawn_task(self, coroutine: Any) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def serve(self) -> None:
+        """
+        Runs the supervisor until SIGTERM or SIGINT.
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        loop.add_signal_handler(
+            signal.SIGHUP, lambda: self._spawn_task(self.rolling_restart())
+        )
+        loop.add_signal_handler(
+            signal.SIGTTIN, lambda: self._spawn_task(self.scale(
+                len(self._workers) + 1))
+        )
+        loop.add_signal_handler(
+            signal.SIGTTOU, lambda: self._spawn_task(self.scale(
+                len(self._workers) - 1))
+        )
+        await self.start()
+        try:
+            await stop.wait()
+        finally:
+            await self.stop()
+
+
+class _WorkerHandler(RequestHandler):
+    def initialize(self, bot_app: "Application", secret_token: str,
+                   drain_timeout: float = 10) -> None:
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+
+    def prepare(self) -> None:
+        secret = self.secret_token
+        if secret and self.request.headers.get(SECRET_HEADER) != secret:
+            self.send_error(403)
+
+    async def post(self) -> None:
+        # Imported in the worker only: the supervisor never loads telegram.
+        from telegram import Update
+
+        update = Update.de_json(json.loads(self.request.body),
+                                self.bot_app.bot)
+        await self.bot_app.update_queue.put(update)
+        self.finish()
+
+
+class _HandoffHandler(_WorkerHandler):
+    # Gives up the games of the chats that belong to another worker
+    # under the ring in the request, once the received updates are done.
+    async def post(self) -> None:
+        from tictactoe.bot import drain_updates
+        from tictactoe.storage import get_store
+
+        request = json.loads(self.request.body)
+        ring = HashRing(request["nodes"])
+        index = request["index"]
+        await drain_updates(self.bot_app, self.drain_timeout)
+        taken = await get_store(self.bot_app).take(
+            lambda chat_id: worker_of(ring, chat_id) != index
+        )
+        logger.info("Handed over %d games", len(taken))
+        self.set_header("Content-Type", "application/octet-stream")
+        self.finish(pack_snapshot(taken))
+
+
+class _GamesHandler(_WorkerHandler):
+    # Stores the games handed over by other workers.
+    async def post(self) -> None:
+        from tictactoe.storage import get_store
+
+        store = get_store(self.bot_app)
+        entries = list(unpack_snapshot(self.request.body))
+        for key, game in entries:
+            store.put(key, game)
+        await store.write()
+        self.finish({"games": len(entries)})
+
+
+async def serve_worker(application: "Application", listen: str, port: int,
+                       url_path: str, secret_token: str = "",
+                       drain_timeout: float = 10) -> None:
+    """
+    Runs an Application fed by the supervisor until SIGTERM or SIGINT.
+    Updates already received get `drain_timeout` seconds to be handled
+    before the process exits. Besides updates, the supervisor posts to
+    "<url_path>/handoff" and "<url_path>/games" to move games between
+    workers when it scales.
+
+    Parameters
+    ----------
+    application : Application
+        The bot.
+    listen, port, url_path : str, int, str
+        Local address the supervisor forwards updates to.
+    secret_token : str
+        Secret expected in the X-Telegram-Bot-Api-Secret-Token header.
+    drain_timeout : float
+        Seconds the received updates get to finish.
+    """
+    from tictactoe.bot import serve_application
+
+    path = url_path.strip("/")
+    options = {"bot_app": application, "secret_token": secret_token,
+               "drain_timeout": drain_timeout}
+    server = HTTPServer(WebApplication([
+        (rf"/{path}/?", _WorkerHandler, options),
+        (rf"/{path}/handoff", _HandoffHandler, options),
+        (rf"/{path}/games", _GamesHandler, options),
+    ]))
+
+    async def start_updates() -> None:
+        server.add_sockets(bind_sockets(port, listen))
+
+    async def stop_updates() -> None:
+        server.stop()
+
+    await serve_application(application, start_updates, stop_updates,
+                            drain_timeout)
@@ -0,0 +1,468 @@
+"""
+Benchmarks for the game logic, the AI and the game handler.
+
+Run from the repository root:
+
+    PYTHONPATH=app python benchmarks.py
+
+Startup time is measured with `python -X importtime` in fresh
+interpreters, one per entry point.
+
+Results can be saved as JSON and compared with an earlier run; the
+comparison fails if a metric got worse than its regression threshold:
+
+    PYTHONPATH=app python benchmarks.py --json before.json
+    PYTHONPATH=app python benchmarks.py --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from tictactoe.batch import (
+    evaluate,
+    evaluate_masks,
+    masks_to_cells,
+    masks_view,
+    pack_masks,
+)
+from tictactoe.board import Board
+from tictactoe.constants import (
+    FREE_SPACE,
+    CROSS,
+    ZERO,
+    KEYBOARD_CACHE_SIZE
+)
+from tictactoe.game_logic import (
+    cell_callback,
+    check_win,
+    find_best_move,
+    get_default_state,
+    is_draw,
+    new_board
+)
+from tictactoe.keyboards import _build_keyboard, generate_keyboard
+from tictactoe.handlers import game
+from tictactoe.outbound import OUTBOUND_KEY, OutboundQueue
+from tictactoe.solver import get_table, reachable_positions as positions_3x3
+from tictactoe.storage import STORE_KEY, MemoryGameStore, dump_game
+
+# Allowed relative change against a baseline before a metric counts as a
+# regression. Timings are noisy, memory figures are not.
+DEFAULT_TOLERANCE = 0.25
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+# Entry points timed by the startup benchmark: the core game engine, the
+# assembled bot, the supervisor and the main script itself.
+STARTUP_MODULES = ("tictactoe.game_logic", "tictactoe.bot",
+                   "tictactoe.supervisor", "main")
+TOLERANCES = {
+    "bytes": 0.05,
+}
+
+
+def naive_minimax(board: list[list[str]], player: str) -> tuple[int, tuple]:
+    """
+    Plain recursive minimax without memoization, used as a baseline.
+
+    Parameters
+    ----------
+    board : list[list[str]]
+        Current 3x3 board, modified in place during the search.
+    player : str
+        CROSS or ZERO - the side to move.
+
+    Returns
+    -------
+    tuple[int, tuple]
+        (score for the side to move, best (row, col) or None).
+    """
+    opponent = ZERO if player == CROSS else CROSS
+    if check_win(board) is not None:
+        return -1, None
+
+    best_score, best_move = -2, None
+    for r in range(3):
+        for c in range(3):
+            if board[r][c] != FREE_SPACE:
+                continue
+            board[r][c] = player
+            score = -naive_minimax(board, opponent)[0]
+            board[r][c] = FREE_SPACE
+            if score > best_score:
+                best_score, best_move = score, (r, c)
+    if best_move is None:
+        return 0, None
+    return best_score, best_move
+
+
+def reachable_positions() -> list[tuple[list[list[str]], str]]:
+    """
+    Enumerates all non-terminal positions reachable from the empty board.
+
+    Returns
+    -------
+    list[tuple[list[list[str]], str]]
+        (board, side to move) pairs.
+    """
+    seen = set()
+    result = []
+
+    def walk(board, player):
+        key = tuple(cell for row in board for cell in row)
+        if key in seen:
+            return
+        seen.add(key)
+        if check_win(board) is not None or FREE_SPACE not in key:
+            return
+        result.append(([row[:] for row in board], player))
+        opponent = ZERO if player == CROSS else CROSS
+        for r in range(3):
+            for c in range(3):
+                if board[r][c] == FREE_SPACE:
+                    board[r][c] = player
+                    walk(board, opponent)
+                    board[r][c] = FREE_SPACE
+
+    walk([[FREE_SPACE] * 3 for _ in range(3)], CROSS)
+    return result
+
+
+class Results:
+    """
+    Collects benchmark metrics and prints them as they come.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, dict] = {}
+
+    def add(self, name: str, value: float, unit: str,
+            higher_is_better: bool = False) -> None:
+        self.metrics[name] = {
+            "value": value,
+            "unit": unit,
+            "higher_is_better": higher_is_better,
+        }
+        print(f"{name:<40}{value:>14.2f} {unit}")
+
+    def to_json(self) -> dict:
+        return {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "tolerances": dict(TOLERANCES, default=DEFAULT_TOLERANCE),
+            "metrics": self.metrics,
+        }
+
+
+def time_per_call(func, args_list: list, repeat: int = 3) -> float:
+    """
+    Best of `repeat` runs of func over every argument tuple.
+
+    Returns
+    -------
+    float
+        Microseconds per call.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in args_list:
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best / len(args_list) * 1e6
+
+
+def bench(label: str, func, positions) -> None:
+    start = time.perf_counter()
+    for board, player in positions:
+        func(board, player)
+    elapsed = time.perf_counter() - start
+    per_move = elapsed / len(positions) * 1e6
+    print(f"{label:<24}{len(positions):>8} moves{per_move:>12.2f} us/move")
+
+
+def bench_game_logic(results: Results) -> None:
+    start = time.perf_counter()
+    get_table()
+    results.add("solver.table_build", (time.perf_counter() - start) * 1e3,
+                "ms")
+
+    boards = [(Board(x, o),) for x, o in positions_3x3()]
+    legacy = [(board.to_rows(),) for (board,) in boards]
+    results.add("get_default_state", time_per_call(get_default_state,
+                                                   [()] * 10_000), "us")
+    results.add("check_win", time_per_call(check_win, boards), "us")
+    results.add("check_win.legacy_rows", time_per_call(check_win, legacy),
+                "us")
+    results.add("is_draw", time_per_call(is_draw, boards), "us")
+    results.add("find_best_move", time_per_call(find_best_move, boards),
+                "us")
+    board_list = [board for (board,) in boards]
+    masks = masks_view(pack_masks(board_list))
+    cells = masks_to_cells(masks)
+    results.add("batch.evaluate", time_per_call(evaluate, [(cells,)] * 20)
+                / len(board_list), "us")
+    results.add("batch.evaluate_masks",
+                time_per_call(evaluate_masks, [(masks,)] * 20)
+                / len(board_list), "us")
+    # An LRU cache smaller than the position set would miss on every call
+    # of a full pass, so hits are measured on positions that fit.
+    cached = boards[:KEYBOARD_CACHE_SIZE // 2]
+    results.add("generate_keyboard.cached",
+                time_per_call(generate_keyboard, cached), "us")
+    results.add("generate_keyboard.build",
+                time_per_call(_build_keyboard, boards), "us")
+
+
+def bench_keyboard_allocation(results: Results) -> None:
+    boards = [Board(x, o) for x, o in positions_3x3()]
+    boards = boards[:KEYBOARD_CACHE_SIZE // 2]
+    for label, func in (("build", _build_keyboard),
+                        ("cached", generate_keyboard)):
+        # Warm the cache so "cached" measures hits only.
+        for board in boards:
+            func(board)
+        tracemalloc.start()
+        markups = [func(board) for board in boards]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del markups
+        results.add(f"generate_keyboard.{label}.bytes",
+                    current / len(boards), "bytes")
+
+
+def _fake_update(chat_id: int, message: SimpleNamespace,
+                 data: str) -> SimpleNamespace:
+    async def answer(*args, **kwargs):
+        return True
+
+    query = SimpleNamespace(
+        data=data,
+        message=message,
+        from_user=SimpleNamespace(id=chat_id, username=f"bench{chat_id}",
+                                  full_name="Bench"),
+        answer=answer,
+    )
+    return SimpleNamespace(callback_query=query,
+                           effective_chat=SimpleNamespace(id=chat_id))
+
+
+def _fake_message(chat_id: int) -> SimpleNamespace:
+    # Stands in for the bot: edits and replies return immediately.
+    async def edit_text(text, reply_markup=None, **kwargs):
+        message.text = text
+        return message
+
+    async def reply_text(text, **kwargs):
+        return message
+
+    message = SimpleNamespace(chat_id=chat_id, message_id=1, text="",
+                              edit_text=edit_text, reply_text=reply_text)
+    return message
+
+
+async def _play_games(chats: int, moves: int, size: int, k: int) -> float:
+    store = MemoryGameStore()
+    context = SimpleNamespace(bot_data={
+        STORE_KEY: store,
+        OUTBOUND_KEY: OutboundQueue(1e9, 1e9, 1e9),
+    })
+    rng = random.Random(0)
+    messages = {chat_id: _fake_message(chat_id) for chat_id in range(chats)}
+
+    def new_game(chat_id: int) -> None:
+        store.put((chat_id, messages[chat_id].message_id), {
+            "board": new_board(size, k),
+            "current_player": CROSS,
+            "players": [{"id": chat_id, "name": f"bench{chat_id}"}],
+            "mode": "single",
+        })
+
+    async def play(chat_id: int, count: int) -> None:
+        message = messages[chat_id]
+        key = (chat_id, message.message_id)
+        for _ in range(count):
+            game_data = store.get(key)
+            if game_data is None:
+                # The last move finished the game and removed it.
+                new_game(chat_id)
+                game_data = store.get(key)
+            board = game_data["board"]
+            free = board.free_mask
+            cells = [i for i in range(size * size) if free >> i & 1]
+            cell = rng.choice(cells)
+            update = _fake_update(chat_id, message,
+                                  cell_callback(cell, size))
+            await game(update, context)
+
+    per_chat = moves // chats
+    start = time.perf_counter()
+    await asyncio.gather(*(play(chat_id, per_chat) for chat_id in messages))
+    await context.bot_data[OUTBOUND_KEY].flush()
+    return per_chat * chats / (time.perf_counter() - start)
+
+
+def bench_handler(results: Results, moves: int) -> None:
+    # Handler logging would dominate the measurement.
+    logging.disable(logging.INFO)
+    try:
+        rate = asyncio.run(_play_games(chats=50, moves=moves, size=3, k=3))
+    finally:
+        logging.disable(logging.NOTSET)
+    results.add("handlers.game.3x3", rate, "updates/s",
+                higher_is_better=True)
+
+
+def bench_game_memory(results: Results, games: int = 2000) -> None:
+    for size, k in ((3, 3), (15, 5)):
+        store = MemoryGameStore()
+        tracemalloc.start()
+        for chat_id in range(games):
+            board = new_board(size, k)
+            # A mid-game position, so the masks are realistic ints.
+            for i in range(0, min(size * size, 2 * k), 2):
+                board.place(i, CROSS)
+                board.place(i + 1, ZERO)
+            store.put((chat_id, 1), {
+                "board": board,
+                "current_player": CROSS,
+                "players": [{"id": chat_id, "name": f"player{chat_id}"}],
+                "mode": "single",
+            })
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.add(f"memory_per_game.{size}x{size}.bytes",
+                    current / games, "bytes")
+        results.add(f"stored_game.{size}x{size}.bytes",
+                    len(dump_game(store.get((0, 1))).encode()), "bytes")
+
+
+def import_time(module: str) -> float:
+    """
+    Imports a module in a fresh interpreter with -X importtime.
+
+    Returns
+    -------
+    float
+        Cumulative import time of the module and everything it imports,
+        in milliseconds.
+    """
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, total, name = line.split("|")
+        # Top-level imports are indented by one space, nested ones by more.
+        if name == f" {module}":
+            return int(total) / 1e3
+    raise RuntimeError(f"{module} is missing in the -X importtime output")
+
+
+def bench_startup(results: Results, runs: int = 5) -> None:
+    for module in STARTUP_MODULES:
+        times = [import_time(module) for _ in range(runs)]
+        results.add(f"startup.{module}", statistics.median(times), "ms")
+
+
+def bench_minimax(sample_size: int) -> None:
+    positions = reachable_positions()
+    # Naive minimax from early positions takes seconds per move,
+    # so it runs on a fixed random sample.
+    sample = random.Random(0).sample(positions, sample_size)
+
+    bench("table lookup (all)", lambda b, p: find_best_move(b), positions)
+    bench("table lookup (sample)", lambda b, p: find_best_move(b), sample)
+    bench("naive minimax (sample)", naive_minimax, sample)
+
+
+def compare(current: dict, baseline: dict) -> list[str]:
+    """
+    Compares two benchmark runs.
+
+    Parameters
+    ----------
+    current, baseline : dict
+        JSON documents produced by Results.to_json().
+
+    Returns
+    -------
+    list[str]
+        Descriptions of the metrics that regressed beyond their threshold.
+    """
+    regressions = []
+    for name, metric in current["metrics"].items():
+        old = baseline["metrics"].get(name)
+        if old is None or not old["value"]:
+            continue
+        change = (metric["value"] - old["value"]) / old["value"]
+        if metric["higher_is_better"]:
+            change = -change
+        tolerance = TOLERANCES.get(metric["unit"], DEFAULT_TOLERANCE)
+        mark = ""
+        if change > tolerance:
+            mark = "  REGRESSION"
+            regressions.append(f"{name}: {change:+.0%} "
+                               f"(threshold {tolerance:.0%})")
+        print(f"{name:<40}{old['value']:>12.2f} ->"
+              f"{metric['value']:>12.2f} {metric['unit']:<10}"
+              f"{change:+8.0%} worse{mark}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="compare with an earlier --json file and exit "
+                             "with code 1 on regressions")
+    parser.add_argument("--moves", type=int, default=20_000,
+                        help="moves played by the handler benchmark")
+    parser.add_argument("--minimax-sample", type=int, default=300,
+                        help="positions for the naive minimax baseline, "
+                             "0 to skip it")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="fresh interpreters per startup benchmark, "
+                             "0 to skip it")
+    args = parser.parse_args()
+
+    results = Results()
+    bench_game_logic(results)
+    bench_keyboard_allocation(results)
+    bench_handler(results, args.moves)
+    bench_game_memory(results)
+    if args.startup_runs:
+        bench_startup(results, args.startup_runs)
+    if args.minimax_sample:
+        bench_minimax(args.minimax_sample)
+
+    document = results.to_json()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(document, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        print()
+        regressions = compare(document, baseline)
+        if regressions:
+            print("\n".join(["", "Regressions:"] + regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
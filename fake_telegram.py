@@ -0,0 +1,138 @@
+"""
+Local stand-in for the Telegram Bot API, used by tests and load_test.py.
+
+It answers the handful of methods the bot calls, records every call and
+serves queued updates through getUpdates long polling. Point the bot at it
+with the TELEGRAM_API_URL environment variable:
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "TicTacToe",
+    "username": "tictactoe_test_bot",
+}
+
+
+class _MethodHandler(RequestHandler):
+    def initialize(self, api: "FakeTelegramAPI") -> None:
+        self.api = api
+
+    async def post(self, token: str, method: str) -> None:
+        if self.request.headers.get("Content-Type", "").startswith(
+                "application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            params = {}
+            for name, values in self.request.body_arguments.items():
+                value = values[-1].decode()
+                try:
+                    params[name] = json.loads(value)
+                except ValueError:
+                    params[name] = value
+        result = await self.api.call(method, params)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"ok": True, "result": result}))
+
+    get = post
+
+
+class FakeTelegramAPI:
+    """
+    In-process fake Bot API server.
+
+    Attributes
+    ----------
+    calls : list[tuple[float, str, dict]]
+        (perf_counter timestamp, method, params) of every request.
+    listeners : list[Callable[[str, dict, object], None]]
+        Called with (method, params, result) after every request.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.calls: list[tuple[float, str, dict]] = []
+        self.updates: asyncio.Queue[dict] = asyncio.Queue()
+        self.listeners: list = []
+        self._message_ids = itertools.count(1000)
+        self._server: HTTPServer | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self) -> None:
+        app = Application([
+            (r"/bot([^/]+)/(\w+)", _MethodHandler, {"api": self}),
+        ])
+        sockets = bind_sockets(self.port, self.host)
+        self.port = sockets[0].getsockname()[1]
+        self._server = HTTPServer(app)
+        self._server.add_sockets(sockets)
+
+    async def stop(self) -> None:
+        # Release a pending long poll so its request finishes cleanly.
+        self.updates.put_nowait(None)
+        await asyncio.sleep(0.05)
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+
+    def push_update(self, update: dict) -> None:
+        """
+        Queues an update to be returned by the next getUpdates call.
+        """
+        self.updates.put_nowait(update)
+
+    async def call(self, method: str, params: dict):
+        self.calls.append((time.perf_counter(), method, params))
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(float(params.get("timeout", 0)))
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+
+        for listener in self.listeners:
+            listener(method, params, result)
+        return result
+
+    async def _get_updates(self, timeout: float) -> list[dict]:
+        if self.updates.empty() and timeout:
+            try:
+                update = await asyncio.wait_for(self.updates.get(), timeout)
+            except asyncio.TimeoutError:
+                return []
+            result = [update]
+        else:
+            result = []
+        while not self.updates.empty():
+            result.append(self.updates.get_nowait())
+        return [update for update in result if update is not None]
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        message_id = params.get("message_id") or next(self._message_ids)
+        message = {
+            "message_id": int(message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        if "reply_markup" in params:
+            message["reply_markup"] = params["reply_markup"]
+        return message
@@ -0,0 +1,222 @@
+"""
+Load test for the bot serving modes.
+
+Starts the bot in a subprocess against the local fake Bot API
+(fake_telegram.py), replays synthetic single-player games from many chats
+and reports callback-query handler latency for polling, webhook and
+supervisor modes.
+
+Run from the repository root:
+
+    PYTHONPATH=app python load_test.py --updates 5000 --chats 100
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+
+import httpx
+
+from fake_telegram import BOT_USER, FakeTelegramAPI
+from tictactoe.constants import FREE_SPACE
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "app", "main.py")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LoadRunner:
+    def __init__(self, mode: str, api: FakeTelegramAPI, port: int,
+                 total_callbacks: int, think_time: float) -> None:
+        self.mode = mode
+        self.think_time = think_time
+        self.api = api
+        self.webhook_url = f"http://127.0.0.1:{port}/telegram"
+        self.remaining = total_callbacks
+        self.latencies: list[float] = []
+        self.update_ids = itertools.count(1)
+        self.waiters: dict[int, tuple[set[str], asyncio.Future]] = {}
+        self.client = httpx.AsyncClient(timeout=30)
+        api.listeners.append(self._on_call)
+
+    def _on_call(self, method: str, params: dict, result) -> None:
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        waiter = self.waiters.get(int(chat_id))
+        if waiter and method in waiter[0] and not waiter[1].done():
+            waiter[1].set_result((time.perf_counter(), result))
+
+    async def _send(self, chat_id: int, update: dict,
+                    methods: set[str]) -> tuple[float, dict]:
+        # A user can only react once the reply is shown.
+        await asyncio.sleep(self.think_time)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = (methods, future)
+        sent = time.perf_counter()
+        if self.mode != "polling":
+            await self.client.post(self.webhook_url, json=update)
+        else:
+            self.api.push_update(update)
+        done, result = await asyncio.wait_for(future, 30)
+        return done - sent, result
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": "Load",
+                "username": f"load{chat_id}"}
+
+    def _chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private"}
+
+    async def start_command(self, chat_id: int) -> dict:
+        update = {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.update_ids),
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+                "from": self._user(chat_id),
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0,
+                              "length": 6}],
+            },
+        }
+        return (await self._send(chat_id, update, {"sendMessage"}))[1]
+
+    async def click(self, chat_id: int, message_id: int, data: str,
+                    methods: set[str]) -> dict:
+        update_id = next(self.update_ids)
+        update = {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(chat_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": self._chat(chat_id),
+                    "from": BOT_USER,
+                    "text": "",
+                },
+            },
+        }
+        self.remaining -= 1
+        latency, result = await self._send(chat_id, update, methods)
+        self.latencies.append(latency)
+        return result
+
+    async def play(self, chat_id: int) -> None:
+        rng = random.Random(chat_id)
+        while self.remaining > 0:
+            menu = await self.start_command(chat_id)
+            board_msg = await self.click(chat_id, menu["message_id"],
+                                         "mode_single", {"sendMessage"})
+            message_id = board_msg["message_id"]
+            markup = board_msg["reply_markup"]
+            while self.remaining > 0:
+                free = [button["callback_data"]
+                        for row in markup["inline_keyboard"][:3]
+                        for button in row if button["text"] == FREE_SPACE]
+                reply = await self.click(chat_id, message_id,
+                                         rng.choice(free),
+                                         {"editMessageText"})
+                markup = reply.get("reply_markup")
+                if "окончена" in reply["text"] or not markup:
+                    break
+            await self.click(chat_id, message_id, "stop_game",
+                             {"editMessageText"})
+
+
+async def wait_ready(api: FakeTelegramAPI, mode: str,
+                     proc: asyncio.subprocess.Process) -> None:
+    method = "getUpdates" if mode == "polling" else "setWebhook"
+    for _ in range(300):
+        if proc.returncode is not None:
+            raise RuntimeError(f"bot exited with code {proc.returncode}")
+        if any(call[1] == method for call in api.calls):
+            return
+        await asyncio.sleep(0.05)
+    raise RuntimeError("bot did not start in time")
+
+
+async def run_mode(mode: str, updates: int, chats: int,
+                   concurrency: int, think_time: float,
+                   workers: int = 2) -> dict:
+    api = FakeTelegramAPI()
+    await api.start()
+    port = free_port()
+    env = dict(os.environ, TELEGRAM_API_URL=api.base_url)
+    # Measure the bot itself rather than the Telegram rate limits it obeys.
+    env.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+    env.setdefault("OUTBOUND_CHAT_RATE", "1000")
+    env.setdefault("OUTBOUND_CHAT_BURST", "1000")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, BOT_SCRIPT, "--mode", mode, "--port", str(port),
+        "--url-path", "telegram", "--concurrency", str(concurrency),
+        "--workers", str(workers), env=env, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    runner = LoadRunner(mode, api, port, updates, think_time)
+    try:
+        await wait_ready(api, mode, proc)
+        # The webhook server starts listening right after setWebhook.
+        await asyncio.sleep(0.2)
+        started = time.perf_counter()
+        await asyncio.gather(*(runner.play(10_000 + i) for i in range(chats)))
+        elapsed = time.perf_counter() - started
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await runner.client.aclose()
+        await api.stop()
+
+    quantiles = statistics.quantiles(runner.latencies, n=100)
+    return {
+        "mode": mode,
+        "callbacks": len(runner.latencies),
+        "throughput": len(runner.latencies) / elapsed,
+        "p50_ms": quantiles[49] * 1e3,
+        "p99_ms": quantiles[98] * 1e3,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--updates", type=int, default=2000,
+                        help="number of callback queries to replay per mode")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--think-ms", type=float, default=0,
+                        help="pause before each update from the same chat")
+    parser.add_argument("--modes", nargs="+", default=["polling", "webhook"],
+                        choices=["polling", "webhook", "supervisor"])
+    parser.add_argument("--workers", type=int, default=2,
+                        help="bot processes in supervisor mode")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'callbacks':>10}{'upd/s':>10}"
+          f"{'p50 ms':>10}{'p99 ms':>10}")
+    for mode in args.modes:
+        result = asyncio.run(
+            run_mode(mode, args.updates, args.chats, args.concurrency,
+                     args.think_ms / 1e3, args.workers)
+        )
+        print(f"{result['mode']:<10}{result['callbacks']:>10}"
+              f"{result['throughput']:>10.0f}{result['p50_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Headless self-play simulator for evaluating the AI.
+
+Plays games between strategies without Telegram, shards them across a
+process pool and reports win rates, average game length and games per
+second. 3x3 games between "ai" and "random" are played for many boards at
+once with NumPy; other matches are played one game at a time.
+
+Run from the repository root:
+
+    PYTHONPATH=app python simulate.py --games 1000000 --cross ai --zero random
+    PYTHONPATH=app python simulate.py --variant 7 --games 200 --cross ai \\
+        --zero heuristic
+"""
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tictactoe.batch import winners
+from tictactoe.constants import BOARD_VARIANTS, CROSS, ZERO
+from tictactoe.game_logic import find_best_move, new_board
+from tictactoe.replay import CROSS_WIN, ZERO_WIN, DRAW, OUTCOMES
+from tictactoe.search import get_engine, heuristic_move
+from tictactoe.solver import get_table
+
+STRATEGIES = ("ai", "random", "heuristic")
+
+# Games per vectorized batch; bounds the memory of one step.
+BATCH_SIZE = 100_000
+
+_POWERS_OF_3 = 3 ** np.arange(9, dtype=np.int32)
+_CELL_BITS = np.arange(9, dtype=np.uint16)
+
+
+def _empty_result() -> dict[str, int]:
+    return dict.fromkeys(OUTCOMES[:3] + ("moves", "games"), 0)
+
+
+def _vectorized_games(count: int, cross: str, zero: str,
+                      rng: np.random.Generator) -> dict[str, int]:
+    # Boards are (N, 9) int8: 0 - free, 1 - CROSS, 2 - ZERO, the same
+    # base-3 digits the solver table is indexed by.
+    table = np.frombuffer(get_table(), dtype=np.uint16)
+    boards = np.zeros((count, 9), dtype=np.int8)
+    outcome = np.full(count, DRAW, dtype=np.int8)
+    length = np.full(count, 9, dtype=np.int8)
+    active = np.arange(count)
+
+    for ply in range(9):
+        player = 1 if ply % 2 == 0 else 2
+        strategy = cross if player == 1 else zero
+        current = boards[active]
+        allowed = current == 0
+        if strategy == "ai":
+            entries = table[current.astype(np.int32) @ _POWERS_OF_3]
+            best = (entries[:, None] >> _CELL_BITS & 1).astype(bool)
+            best &= allowed
+            # Positions missing from the table fall back to any free cell.
+            best[~best.any(axis=1)] = allowed[~best.any(axis=1)]
+            allowed = best
+
+        # A uniformly random allowed cell: the largest random key.
+        keys = rng.random(allowed.shape)
+        keys[~allowed] = -1.0
+        cells = keys.argmax(axis=1)
+        current[np.arange(len(active)), cells] = player
+        boards[active] = current
+
+        won = winners(current) == player
+        finished = active[won]
+        outcome[finished] = CROSS_WIN if player == 1 else ZERO_WIN
+        length[finished] = ply + 1
+        active = active[~won]
+        if not len(active):
+            break
+
+    result = _empty_result()
+    counts = np.bincount(outcome, minlength=3)
+    for code in (CROSS_WIN, ZERO_WIN, DRAW):
+        result[OUTCOMES[code]] = int(counts[code])
+    result["moves"] = int(length.sum(dtype=np.int64))
+    result["games"] = count
+    return result
+
+
+def _pick(strategy: str, board, rng: random.Random, nodes: int) -> int:
+    size = board.size
+    if strategy == "random":
+        free = board.free_mask
+        return rng.choice([i for i in range(size * size) if free >> i & 1])
+    if strategy == "heuristic":
+        return heuristic_move(size, board.k, board.x, board.o)
+    if size == 3:
+        row, col = find_best_move(board)
+        return row * 3 + col
+    return get_engine("alphabeta").search(size, board.k, board.x, board.o,
+                                          time_limit=0,
+                                          node_limit=nodes).move
+
+
+def _single_games(count: int, variant: str, cross: str, zero: str,
+                  rng: random.Random, nodes: int) -> dict[str, int]:
+    size, k = BOARD_VARIANTS[variant]
+    result = _empty_result()
+    for _ in range(count):
+        board = new_board(size, k)
+        symbol, strategy = CROSS, cross
+        moves = 0
+        while True:
+            board.place(_pick(strategy, board, rng, nodes), symbol)
+            moves += 1
+            winner = board.winner()
+            if winner or board.is_full():
+                break
+            symbol = ZERO if symbol == CROSS else CROSS
+            strategy = zero if strategy is cross else cross
+        if winner == CROSS:
+            result[OUTCOMES[CROSS_WIN]] += 1
+        elif winner == ZERO:
+            result[OUTCOMES[ZERO_WIN]] += 1
+        else:
+            result[OUTCOMES[DRAW]] += 1
+        result["moves"] += moves
+        result["games"] += 1
+    return result
+
+
+def run_shard(count: int, variant: str, cross: str, zero: str, seed: int,
+              nodes: int = 2000) -> dict[str, int]:
+    """
+    Plays `count` games in the current process.
+
+    Parameters
+    ----------
+    count : int
+        Number of games.
+    variant : str
+        Key of BOARD_VARIANTS.
+    cross, zero : str
+        Strategies of the two sides, see STRATEGIES.
+    seed : int
+        Random seed of the shard.
+    nodes : int
+        Node budget per move of the search on large boards.
+
+    Returns
+    -------
+    dict[str, int]
+        Outcome counts, total moves and number of games.
+    """
+    if variant == "3" and {cross, zero} <= {"ai", "random"}:
+        rng = np.random.default_rng(seed)
+        result = _empty_result()
+        for start in range(0, count, BATCH_SIZE):
+            batch = _vectorized_games(min(BATCH_SIZE, count - start),
+                                      cross, zero, rng)
+            for key in result:
+                result[key] += batch[key]
+        return result
+    return _single_games(count, variant, cross, zero,
+                         random.Random(seed), nodes)
+
+
+def simulate(games: int, variant: str, cross: str, zero: str,
+             workers: int, seed: int = 0,
+             nodes: int = 2000) -> dict[str, float]:
+    """
+    Plays games split into shards over a process pool.
+
+    Returns
+    -------
+    dict[str, float]
+        Outcome counts and rates, average game length, elapsed seconds
+        and games per second.
+    """
+    shards = max(1, min(workers * 4, games))
+    sizes = [games // shards + (i < games % shards) for i in range(shards)]
+    started = time.perf_counter()
+    if workers == 1:
+        parts = [run_shard(size, variant, cross, zero, seed + i, nodes)
+                 for i, size in enumerate(sizes)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            parts = list(pool.map(
+                run_shard, sizes, [variant] * shards, [cross] * shards,
+                [zero] * shards, [seed + i for i in range(shards)],
+                [nodes] * shards
+            ))
+    elapsed = time.perf_counter() - started
+
+    total = _empty_result()
+    for part in parts:
+        for key in total:
+            total[key] += part[key]
+    report: dict[str, float] = dict(total)
+    for name in OUTCOMES[:3]:
+        report[name + "_rate"] = total[name] / total["games"]
+    report["avg_moves"] = total["moves"] / total["games"]
+    report["elapsed"] = elapsed
+    report["games_per_second"] = total["games"] / elapsed
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--games", type=int, default=100_000)
+    parser.add_argument("--variant", choices=sorted(BOARD_VARIANTS),
+                        default="3", help="board side (see BOARD_VARIANTS)")
+    parser.add_argument("--cross", choices=STRATEGIES, default="ai")
+    parser.add_argument("--zero", choices=STRATEGIES, default="random")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nodes", type=int, default=2000,
+                        help="search nodes per AI move on large boards")
+    args = parser.parse_args()
+
+    report = simulate(args.games, args.variant, args.cross, args.zero,
+                      args.workers, args.seed, args.nodes)
+    size = BOARD_VARIANTS[args.variant][0]
+    print(f"{args.cross} (❌) vs {args.zero} (⭕️) on {size}x{size}, "
+          f"{report['games']} games")
+    for name in OUTCOMES[:3]:
+        print(f"{name:<12}{report[name]:>12}{report[name + '_rate']:>10.2%}")
+    print(f"avg moves   {report['avg_moves']:>12.2f}")
+    print(f"games/s     {report['games_per_second']:>12.0f} "
+          f"({report['elapsed']:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
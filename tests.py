@@ -1,17 +1,120 @@
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import zlib
+from functools import partial
+from types import SimpleNamespace
+
+import httpx
 import pytest
+from telegram import Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import (
+    Application,
+    CallbackQueryHandler,
+    CommandHandler,
+    InlineQueryHandler
+)
+
+from fake_telegram import FakeTelegramAPI
+from simulate import run_shard
 
 from app.tictactoe.constants import (
     FREE_SPACE,
     CROSS,
-    ZERO
+    ZERO,
+    GAME_CALLBACK_PATTERN,
+    INLINE_CALLBACK_PATTERN,
+    LOBBY_CHAT
 )
 
 from app.tictactoe.game_logic import (
     get_default_state,
     check_win,
     is_draw,
-    find_best_move
+    find_best_move,
+    find_best_move_async,
+    cell_callback,
+    parse_cell
+)
+from app.tictactoe.keyboards import generate_keyboard, keyboard_cache_stats
+from app.tictactoe.ai_pool import AIPool, pack_board, unpack_board
+from app.tictactoe import batch
+from app.tictactoe.board import Board, GridBoard
+from app.tictactoe.book import build_entries, write_book
+from app.tictactoe.bot import drain_updates, serve_application
+from app.tictactoe.concurrency import ChatSerialUpdateProcessor
+from app.tictactoe import handlers
+from app.tictactoe.handlers import end, game, join, mode_selection, start
+from app.tictactoe.inline import (
+    InlineGame,
+    inline_game,
+    inline_query,
+    pack_callback,
+    unpack_callback
+)
+from app.tictactoe.lobby import begin, get_matchmaker, leave, queue
+from app.tictactoe.matchmaking import Tournament, WaitingPool, Waiting
+from app.tictactoe.ratings import RankIndex, create_rating_table, rate_game
+from app.tictactoe.outbound import OUTBOUND_KEY, OutboundQueue
+from app.tictactoe.position_cache import (
+    PositionCache,
+    canonical,
+    symmetries
 )
+from app.tictactoe.reaper import EXPIRED_TEXT, GameReaper
+from app.tictactoe.replay import (
+    CROSS_WIN,
+    ZERO_WIN,
+    DRAW as REPLAY_DRAW,
+    GameRecord,
+    ReplayLog,
+    aggregate,
+    read_records
+)
+from app.tictactoe.search import AlphaBetaEngine, MCTSEngine, WIN_SCORE
+from app.tictactoe.snapshot import MAGIC, GameSnapshot, pack_snapshot
+from app.tictactoe import supervisor
+from app.tictactoe.supervisor import (
+    HashRing,
+    Supervisor,
+    chat_id_of,
+    worker_of
+)
+from app.tictactoe.storage import (
+    LEGACY_GAME_ID,
+    FileGameStore,
+    MemoryGameStore,
+    ShardedGameStore,
+    create_store
+)
+from app.tictactoe.solver import (
+    DRAW,
+    lookup,
+    reachable_count,
+    reachable_positions
+)
+
+
+def test_core_imports_without_telegram():
+    """
+    Test that the board, the win checks, the AI, the stores and the
+    supervisor load without telegram, and main.py without the bot.
+    """
+    code = ("import sys, main, tictactoe.game_logic, tictactoe.ai_pool, "
+            "tictactoe.storage, tictactoe.replay, tictactoe.supervisor; "
+            "print(sorted(set(sys.modules) "
+            "& {'telegram', 'sqlite3', 'tictactoe.bot'}))")
+    app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+    loaded = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True,
+        check=True, env=dict(os.environ, PYTHONPATH=app_dir),
+    ).stdout
+    assert loaded.strip() == "[]"
 
 
 def test_get_default_state():
@@ -114,3 +217,1638 @@ def test_find_best_move_has_free_cells():
     assert 0 <= row < 3
     assert 0 <= col < 3
     assert board[row][col] == FREE_SPACE
+
+
+def test_solver_reachable_positions():
+    """
+    Test that the move table covers every reachable 3x3 position.
+    """
+    assert reachable_count() == 5478
+    assert lookup(0, 0) == (DRAW, 0b111111111)
+
+
+def test_find_best_move_takes_win():
+    """
+    Test that find_best_move() completes a line when it can.
+    """
+    board = [
+        [CROSS, CROSS, FREE_SPACE],
+        [ZERO, ZERO, FREE_SPACE],
+        [CROSS, FREE_SPACE, FREE_SPACE]
+    ]
+    assert find_best_move(board) == (1, 2)
+
+
+def test_find_best_move_never_loses():
+    """
+    Test that the AI playing ZERO never loses against any sequence
+    of CROSS moves.
+    """
+    def play(board):
+        for cell in range(9):
+            if not board.is_free(cell):
+                continue
+            child = Board(board.x, board.o)
+            child.place(cell, CROSS)
+            assert check_win(child) != CROSS
+            if is_draw(child):
+                continue
+            ai_r, ai_c = find_best_move(child)
+            child.place(ai_r * 3 + ai_c, ZERO)
+            if check_win(child) is None:
+                play(child)
+
+    play(get_default_state())
+
+
+def test_board_matches_rows():
+    """
+    Test that a Board built from a matrix renders back to the same matrix.
+    """
+    rows = [
+        [CROSS, ZERO, FREE_SPACE],
+        [FREE_SPACE, CROSS, ZERO],
+        [ZERO, FREE_SPACE, CROSS]
+    ]
+    board = Board.from_rows(rows)
+    assert board.to_rows() == rows
+    assert board.winner() == CROSS
+    assert not board.is_full()
+    assert board.is_free(2) and not board.is_free(0)
+
+
+def test_generate_keyboard_is_cached():
+    """
+    Test that the same position reuses one markup and is counted as a hit.
+    """
+    board = Board.from_rows([
+        [CROSS, FREE_SPACE, FREE_SPACE],
+        [FREE_SPACE, ZERO, FREE_SPACE],
+        [FREE_SPACE, FREE_SPACE, FREE_SPACE]
+    ])
+    first = generate_keyboard(board)
+    hits = keyboard_cache_stats()["hits"]
+    second = generate_keyboard(Board(board.x, board.o))
+    assert second is first
+    assert keyboard_cache_stats()["hits"] == hits + 1
+    assert first.inline_keyboard[1][1].text == ZERO
+    assert first.inline_keyboard[3][0].callback_data == "stop_game"
+
+
+def test_start_against_fake_api():
+    """
+    Test that /start sends the mode menu through the local Bot API stand-in.
+    """
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        try:
+            application = (Application.builder()
+                           .token("1:TEST")
+                           .base_url(api.base_url)
+                           .build())
+            application.add_handler(CommandHandler("start", start))
+            async with application:
+                update = Update.de_json({
+                    "update_id": 1,
+                    "message": {
+                        "message_id": 1,
+                        "date": 0,
+                        "chat": {"id": 42, "type": "private"},
+                        "from": {"id": 42, "is_bot": False,
+                                 "first_name": "Test"},
+                        "text": "/start",
+                        "entities": [{"type": "bot_command", "offset": 0,
+                                      "length": 6}],
+                    },
+                }, application.bot)
+                await application.process_update(update)
+        finally:
+            await api.stop()
+        return api.calls
+
+    calls = asyncio.run(scenario())
+    sent = [params for _, method, params in calls if method == "sendMessage"]
+    assert len(sent) == 1
+    assert sent[0]["chat_id"] == 42
+    menu = sent[0]["reply_markup"]["inline_keyboard"][0]
+    assert [button["callback_data"] for button in menu] == [
+        "mode_single", "mode_multi"
+    ]
+
+
+def test_file_store_write_behind(tmp_path):
+    """
+    Test that games reach the file only on flush and survive a restart.
+    """
+    path = str(tmp_path / "games.json")
+    store = FileGameStore(path)
+    game = {"board": Board(0b1, 0b10), "current_player": CROSS,
+            "players": [{"id": 1, "name": "a"}], "mode": "single"}
+    store.put((7, 70), game)
+    assert FileGameStore(path).get((7, 70)) is None
+
+    store.flush()
+    restored = FileGameStore(path).get((7, 70))
+    assert (restored["board"].x, restored["board"].o) == (0b1, 0b10)
+    assert restored["players"] == game["players"]
+    assert FileGameStore(path).games_of(7) == [70]
+
+    store.delete((7, 70))
+    assert store.get((7, 70)) is None
+    store.flush()
+    assert FileGameStore(path).get((7, 70)) is None
+
+
+def test_sharded_sqlite_store(tmp_path):
+    """
+    Test that a sharded SQLite store keeps each chat in its own shard file
+    and finds all games of a chat.
+    """
+    url = "sqlite:" + str(tmp_path / "games-{shard}.db")
+    store = create_store(url, shards=2)
+    for chat_id, message_id in ((10, 5), (11, 5), (11, 3)):
+        store.put((chat_id, message_id),
+                  {"board": Board(), "current_player": ZERO,
+                   "players": [], "mode": "multi"})
+    store.flush()
+
+    reopened = create_store(url, shards=2)
+    assert reopened.get((10, 5))["current_player"] == ZERO
+    assert reopened.shard(10).get((11, 5)) is None
+    assert reopened.shard(11).get((11, 5)) is not None
+    assert reopened.games_of(11) == [3, 5]
+    reopened.delete((11, 3))
+    assert reopened.games_of(11) == [5]
+
+
+def test_sqlite_store_moves_games_kept_per_chat(tmp_path):
+    """
+    Test that games stored one per chat by earlier versions are moved
+    under their board message, and games still waiting for a second
+    player under LEGACY_GAME_ID.
+    """
+    import sqlite3
+
+    path = str(tmp_path / "games.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE games ("
+                     "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.executemany("INSERT INTO games VALUES (?, ?)", [
+            (1, '{"board":[1,2],"message_id":9,"mode":"single"}'),
+            (-2, '{"board":[0,0],"mode":"multi","current_player":"❌",'
+                 '"players":[{"id":5,"name":"p5"}]}'),
+        ])
+    conn.close()
+
+    store = create_store("sqlite:" + path)
+    assert store.get((1, 9))["board"].o == 2
+    assert store.games_of(1) == [9]
+    assert store.games_of(-2) == [LEGACY_GAME_ID]
+
+    # /join gives the waiting game a board and moves it under it.
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url).build())
+            application.bot_data["game_store"] = store
+            application.add_handler(CommandHandler("join", join))
+            async with application:
+                await application.process_update(Update.de_json({
+                    "update_id": 1, "message": {
+                        "message_id": 1, "date": 0, "text": "/join",
+                        "chat": {"id": -2, "type": "group"},
+                        "from": {"id": 6, "is_bot": False,
+                                 "first_name": "p6"},
+                        "entities": [{"type": "bot_command", "offset": 0,
+                                      "length": 5}],
+                    },
+                }, application.bot))
+            return [method for _, method, _ in api.calls]
+        finally:
+            await api.stop()
+
+    methods = asyncio.run(scenario())
+    assert "editMessageText" not in methods
+    (game_id,) = store.games_of(-2)
+    assert game_id != LEGACY_GAME_ID
+    assert len(store.get((-2, game_id))["players"]) == 2
+
+
+def test_sqlite_store_reads_beside_a_batch_commit(tmp_path):
+    """
+    Test that games are read on their own connection: a batch still
+    being written does not hold up or leak into reads.
+    """
+    store = create_store("sqlite:" + str(tmp_path / "games.db"))
+    writer = store._conn
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("INSERT INTO games VALUES (2, 6, '{\"board\":[1,2]}')")
+    assert store.get((2, 6)) is None and store.games_of(2) == []
+    writer.commit()
+    assert store.get((2, 6))["board"].o == 2
+    asyncio.run(store.stop())
+
+
+def test_chat_serial_update_processor_stress():
+    """
+    Test that interleaved updates of one chat are handled one by one and in
+    order, while different chats run in parallel.
+    """
+    async def scenario():
+        processor = ChatSerialUpdateProcessor(max_concurrent_updates=8)
+        games = {1: [], 2: []}
+        running = {"now": 0, "max": 0}
+
+        async def click(chat_id, move):
+            # Read-await-write, like handlers.game around Telegram calls.
+            moves = list(games[chat_id])
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            await asyncio.sleep(0)
+            await asyncio.sleep(0.001 * (move % 3))
+            running["now"] -= 1
+            games[chat_id] = moves + [move]
+
+        tasks = []
+        for move in range(100):
+            for chat_id in (1, 2):
+                update = SimpleNamespace(
+                    effective_chat=SimpleNamespace(id=chat_id)
+                )
+                tasks.append(asyncio.create_task(
+                    processor.process_update(update, click(chat_id, move))
+                ))
+        await asyncio.gather(*tasks)
+        return games, running["max"], len(processor.locks)
+
+    games, max_running, locks_left = asyncio.run(scenario())
+    assert games[1] == list(range(100))
+    assert games[2] == list(range(100))
+    assert max_running == 2
+    assert locks_left == 0
+
+
+def test_outbound_queue_coalesces_and_isolates_flood_waits():
+    """
+    Test that pending edits of one message collapse into the latest one,
+    notices to a busy chat are dropped, and a flood wait in one chat does
+    not delay another chat.
+    """
+    async def scenario():
+        outbound = OutboundQueue(global_rate=1000, chat_rate=1000,
+                                 chat_burst=1000)
+        sent = []
+        flooded = {"done": False}
+
+        async def send(chat_id, text):
+            if chat_id == 1 and not flooded["done"]:
+                flooded["done"] = True
+                raise RetryAfter(0.2)
+            sent.append((chat_id, text))
+
+        for text in ("a", "b", "c"):
+            outbound.submit(1, partial(send, 1, text), key=(1, 100))
+        outbound.submit(1, partial(send, 1, "busy"), droppable=True)
+        outbound.submit(2, partial(send, 2, "x"))
+        await asyncio.sleep(0.05)
+        early = list(sent)
+        outbound.submit(1, partial(send, 1, "d"), key=(1, 100))
+        await outbound.flush()
+        return early, sent, outbound.stats()
+
+    early, sent, stats = asyncio.run(scenario())
+    assert early == [(2, "x")]
+    assert sent == [(2, "x"), (1, "d")]
+    assert stats["coalesced"] == 3
+    assert stats["dropped"] == 1
+    assert stats["pending"] == 0
+
+
+@pytest.mark.parametrize("size,k,cells,expected", [
+    (7, 4, [0, 8, 16, 24], CROSS),
+    (7, 4, [6, 12, 18, 24], CROSS),
+    (7, 4, [0, 1, 2, 4], None),
+    (15, 5, [30, 45, 60, 75, 90], CROSS),
+    (15, 5, [14, 15, 16, 17, 18], None),
+])
+def test_grid_board_incremental_win(size, k, cells, expected):
+    """
+    Test that GridBoard detects K in a row through the last move only,
+    without wrapping around the board edge.
+    """
+    board = GridBoard(size, k)
+    for cell in cells:
+        board.place(cell, CROSS)
+    assert board.winner() == expected
+    restored = GridBoard(size, k, board.x, board.o)
+    assert restored.winner() == expected
+
+
+def test_grid_keyboard_fits_telegram_limits():
+    """
+    Test that a 15x15 board is shown through a window with scroll buttons
+    and that cell callbacks round-trip.
+    """
+    board = GridBoard(15, 5)
+    board.place(224, ZERO)
+    markup = generate_keyboard(board, focus=224)
+    rows = markup.inline_keyboard
+    assert all(len(row) <= 8 for row in rows)
+    assert sum(len(row) for row in rows) <= 100
+    assert rows[7][7].text == ZERO
+    assert parse_cell(rows[7][7].callback_data, 15) == 224
+    assert [b.text for b in rows[8]] == ["⬅️", "⬆️"]
+    assert cell_callback(7, 3) == "21"
+
+
+def test_find_best_move_blocks_on_grid():
+    """
+    Test that the large-board AI blocks an open line of the opponent.
+    """
+    board = GridBoard(7, 4)
+    for cell, symbol in ((22, CROSS), (0, ZERO), (23, CROSS), (6, ZERO),
+                         (24, CROSS)):
+        board.place(cell, symbol)
+    assert find_best_move(board) in ((3, 0), (3, 4))
+
+
+@pytest.mark.parametrize("engine", [AlphaBetaEngine(), MCTSEngine()])
+def test_search_engines_block_and_respect_budget(engine):
+    """
+    Test that both engines block an immediate threat, stop within the node
+    budget and report nodes per second.
+    """
+    x = sum(1 << (3 * 7 + col) for col in (1, 2, 3))
+    o = (1 << 0) | (1 << 6)
+    assert engine.search(7, 4, x, o, time_limit=1).move in (21, 25)
+
+    result = engine.search(15, 5, 1 << 112, 1 << 113, time_limit=0,
+                           node_limit=300)
+    assert result.move is not None
+    assert 0 < result.nodes <= 301
+    assert result.nps > 0
+
+
+def test_alphabeta_finds_forced_win():
+    """
+    Test that alpha-beta sees a win two moves ahead: an open line of three
+    on a 7x7, 4-in-a-row board, and stores positions in its table.
+    """
+    engine = AlphaBetaEngine(tt_bits=10)
+    x = (1 << 22) | (1 << 23)
+    o = (1 << 0) | (1 << 48)
+    result = engine.search(7, 4, x, o, time_limit=2)
+    assert result.move == 24
+    assert result.score >= WIN_SCORE - 49
+    assert engine.table.stores > 0
+
+
+def test_find_best_move_async_on_grid():
+    """
+    Test that the large-board search also works off the event loop.
+    """
+    board = GridBoard(7, 4)
+    for cell, symbol in ((22, CROSS), (0, ZERO), (23, CROSS), (6, ZERO),
+                         (24, CROSS)):
+        board.place(cell, symbol)
+    move = asyncio.run(find_best_move_async(board))
+    assert move in ((3, 0), (3, 4))
+
+
+def test_ai_pool_workers_and_backpressure():
+    """
+    Test that large-board moves are computed in a worker process from a
+    packed board and that moves over max_pending fall back to the
+    heuristic.
+    """
+    x, o = (1 << 224) | (1 << 3), 1 << 112
+    assert unpack_board(pack_board(15, 5, x, o)) == (15, 5, x, o)
+    assert len(pack_board(15, 5, x, o)) == 60
+
+    board = GridBoard(7, 4)
+    for cell, symbol in ((22, CROSS), (0, ZERO), (23, CROSS), (6, ZERO),
+                         (24, CROSS)):
+        board.place(cell, symbol)
+
+    # The position is also searched by other tests of this process.
+    sys.modules[AIPool.__module__].get_position_cache().clear()
+
+    async def play() -> list:
+        pool = AIPool(workers=1, max_pending=1)
+        pool.start()
+        try:
+            return await asyncio.gather(pool.best_move(board),
+                                        pool.best_move(board)), pool.stats()
+        finally:
+            pool.shutdown()
+
+    moves, stats = asyncio.run(play())
+    assert all(move in ((3, 0), (3, 4)) for move in moves)
+    assert stats == {"searched": 1, "fallback": 1, "failed": 0,
+                     "pending": 0}
+
+
+def test_position_cache_maps_moves_through_symmetries():
+    """
+    Test that the 8 symmetric copies of a position share one cache entry,
+    that the stored move comes back rotated or reflected with the board,
+    and that the cache is bounded.
+    """
+    x = (1 << 8) | (1 << 9)
+    o = 1 << 16
+    forward = symmetries(7)[0]
+
+    def permute(mask, t):
+        return sum(1 << forward[t][i] for i in range(49) if mask >> i & 1)
+
+    cache = PositionCache(2)
+    cache.put(*canonical(7, 4, x, o), 10)
+    for t in range(8):
+        key, transform = canonical(7, 4, permute(x, t), permute(o, t))
+        assert cache.get(key, transform) == forward[t][10]
+    assert cache.stats()["hits"] == 8
+
+    cache.put(*canonical(7, 4, 1, 0), 24)
+    cache.put(*canonical(7, 4, 2, 0), 24)
+    assert len(cache) == 2
+    assert cache.get(*canonical(7, 4, x, o)) is None
+    assert cache.misses == 1
+
+    pool = AIPool(workers=0)
+    # No symmetry maps this position onto itself, so the mirrored move
+    # is the only equivalent one.
+    board = GridBoard(7, 4)
+    board.place(30, CROSS)
+    board.place(7, ZERO)
+    mirrored = GridBoard(7, 4)
+    mirrored.place(32, CROSS)
+    mirrored.place(13, ZERO)
+    # The cache the pool uses, see test_handler_metrics_endpoint().
+    shared = sys.modules[AIPool.__module__].get_position_cache()
+    shared.clear()
+
+    async def moves():
+        return await pool.best_move(board), await pool.best_move(mirrored)
+
+    move, mirrored_move = asyncio.run(moves())
+    assert pool.stats()["searched"] == 1
+    assert shared.stats()["hits"] == 1
+    assert mirrored_move == (move[0], 6 - move[1])
+
+
+def test_book_is_mapped_and_played_before_search(tmp_path, monkeypatch):
+    """
+    Test that a built book is read back through the memory map in any
+    orientation, that endings of logged games are solved, and that
+    find_best_move() plays book moves without searching.
+    """
+    log_path = str(tmp_path / "games.log")
+    log = ReplayLog(log_path)
+    # CROSS completes row 0 with cell 3; ZERO fills row 1.
+    log.append(GameRecord(7, 4, 1, 0, 1700000000, 1, 2,
+                          bytes([0, 7, 1, 8, 2, 9, 3])))
+    asyncio.run(log.stop())
+    entries = build_entries(7, 4, 2, [log_path], tail=1, time_limit=0,
+                            node_limit=2000)
+    # Empty board, the center and 2 classes of replies, the ending.
+    assert len(entries) == 5
+    path = str(tmp_path / "book.bin")
+    write_book(path, entries)
+
+    # The book module the game logic uses, see
+    # test_position_cache_maps_moves_through_symmetries().
+    shared = sys.modules[
+        sys.modules[find_best_move.__module__].book_move.__module__
+    ]
+    book = shared.OpeningBook(path)
+    assert len(book) == 5
+    assert book.probe(7, 4, 0, 0).move == 24
+    # The ending flipped upside down.
+    x = (1 << 42) | (1 << 43) | (1 << 44)
+    o = (1 << 35) | (1 << 36) | (1 << 37)
+    assert book.probe(7, 4, x, o) == (45, 1, shared.ENDGAME)
+    assert book.probe(7, 4, 1, 0) is None
+
+    monkeypatch.setattr(shared, "_book", book)
+    monkeypatch.setattr(shared, "_book_loaded", True)
+    board = GridBoard(7, 4, x, o)
+    cache = sys.modules[AIPool.__module__].get_position_cache()
+    misses = cache.misses
+    assert find_best_move(board) == (6, 3)
+    assert cache.misses == misses
+    assert book.hits == 3
+    book.close()
+
+    with open(path, "r+b") as file:
+        file.truncate(40)
+    with pytest.raises(ValueError):
+        shared.OpeningBook(path)
+
+
+def test_handler_metrics_endpoint():
+    """
+    Test that an instrumented handler records its latency and Telegram API
+    time and that both are served on /metrics.
+    """
+    # Handlers import the package as "tictactoe", so the metrics they
+    # update live there rather than in app.tictactoe.metrics.
+    metrics = sys.modules[handlers.instrument.__module__]
+    api_time = metrics.HANDLER_API_SECONDS.labels("start")
+    total_time = metrics.HANDLER_SECONDS.labels("start")
+    count_before = total_time.count
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        server = metrics.MetricsServer(port=0)
+        await server.start()
+        try:
+            application = (Application.builder()
+                           .token("1:TEST")
+                           .base_url(api.base_url)
+                           .request(metrics.InstrumentedRequest())
+                           .build())
+            application.add_handler(CommandHandler("start", start))
+            async with application:
+                update = Update.de_json({
+                    "update_id": 1,
+                    "message": {
+                        "message_id": 1,
+                        "date": 0,
+                        "chat": {"id": 42, "type": "private"},
+                        "from": {"id": 42, "is_bot": False,
+                                 "first_name": "Test"},
+                        "text": "/start",
+                        "entities": [{"type": "bot_command", "offset": 0,
+                                      "length": 6}],
+                    },
+                }, application.bot)
+                await application.process_update(update)
+            async with httpx.AsyncClient() as client:
+                url = f"http://127.0.0.1:{server.port}/metrics"
+                return (await client.get(url)).text
+        finally:
+            await server.stop()
+            await api.stop()
+
+    text = asyncio.run(scenario())
+    assert total_time.count == count_before + 1
+    assert 0 < api_time.sum <= total_time.sum
+    line = 'tictactoe_handler_seconds_count{handler="start"} %d' % (
+        count_before + 1
+    )
+    assert line in text
+    assert 'tictactoe_telegram_api_seconds_count{method="sendMessage"}' \
+        in text
+
+
+def test_reaper_expires_idle_and_least_recent_games():
+    """
+    Test that the reaper expires games idle past the TTL and the least
+    recently active ones above the cap and edits their board messages.
+    """
+    store = MemoryGameStore()
+    for chat_id in range(1, 6):
+        store.put((chat_id, 100 + chat_id), {"board": Board()})
+
+    async def scenario():
+        edits = []
+
+        async def edit_message_text(text, chat_id, message_id):
+            edits.append((chat_id, message_id, text))
+
+        context = SimpleNamespace(
+            bot=SimpleNamespace(edit_message_text=edit_message_text),
+            bot_data={"game_store": store, "outbound": OutboundQueue()},
+        )
+        reaper = GameReaper(ttl=0.2, max_games=3)
+
+        # Cap only: chats 1 and 2 are the least recently active.
+        store.get((1, 101))
+        await reaper(context)
+        capped = sorted(key for key, _ in store.items())
+        await asyncio.sleep(0.25)
+        store.put((4, 104), store.get((4, 104)))
+        # TTL: everything but chat 4 is idle now.
+        await reaper(context)
+        await context.bot_data["outbound"].flush()
+        return capped, edits
+
+    capped, edits = asyncio.run(scenario())
+    assert capped == [(1, 101), (4, 104), (5, 105)]
+    assert sorted(edits) == [(chat_id, 100 + chat_id, EXPIRED_TEXT)
+                             for chat_id in (1, 2, 3, 5)]
+    assert len(store) == 1 and store.get((4, 104)) is not None
+    assert store.games_of(4) == [104] and store.games_of(1) == []
+
+
+def test_replay_log_roundtrip_and_stats(tmp_path):
+    """
+    Test that game records survive a write / mmap read roundtrip, that a
+    record cut short at the end is skipped and that stats are aggregated.
+    """
+    path = str(tmp_path / "games.log")
+    records = [
+        GameRecord(3, 3, 0, 0, 1700000000, 42, 0, bytes([4, 0, 8, 2, 6])),
+        GameRecord(3, 3, 0, 2, 1700000001, 42, 0, bytes(range(9))),
+        GameRecord(15, 5, 1, 1, 1700000002, 1, 2, bytes([112, 224, 0])),
+    ]
+    log = ReplayLog(path, buffer_size=64)
+    for record in records:
+        log.append(record)
+    asyncio.run(log.stop())
+    with open(path, "ab") as file:
+        file.write(b"\x03\x03\x00")
+
+    assert list(read_records(path)) == records
+    stats = aggregate([path, path])
+    assert stats["games"] == 6
+    single = stats["groups"]["single 3x3"]
+    assert (single["human_win"], single["human_draw"],
+            single["human_loss"]) == (2, 2, 0)
+    assert single["avg_moves"] == 7
+    assert stats["groups"]["multi 15x15"]["zero_win"] == 2
+
+
+def test_simulator_vectorized_and_single_games():
+    """
+    Test that the vectorized 3x3 simulator matches the known statistics
+    of random play, that the table AI never loses, and that large boards
+    are played through the same rules.
+    """
+    random_play = run_shard(50_000, "3", "random", "random", seed=1)
+    assert random_play["games"] == 50_000
+    assert abs(random_play["cross_win"] / 50_000 - 0.585) < 0.01
+    assert abs(random_play["draw"] / 50_000 - 0.127) < 0.01
+
+    assert run_shard(20_000, "3", "ai", "random", seed=2)["zero_win"] == 0
+    assert run_shard(20_000, "3", "random", "ai", seed=3)["cross_win"] == 0
+    assert run_shard(200, "3", "ai", "heuristic", seed=4)["zero_win"] == 0
+
+    grid = run_shard(2, "7", "heuristic", "random", seed=5)
+    assert grid["games"] == 2 and 7 <= grid["moves"] <= 2 * 49
+
+
+def test_batch_evaluation_matches_board():
+    """
+    Test that both batch layouts agree with the per-board checks on every
+    reachable position and that masks_view() does not copy the buffer.
+    """
+    positions = [Board(x, o) for x, o in reachable_positions()]
+    buffer = batch.pack_masks(positions)
+    masks = batch.masks_view(buffer)
+    buffer[0] = 0b111
+    assert masks[0, 0] == 0b111
+    buffer[0] = positions[0].x
+
+    cells = batch.masks_to_cells(masks)
+    assert (batch.cells_to_masks(cells) == masks).all()
+    for result in (batch.evaluate(cells), batch.evaluate_masks(masks)):
+        for i, board in enumerate(positions):
+            winner = {CROSS: batch.X, ZERO: batch.O}.get(check_win(board),
+                                                           batch.FREE)
+            assert result.winners[i] == winner
+            # is_draw() is only called once check_win() found no winner.
+            assert result.draws[i] == (not winner and is_draw(board))
+            assert result.legal[i] == (0 if winner else board.free_mask)
+
+
+def test_hash_ring_moves_only_chats_of_changed_worker():
+    """
+    Test that chats spread over all workers and that adding a worker only
+    moves chats onto it.
+    """
+    ring = HashRing(range(4))
+    before = {chat: ring.node_for(chat) for chat in range(10_000)}
+    assert min(list(before.values()).count(node) for node in range(4)) \
+        > 1500
+    ring.add(4)
+    moved = [chat for chat in before if ring.node_for(chat) != before[chat]]
+    assert all(ring.node_for(chat) == 4 for chat in moved)
+    assert 1000 < len(moved) < 3000
+    ring.remove(4)
+    assert all(ring.node_for(chat) == node for chat, node in before.items())
+
+    query = {"update_id": 1, "callback_query": {
+        "id": "1", "from": {"id": 5}, "message": {"chat": {"id": -7}}}}
+    assert chat_id_of(query) == -7
+    assert chat_id_of({"update_id": 2, "inline_query": {"from": {"id": 5}}}) \
+        == 5
+
+    # Lobby commands and clicks on boards of /queue games go to the
+    # lowest worker, whatever the chat.
+    command = {"update_id": 3, "message": {
+        "chat": {"id": 5}, "text": "/queue@bot 7"}}
+    assert chat_id_of(command) == LOBBY_CHAT
+    command["message"]["text"] = "/start"
+    assert chat_id_of(command) == 5
+    query["callback_query"]["data"] = "L1f:00"
+    assert chat_id_of(query) == LOBBY_CHAT
+    ring.remove(0)
+    assert worker_of(ring, LOBBY_CHAT) == 1
+
+
+def test_supervisor_routes_chats_and_restarts_workers(monkeypatch):
+    """
+    Test that the supervisor answers updates of every chat through its
+    worker processes, holds updates while a worker restarts and brings
+    back a worker that died.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "app", "main.py")
+    command = [sys.executable, script, "--mode", "worker", "--listen",
+               "127.0.0.1", "--url-path", "telegram"]
+    monkeypatch.setenv("AI_WORKERS", "0")
+    monkeypatch.setattr(supervisor, "METRICS_PORT", 0)
+
+    def start_update(update_id, chat_id):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False,
+                         "first_name": "Test"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0,
+                              "length": 6}],
+            },
+        }
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        monkeypatch.setenv("TELEGRAM_API_URL", api.base_url)
+        monkeypatch.setattr(supervisor, "TELEGRAM_API_URL", api.base_url)
+        ingress = Supervisor(command, 2, "127.0.0.1", 0, "telegram",
+                             webhook_url="http://bot.example/telegram",
+                             secret_token="secret", stop_timeout=10)
+        await ingress.start()
+        url = f"http://127.0.0.1:{ingress.port}/telegram"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+        chats = range(100, 110)
+        try:
+            async with httpx.AsyncClient() as client:
+                denied = await client.post(url, json=start_update(1, 100))
+                assert denied.status_code == 403
+
+                restart = asyncio.create_task(ingress.restart(0))
+                await asyncio.sleep(0)
+                statuses = await asyncio.gather(*(
+                    client.post(url, json=start_update(chat, chat),
+                                headers=headers)
+                    for chat in chats
+                ))
+                await restart
+
+                chat = next(chat for chat in chats
+                            if ingress.worker_for(chat) == 1)
+                ingress._workers[1].process.kill()
+                await asyncio.sleep(0.1)
+                revived = await client.post(url,
+                                            json=start_update(200, chat),
+                                            headers=headers)
+                await asyncio.sleep(0.5)
+        finally:
+            await ingress.stop()
+            await api.stop()
+        return api.calls, statuses, revived
+
+    calls, statuses, revived = asyncio.run(scenario())
+    assert [response.status_code for response in statuses] == [200] * 10
+    assert revived.status_code == 200
+    methods = [method for _, method, _ in calls]
+    assert methods.count("setWebhook") == 1
+    sent = [int(params["chat_id"]) for _, method, params in calls
+            if method == "sendMessage"]
+    assert sorted(set(sent)) == list(range(100, 110))
+    assert len(sent) == 11
+
+
+def test_supervisor_scaling_moves_games_to_new_workers(monkeypatch):
+    """
+    Test that games in progress keep being played after the supervisor
+    removes and adds workers, whichever worker their chat moves to.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "app", "main.py")
+    command = [sys.executable, script, "--mode", "worker", "--listen",
+               "127.0.0.1", "--url-path", "telegram"]
+    monkeypatch.setenv("AI_WORKERS", "0")
+    monkeypatch.setattr(supervisor, "METRICS_PORT", 0)
+    chats = range(100, 108)
+
+    def message(chat_id, message_id, text=""):
+        return {"message_id": message_id, "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False,
+                         "first_name": f"p{chat_id}"},
+                "text": text}
+
+    def click(update_id, chat_id, message_id, data):
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": "1",
+            "from": message(chat_id, 0)["from"], "data": data,
+            "message": message(chat_id, message_id),
+        }}
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        sent = {}
+        api.listeners.append(
+            lambda method, params, result: sent.setdefault(
+                int(params["chat_id"]), []).append(
+                    (params["text"], result["message_id"]))
+            if method == "sendMessage" else None
+        )
+        await api.start()
+        monkeypatch.setenv("TELEGRAM_API_URL", api.base_url)
+        ingress = Supervisor(command, 2, "127.0.0.1", 0, "telegram",
+                             stop_timeout=10)
+        await ingress.start()
+        url = f"http://127.0.0.1:{ingress.port}/telegram"
+
+        async def wait_for(condition):
+            for _ in range(200):
+                if condition():
+                    return
+                await asyncio.sleep(0.05)
+            raise AssertionError("Timed out")
+
+        def edits():
+            return [params["text"] for _, method, params in api.calls
+                    if method == "editMessageText"
+                    and params["text"].startswith("Ваш ход")]
+
+        try:
+            async with httpx.AsyncClient() as client:
+                for chat in chats:
+                    update = {"update_id": chat,
+                              "message": message(chat, 1, "/start")}
+                    update["message"]["entities"] = [
+                        {"type": "bot_command", "offset": 0, "length": 6}
+                    ]
+                    await client.post(url, json=update)
+                await wait_for(lambda: len(sent) == len(chats))
+                for chat in chats:
+                    await client.post(url, json=click(
+                        1000 + chat, chat, sent[chat][0][1], "mode_single"
+                    ))
+                await wait_for(lambda: all(len(sent[chat]) == 2
+                                           for chat in chats))
+                moved = [chat for chat in chats
+                         if ingress.worker_for(chat) == 1]
+                await ingress.scale(1)
+                for chat in chats:
+                    await client.post(url, json=click(
+                        2000 + chat, chat, sent[chat][1][1], "00"
+                    ))
+                await wait_for(lambda: len(edits()) == len(chats))
+                await ingress.scale(3)
+                # The cell is taken: the game answers, not "Нет игры".
+                for chat in chats:
+                    await client.post(url, json=click(
+                        3000 + chat, chat, sent[chat][1][1], "00"
+                    ))
+                await wait_for(lambda: all(len(sent[chat]) == 3
+                                           for chat in chats))
+                spread = {ingress.worker_for(chat) for chat in chats}
+        finally:
+            await ingress.stop()
+            await api.stop()
+        return sent, moved, spread
+
+    sent, moved, spread = asyncio.run(scenario())
+    assert moved and len(spread) > 1
+    assert all(messages[2][0].startswith("Клетка занята")
+               for messages in sent.values())
+
+
+def test_snapshot_restores_games(tmp_path):
+    """
+    Test that a snapshot brings back the games of every board, their
+    order of activity, and is used only once.
+    """
+    path = str(tmp_path / "snapshot.bin")
+    store = MemoryGameStore()
+    store.put((1, 5), {"board": Board(0b1, 0b10), "current_player": CROSS,
+                       "mode": "single"})
+    store.put((-100, 7), {"board": GridBoard(7, 4, 1 << 24, 1 << 25),
+                          "current_player": ZERO, "mode": "multi"})
+    store.put((-100, 2**40), {"board": Board(), "current_player": CROSS,
+                              "mode": "multi"})
+    assert GameSnapshot(path).save(store) == 3
+
+    restored = ShardedGameStore([MemoryGameStore(), MemoryGameStore()])
+    assert GameSnapshot(path).restore(restored) == 3
+    assert [key for key, _ in restored.shard(1).items()] == [(1, 5)]
+    game = restored.get((-100, 7))
+    assert (game["board"].size, game["board"].x) == (7, 1 << 24)
+    assert restored.games_of(-100) == [7, 2**40]
+    assert not os.path.exists(path)
+    assert GameSnapshot(path).restore(MemoryGameStore()) == 0
+
+    with open(path, "wb") as file:
+        file.write(b"TTTS\x01")
+    assert GameSnapshot(path).restore(MemoryGameStore()) == 0
+    assert not os.path.exists(path)
+
+
+def test_truncated_snapshot_starts_empty(tmp_path):
+    """
+    Test that a snapshot cut short, in the zlib stream or inside a
+    record, is skipped as a whole and removed instead of stopping the
+    start.
+    """
+    path = str(tmp_path / "snapshot.bin")
+    data = pack_snapshot([
+        ((1, 5), {"board": Board(0b1, 0b10), "current_player": CROSS,
+                  "mode": "single"}),
+        ((2, 6), {"board": Board(), "current_player": CROSS,
+                  "mode": "single"}),
+    ])
+    body = zlib.decompress(data[len(MAGIC):])
+    for broken in (data[:len(data) // 2],
+                   MAGIC + zlib.compress(body[:-3]),
+                   MAGIC + zlib.compress(body + b"\x01\x02")):
+        with open(path, "wb") as file:
+            file.write(broken)
+        store = MemoryGameStore()
+        assert GameSnapshot(path).restore(store) == 0
+        assert len(store) == 0 and not os.path.exists(path)
+
+
+def test_drain_updates_cancels_updates_past_deadline():
+    """
+    Test that draining waits for quick updates, cancels the ones still
+    running at the deadline and drops updates arriving afterwards.
+    """
+    async def scenario():
+        processor = ChatSerialUpdateProcessor(4)
+        application = SimpleNamespace(update_processor=processor,
+                                      update_queue=asyncio.Queue())
+        done = []
+
+        async def handle(chat_id, delay):
+            await asyncio.sleep(delay)
+            done.append(chat_id)
+
+        def update(chat_id):
+            return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+        tasks = [asyncio.create_task(processor.process_update(
+            update(chat_id), handle(chat_id, delay)
+        )) for chat_id, delay in ((1, 0.01), (2, 0.05), (3, 10))]
+        await asyncio.sleep(0)
+        cancelled = await drain_updates(application, 0.2)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await processor.process_update(update(4), handle(4, 0))
+        return cancelled, done, processor.in_flight
+
+    cancelled, done, in_flight = asyncio.run(scenario())
+    assert cancelled == 1
+    assert done == [1, 2]
+    assert in_flight == 0
+
+
+def test_shutdown_flushes_outbound_edits_before_closing_the_bot():
+    """
+    Test that edits still queued when SIGTERM arrives reach the API
+    before the bot closes its HTTP client.
+    """
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url)
+                           .concurrent_updates(ChatSerialUpdateProcessor(1))
+                           .build())
+            outbound = OutboundQueue(global_rate=1000, chat_rate=2,
+                                     chat_burst=1)
+            application.bot_data[OUTBOUND_KEY] = outbound
+
+            async def start_updates():
+                for message_id in (1, 2, 3):
+                    outbound.submit(7, partial(
+                        application.bot.edit_message_text, "bye",
+                        chat_id=7, message_id=message_id
+                    ), key=(7, message_id))
+                os.kill(os.getpid(), signal.SIGTERM)
+
+            async def stop_updates():
+                pass
+
+            await serve_application(application, start_updates,
+                                    stop_updates, 1)
+            edits = [params for _, method, params in api.calls
+                     if method == "editMessageText"]
+            return edits, outbound.stats()
+        finally:
+            await api.stop()
+
+    edits, stats = asyncio.run(scenario())
+    assert sorted(int(params["message_id"]) for params in edits) \
+        == [1, 2, 3]
+    assert stats["failed"] == 0 and stats["pending"] == 0
+
+
+def test_waiting_pool_pairs_nearest_rating_first_come_first_served():
+    """
+    Test that the pool pairs with the nearest bucket, the longest waiting
+    player of it, never past the rating gap, and forgets players who
+    leave.
+    """
+    pool = WaitingPool(bucket_width=50)
+    for user_id in range(5000):
+        pool.add(Waiting(user_id, 1000 + user_id % 40 * 50, user_id, "p",
+                         user_id))
+    assert len(pool) == 5000
+    assert pool.remove(41).user_id == 41
+
+    opponent = pool.pop_match(1060, max_gap=300)
+    assert (opponent.user_id, opponent.rating) == (1, 1050)
+    assert pool.pop_match(1060, max_gap=300).user_id == 81
+    assert pool.pop_match(-400, max_gap=300) is None
+    assert pool.pop_match(-400, max_gap=1400).rating == 1000
+    assert 1 not in pool and 2 in pool
+
+    for user_id in list(range(5000)):
+        pool.remove(user_id)
+    assert len(pool) == 0 and pool.pop_match(1000, 10 ** 6) is None
+
+
+def test_swiss_tournament_avoids_rematches_and_ranks_players():
+    """
+    Test that a tournament of five plays ceil(log2(5)) rounds with a bye,
+    pairs players who have not met and ranks them by score.
+    """
+    tournament = Tournament(-1, "3", organizer=1)
+    for user_id in range(1, 6):
+        assert tournament.register(user_id, f"p{user_id}", 1000 + user_id)
+    assert not tournament.register(1, "p1", 1001)
+
+    met = set()
+    byes = []
+    while not tournament.finished:
+        pairs, bye = tournament.pair_round()
+        byes.append(bye.user_id)
+        for cross, zero in pairs:
+            pair = frozenset((cross.user_id, zero.user_id))
+            assert pair not in met
+            met.add(pair)
+            # The higher user id always wins.
+            outcome = CROSS_WIN if cross.user_id > zero.user_id else ZERO_WIN
+            tournament.report(cross.user_id, zero.user_id, outcome)
+        assert not tournament.register(9, "late", 1000)
+
+    assert tournament.rounds == tournament.round == 3
+    assert len(set(byes)) == 3
+    standings = tournament.standings()
+    assert standings[0].user_id == 5
+    assert [p.score for p in standings] == sorted(
+        (p.score for p in standings), reverse=True
+    )
+
+
+def test_swiss_pairing_backtracks_without_recursion():
+    """
+    Test that a round undoes a pair when the rest cannot be paired, and
+    that a round of thousands of players is paired without running out
+    of stack.
+    """
+    tournament = Tournament(-1, "3", organizer=1)
+    for user_id in range(1, 5):
+        tournament.register(user_id, f"p{user_id}", 1000)
+    tournament.players[3].opponents.add(4)
+    tournament.players[4].opponents.add(3)
+    pairs, bye = tournament.pair_round()
+    assert bye is None
+    assert {frozenset((a.user_id, b.user_id)) for a, b in pairs} \
+        == {frozenset((1, 3)), frozenset((2, 4))}
+
+    tournament = Tournament(-1, "3", organizer=1)
+    for user_id in range(1, 2401):
+        tournament.register(user_id, f"p{user_id}", 1000 + user_id % 7)
+    pairs, bye = tournament.pair_round()
+    assert bye is None and len(pairs) == 1200
+    assert len({p.user_id for pair in pairs for p in pair}) == 2400
+
+
+def test_begin_reports_a_failed_round_to_the_group():
+    """
+    Test that /begin answers with an error when the round cannot be
+    announced, instead of leaving the group without a reply.
+    """
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    async def send_message(chat_id, text):
+        raise TelegramError("Forbidden: bot was kicked from the group chat")
+
+    context = SimpleNamespace(bot_data={}, args=[],
+                              bot=SimpleNamespace(send_message=send_message))
+    matchmaker = get_matchmaker(context)
+    matchmaker.open_tournament(Tournament(-5, "3", organizer=1))
+    for user_id in (1, 2):
+        matchmaker.enter(matchmaker.tournaments[-5], user_id, f"p{user_id}")
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=-5),
+                             effective_user=SimpleNamespace(id=1),
+                             message=SimpleNamespace(reply_text=reply_text))
+    asyncio.run(begin(update, context))
+    assert replies == ["Произошла ошибка при /begin."]
+
+
+def test_leave_withdraws_from_a_tournament_before_it_starts():
+    """
+    Test that /leave takes a player out of a tournament that has not
+    started, so they are not paired, and does nothing once it has.
+    """
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    context = SimpleNamespace(bot_data={}, args=[])
+    matchmaker = get_matchmaker(context)
+    matchmaker.open_tournament(Tournament(-5, "3", organizer=1))
+    current = matchmaker.tournaments[-5]
+    for user_id in (1, 2, 3):
+        matchmaker.enter(current, user_id, f"p{user_id}")
+
+    def update(user_id):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=-5),
+                               effective_user=SimpleNamespace(id=user_id),
+                               message=SimpleNamespace(reply_text=reply_text))
+
+    asyncio.run(leave(update(3), context))
+    assert replies == ["Вы вышли из турнира. Участников: 2."]
+    assert matchmaker.tournament_of(3) is None and 3 not in current.players
+    pairs, bye = current.pair_round()
+    assert bye is None and len(pairs) == 1
+    assert matchmaker.withdraw(1) is None and 1 in current.players
+
+
+def test_queue_matches_private_chats_and_mirrors_moves():
+    """
+    Test that two players of /queue get boards in their private chats,
+    that the game is stored once for both boards, that each move is shown
+    on both boards, that the win frees them and that /leave resigns.
+    """
+    def message(user_id, text):
+        return {"message_id": 1, "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False,
+                         "first_name": f"p{user_id}"},
+                "text": text}
+
+    def command(update_id, user_id, text):
+        update = message(user_id, text)
+        update["entities"] = [{"type": "bot_command", "offset": 0,
+                               "length": len(text)}]
+        return {"update_id": update_id, "message": update}
+
+    def board_sent(method, params, result):
+        if method == "sendMessage" and "reply_markup" in params:
+            markup = params["reply_markup"]
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            data = markup["inline_keyboard"][0][0]["callback_data"]
+            boards[int(params["chat_id"])] = (result["message_id"],
+                                              data[:data.index(":") + 1])
+
+    boards = {}
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        api.listeners.append(board_sent)
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url).build())
+            application.add_handler(CommandHandler("queue", queue))
+            application.add_handler(CommandHandler("leave", leave))
+            application.add_handler(
+                CallbackQueryHandler(game, pattern=GAME_CALLBACK_PATTERN)
+            )
+            matchmaker = get_matchmaker(application)
+            async with application:
+                for update_id, user_id in enumerate((11, 12), 1):
+                    await application.process_update(Update.de_json(
+                        command(update_id, user_id, "/queue"),
+                        application.bot
+                    ))
+                match_id = matchmaker.match_of(11)
+                assert match_id == matchmaker.match_of(12)
+                store = application.bot_data["game_store"]
+                assert store.games_of(LOBBY_CHAT) == [match_id]
+                assert store.games_of(11) == store.games_of(12) == []
+                for update_id, (user_id, data) in enumerate(
+                        [(11, "00"), (11, "01"), (12, "10"), (11, "01"),
+                         (12, "11"), (11, "02")], 10):
+                    message_id, prefix = boards[user_id]
+                    board = message(user_id, "")
+                    board["message_id"] = message_id
+                    await application.process_update(Update.de_json({
+                        "update_id": update_id,
+                        "callback_query": {
+                            "id": str(update_id), "chat_instance": "1",
+                            "from": board["from"], "data": prefix + data,
+                            "message": board,
+                        },
+                    }, application.bot))
+                await application.bot_data["outbound"].flush()
+                ratings = application.bot_data["ratings"]
+                assert ratings.rank(11) == 1 and ratings.rank(12) == 2
+                won = (list(api.calls), dict(boards),
+                       store.games_of(LOBBY_CHAT), matchmaker.match_of(11))
+
+                for update_id, user_id in enumerate((12, 11), 20):
+                    await application.process_update(Update.de_json(
+                        command(update_id, user_id, "/queue"),
+                        application.bot
+                    ))
+                await application.process_update(Update.de_json(
+                    command(30, 11, "/leave"), application.bot
+                ))
+                await application.bot_data["outbound"].flush()
+                left = (api.calls[len(won[0]):], dict(boards),
+                        store.games_of(LOBBY_CHAT), matchmaker.match_of(12))
+                return won, left
+        finally:
+            await api.stop()
+
+    won, left = asyncio.run(scenario())
+    calls, won_boards, games, active = won
+    assert games == [] and active is None
+    edits = [params for _, method, params in calls
+             if method == "editMessageText"]
+    final = {int(params["chat_id"]): params["text"] for params in edits}
+    assert set(final) == set(won_boards) == {11, 12}
+    assert all(text.startswith("Победил ❌ (@p11)") for text in final.values())
+
+    calls, left_boards, games, active = left
+    assert games == [] and active is None and left_boards != won_boards
+    final = {int(params["chat_id"]): params["text"]
+             for _, method, params in calls if method == "editMessageText"}
+    assert final[11].startswith("Вы покинули игру")
+    assert final[12].startswith("Соперник покинул игру")
+
+
+def test_failed_ai_move_leaves_the_turn_to_the_player():
+    """
+    Test that a single-mode game keeps the player's symbol when the AI
+    search fails, so the next click still places the player's mark.
+    """
+    chat = {"id": 42, "type": "private"}
+    player = {"id": 42, "is_bot": False, "first_name": "p42"}
+
+    class BrokenPool:
+        async def best_move(self, board):
+            raise RuntimeError("worker died")
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url).build())
+            application.add_handler(
+                CallbackQueryHandler(game, pattern=GAME_CALLBACK_PATTERN)
+            )
+            store = application.bot_data["game_store"] = MemoryGameStore()
+            store.put((42, 7), {"board": Board(), "current_player": CROSS,
+                                "players": [{"id": 42, "name": "p42"}],
+                                "moves": [], "mode": "single"})
+            application.bot_data["ai_pool"] = BrokenPool()
+            async with application:
+                for update_id, data in enumerate(("00", "11"), 1):
+                    await application.process_update(Update.de_json({
+                        "update_id": update_id,
+                        "callback_query": {
+                            "id": str(update_id), "chat_instance": "1",
+                            "from": player, "data": data,
+                            "message": {"message_id": 7, "date": 0,
+                                        "chat": chat, "text": ""},
+                        },
+                    }, application.bot))
+                    if update_id == 1:
+                        turn = store.get((42, 7))["current_player"]
+                        application.bot_data["ai_pool"] = AIPool()
+                await application.bot_data["outbound"].flush()
+                return turn, store.get((42, 7))
+        finally:
+            await api.stop()
+
+    turn, game_data = asyncio.run(scenario())
+    assert turn == CROSS
+    assert game_data["board"].x == 0b10001
+    assert game_data["board"].o.bit_count() == 1
+    assert game_data["current_player"] == CROSS
+
+
+def test_group_plays_several_games_at_once():
+    """
+    Test that two games of one group are joined, played and ended
+    independently, each found by its board message.
+    """
+    chat = {"id": -5, "type": "group"}
+
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"p{user_id}"}
+
+    def command(user_id, text, reply_to=None):
+        message = {"message_id": 1, "date": 0, "chat": chat,
+                   "from": user(user_id), "text": text,
+                   "entities": [{"type": "bot_command", "offset": 0,
+                                 "length": len(text)}]}
+        if reply_to is not None:
+            message["reply_to_message"] = {"message_id": reply_to,
+                                           "date": 0, "chat": chat}
+        return {"message": message}
+
+    def click(user_id, message_id, data):
+        return {"callback_query": {
+            "id": "1", "chat_instance": "1", "from": user(user_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": 0, "chat": chat,
+                        "text": ""},
+        }}
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        menus = []
+        api.listeners.append(
+            lambda method, params, result: menus.append(result["message_id"])
+            if method == "sendMessage" and params["text"].startswith("При")
+            else None
+        )
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url).build())
+            application.add_handler(CommandHandler("start", start))
+            application.add_handler(
+                CallbackQueryHandler(mode_selection, pattern="^mode_.*$")
+            )
+            application.add_handler(
+                CallbackQueryHandler(join, pattern="^join$")
+            )
+            application.add_handler(
+                CallbackQueryHandler(game, pattern=GAME_CALLBACK_PATTERN)
+            )
+            application.add_handler(CommandHandler("join", join))
+            application.add_handler(CommandHandler("end", end))
+            store = application.bot_data["game_store"] = MemoryGameStore()
+            application.bot_data["outbound"] = OutboundQueue(1000, 1000,
+                                                             1000)
+
+            async def send(update_id, update):
+                update["update_id"] = update_id
+                await application.process_update(
+                    Update.de_json(update, application.bot)
+                )
+
+            async with application:
+                await send(1, command(1, "/start"))
+                await send(2, command(2, "/start"))
+                first, second = menus
+                await send(3, click(1, first, "mode_multi"))
+                await send(4, click(2, second, "mode_multi"))
+                # A button joins its own game, /join the oldest open one.
+                await send(5, click(3, first, "join"))
+                await send(6, command(4, "/join"))
+                for update_id, (user_id, board, data) in enumerate(
+                        [(1, first, "00"), (2, second, "11"),
+                         (3, first, "11"), (4, second, "00"),
+                         (4, first, "22")], 7):
+                    await send(update_id, click(user_id, board, data))
+                games = {key: ([p["id"] for p in game["players"]],
+                               game["board"].x, game["board"].o)
+                         for key, game in store.items()}
+                await send(20, command(4, "/end"))
+                left = store.games_of(-5)
+                await send(21, command(1, "/end", reply_to=first))
+                await application.bot_data["outbound"].flush()
+                return first, second, games, left, store.games_of(-5)
+        finally:
+            await api.stop()
+
+    first, second, games, left, finally_left = asyncio.run(scenario())
+    assert games == {(-5, first): ([1, 3], 0b1, 0b10000),
+                     (-5, second): ([2, 4], 0b10000, 0b1)}
+    assert left == [first] and finally_left == []
+
+
+def test_inline_callback_is_signed_and_fits_telegram_limit():
+    """
+    Test that inline callback data round-trips, fits in 64 bytes and is
+    rejected when tampered with or moved to another message.
+    """
+    key = b"secret"
+    game = InlineGame(0b100010001, 0b11000, 2 ** 52 - 1, 2 ** 40, False)
+    data = pack_callback(game, 5, "msg-1", key)
+    assert len(data.encode()) <= 64
+    assert unpack_callback(data, "msg-1", key) == (game, 5)
+
+    tampered = data[:10] + ("A" if data[10] != "A" else "B") + data[11:]
+    for bad, message_id, bad_key in ((tampered, "msg-1", key),
+                                     (data, "msg-2", key),
+                                     (data, "msg-1", b"other"),
+                                     (data[:-2], "msg-1", key)):
+        with pytest.raises(ValueError):
+            unpack_callback(bad, message_id, bad_key)
+
+    # The first keyboard is signed before the message exists.
+    empty = InlineGame(0, 0, 7, 0, True)
+    assert unpack_callback(pack_callback(empty, 0, "", key), "any",
+                           key) == (empty, 0)
+
+
+def test_inline_games_keep_no_state():
+    """
+    Test that an inline game for two and one against the AI are played
+    from the callback data alone.
+    """
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"p{user_id}"}
+
+    async def scenario():
+        api = FakeTelegramAPI()
+        markups = {}
+        api.listeners.append(
+            lambda method, params, result: markups.update(
+                {r["id"]: r["reply_markup"] for r in params["results"]}
+                if method == "answerInlineQuery"
+                else {params["inline_message_id"]: params["reply_markup"]}
+                if method == "editMessageText" and "reply_markup" in params
+                else {}
+            )
+        )
+        await api.start()
+        try:
+            application = (Application.builder().token("1:TEST")
+                           .base_url(api.base_url).build())
+            application.add_handler(InlineQueryHandler(inline_query))
+            application.add_handler(CallbackQueryHandler(
+                inline_game, pattern=INLINE_CALLBACK_PATTERN
+            ))
+
+            async def click(update_id, user_id, message_id, source, cell):
+                rows = markups[source]["inline_keyboard"]
+                await application.process_update(Update.de_json({
+                    "update_id": update_id,
+                    "callback_query": {
+                        "id": str(update_id), "chat_instance": "1",
+                        "from": user(user_id), "inline_message_id":
+                            message_id,
+                        "data": rows[cell // 3][cell % 3]["callback_data"],
+                    },
+                }, application.bot))
+
+            async with application:
+                await application.process_update(Update.de_json({
+                    "update_id": 1,
+                    "inline_query": {"id": "q", "from": user(1),
+                                     "query": "", "offset": ""},
+                }, application.bot))
+                await click(2, 1, "duel", "duel", 4)
+                await click(3, 1, "duel", "duel", 0)
+                await click(4, 2, "duel", "duel", 0)
+                # Player 3 is not in the game.
+                await click(5, 3, "duel", "duel", 1)
+                await click(6, 1, "ai", "ai", 4)
+        finally:
+            await api.stop()
+        return markups, application.bot_data
+
+    markups, bot_data = asyncio.run(scenario())
+
+    def cells(markup):
+        return [button["text"] for row in markup["inline_keyboard"][:3]
+                for button in row]
+
+    assert cells(markups["duel"]) == [ZERO] + [FREE_SPACE] * 3 + [CROSS] \
+        + [FREE_SPACE] * 4
+    game, _ = unpack_callback(
+        markups["duel"]["inline_keyboard"][0][1]["callback_data"], "duel"
+    )
+    assert (game.cross, game.zero, game.turn) == (1, 2, CROSS)
+    assert cells(markups["ai"]).count(ZERO) == 1
+    assert cells(markups["ai"])[4] == CROSS
+    assert bot_data == {}
+
+
+def test_inline_game_survives_failed_edits():
+    """
+    Test that a repeated edit of a stale inline keyboard is ignored and
+    that other API errors are counted instead of escaping the handler.
+    """
+    metrics = sys.modules[handlers.instrument.__module__]
+    errors = metrics.HANDLER_ERRORS.labels("inline_game")
+    data = pack_callback(InlineGame(0, 0, 1, 0, False), 4)
+
+    async def answer(*args, **kwargs):
+        pass
+
+    def click(error):
+        async def edit_message_text(*args, **kwargs):
+            raise error
+
+        query = SimpleNamespace(data=data, inline_message_id=None,
+                                from_user=SimpleNamespace(id=1),
+                                answer=answer,
+                                edit_message_text=edit_message_text)
+        return SimpleNamespace(callback_query=query, effective_chat=None,
+                               effective_user=query.from_user)
+
+    before = errors.get()
+    asyncio.run(inline_game(click(BadRequest(
+        "Message is not modified: specified new message content and reply "
+        "markup are exactly the same"
+    )), None))
+    assert errors.get() == before
+    asyncio.run(inline_game(click(BadRequest("Message to edit not found")),
+                            None))
+    assert errors.get() == before + 1
+
+
+def test_rank_index_matches_sorting():
+    """
+    Test that ranks and the top of the Fenwick index agree with sorting
+    all players after random rating changes.
+    """
+    rng = random.Random(3)
+    ratings = {user_id: rng.uniform(800, 2000) for user_id in range(2000)}
+    index = RankIndex()
+    for user_id, rating in ratings.items():
+        index.add(user_id, rating)
+    for user_id in rng.sample(sorted(ratings), 500):
+        index.remove(user_id, ratings[user_id])
+        ratings[user_id] += rng.uniform(-100, 100)
+        index.add(user_id, ratings[user_id])
+
+    slots = {user_id: RankIndex.slot(r) for user_id, r in ratings.items()}
+    for user_id in rng.sample(sorted(ratings), 100):
+        higher = sum(slot > slots[user_id] for slot in slots.values())
+        assert index.rank(ratings[user_id]) == higher + 1
+    leaders = index.top(25)
+    assert [slots[user_id] for user_id in leaders] == sorted(
+        slots.values(), reverse=True
+    )[:25]
+    assert len(index.top(5000)) == len(index) == 2000
+
+
+def test_rating_table_updates_once_and_batches_writes(tmp_path):
+    """
+    Test that a finished game moves both ratings once, a draw lifts the
+    lower rating, and ratings reach SQLite only on flush.
+    """
+    url = "sqlite:" + str(tmp_path / "ratings.db")
+    ratings = create_rating_table(url)
+    context = SimpleNamespace(bot_data={"ratings": ratings})
+    players = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+    won = {"mode": "multi", "players": players}
+    assert rate_game(context, won, CROSS_WIN) == (20.0, -20.0)
+    assert rate_game(context, won, CROSS_WIN) is None
+    assert rate_game(context, {"mode": "single", "players": players[:1]},
+                     CROSS_WIN) is None
+    assert rate_game(context, {"mode": "lobby", "players": players[::-1]},
+                     REPLAY_DRAW)[0] > 0
+
+    assert len(create_rating_table(url)) == 0
+    ratings.flush()
+    reloaded = create_rating_table(url)
+    assert reloaded.rating_of(1) == ratings.rating_of(1) > 1200
+    assert [user_id for user_id, _ in reloaded.top(2)] == [1, 2]
+    assert reloaded.players[2].losses == 1 and reloaded.players[2].draws == 1
+    assert reloaded.rank(2) == 2 and reloaded.rank(3) is None
+
+
+def test_rating_tables_of_processes_share_one_file(tmp_path):
+    """
+    Test that two processes rating games on one SQLite file add up their
+    results instead of overwriting each other, and see each other's
+    players on the leaderboard.
+    """
+    url = "sqlite:" + str(tmp_path / "ratings.db")
+    first = create_rating_table(url)
+    second = create_rating_table(url)
+    first.record((1, "a"), (2, "b"), CROSS_WIN)
+    second.record((1, "a"), (3, "c"), CROSS_WIN)
+    first.flush()
+    second.flush()
+    first.flush()
+
+    for table in (first, second):
+        player = table.players[1]
+        assert (player.games, player.wins) == (2, 2)
+        assert player.rating == 1240
+        assert [user_id for user_id, _ in table.top(3)][0] == 1
+        assert len(table) == 3 and table.rank(2) == table.rank(3) == 2